@@ -6,6 +6,7 @@ The server uses Flask to serve a React frontend, and connect to a postgres
 database.
 """
 
+import atexit
 import base64
 import binascii
 import copy
@@ -15,12 +16,13 @@ import logging
 import sys
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import TimedRotatingFileHandler
 
 import apscheduler.schedulers.background
 import flask_session
 import requests
-from flask import Flask, abort, jsonify, redirect, request, session, url_for
+from flask import Flask, abort, g, jsonify, redirect, request, session, url_for
 from flask_caching import Cache
 from flask_login import (
     LoginManager,
@@ -32,20 +34,29 @@ from flask_login import (
 from utils.cert_acess import (
     check_certificate_s3,
     create_pdf_response,
-    download_certificate_s3,
+    create_pdf_stream_response,
     get_certificate,
     get_certificate_data,
+    get_certificate_preview,
+    register_digital_certificate,
     sign_data,
     upload_certificate,
     verify_certificate_checksum,
     verify_signature,
 )
 
+import utils.cert_jobs as cert_jobs  # isort:skip
+import utils.instrumentation as instrumentation  # isort:skip
+import utils.metrics as metrics  # isort:skip
 import utils.csvparser as csvparser  # isort:skip
 import utils.external_auth  # isort:skip
+import utils.genetics_cache as genetics_cache  # isort:skip
+import utils.genetics_refresher as genetics_refresher  # isort:skip
+import utils.rapi as rapi  # isort:skip
 import utils.data_access as da  # isort:skip
 import utils.database as db  # isort:skip
 import utils.settings as settings  # isort:skip
+import utils.slow_queries as slow_queries  # isort:skip
 import utils.genebank_logging as gblogging  # isort:skip
 
 APP = Flask(__name__, static_folder="/static")
@@ -77,6 +88,13 @@ file_handler.setFormatter(
     )
 )
 APP.logger.addHandler(file_handler)
+slow_query_handler = TimedRotatingFileHandler(
+    f"{settings.service.logfolder}/slow_queries.log", when="W6", delay=True
+)
+slow_query_handler.setFormatter(
+    logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+)
+slow_queries.logger.addHandler(slow_query_handler)
 utils.external_auth.setup(APP)
 
 flask_session.Session().init_app(APP)
@@ -85,18 +103,80 @@ CACHE = Cache(APP)
 LOGIN = LoginManager(APP)
 LOGIN.login_view = "/login"
 
-KINSHIP_LIFETIME = 300
+# Genetics results older than this are refreshed in the background
+GENETICS_LIFETIME = 300
+# Genetics results that are also stored per individual, see get_ind_genetics
+INDIVIDUAL_GENETICS = ("inbreeding", "meankinship")
+
+
+def store_genetics(kind, g_id, values, data_version):
+    """
+    Stores the per individual genetics results `values` of the genebank given
+    by `g_id`, so that they can be looked up per individual.
+    """
+    if kind in INDIVIDUAL_GENETICS:
+        da.store_genetics(g_id, kind, values, data_version)
+
+
+GENETICS = genetics_cache.GeneticsCache(
+    CACHE, APP.config["CACHE_DIR"], GENETICS_LIFETIME, store=store_genetics
+)
+RAPI = rapi.RapiClient(
+    "http://{}:{}".format(settings.rapi.host, settings.rapi.port),
+    timeout=settings.rapi.timeout,
+    failure_threshold=settings.rapi.failure_threshold,
+    reset_timeout=settings.rapi.reset_timeout,
+    pool_size=settings.rapi.pool_size,
+)
+# Fetches the genetics results of an individual concurrently
+GENETICS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=settings.rapi.pool_size, thread_name_prefix="genetics"
+)
 
 
 # Before_request
-# function that will update users last_active field in the database
+# function that will update users last_active field
 # this will be called before every request
+def primary_pin():
+    """
+    Returns the time until which the current session or user reads from the
+    primary database, as they have written recently.
+    """
+    until = session.get("db_primary_until", 0)
+    if current_user.is_authenticated:
+        until = max(until, CACHE.get(f"db-primary-{current_user.uuid}") or 0)
+    return until
+
+
+def pin_primary(until):
+    """
+    Keeps the current session and user on the primary database until `until`,
+    so that they read their own writes. Users are pinned in the shared cache,
+    as API token and basic auth clients have no session.
+    """
+    if session:
+        session["db_primary_until"] = until
+    if current_user.is_authenticated:
+        CACHE.set(
+            f"db-primary-{current_user.uuid}",
+            until,
+            timeout=settings.postgres.replica_pin,
+        )
+
+
 @APP.before_request
 def before_request():
     """
-    Callback that triggers before each request. This is used to update the users last active.
+    Callback that triggers before each request. This is used to start the
+    request instrumentation, to check out a pooled database connection, to
+    keep sessions that have recently written on the primary database, and to
+    update the users last active.
     """
-    # update last_active field in the database
+    instrumentation.start_request()
+    db.open_request_connection()
+    db.start_request(pinned=primary_pin() > time.time())
+    # update last_active, this is written to the database in batches by
+    # flush_last_active
     if current_user.is_authenticated:
         current_user.update_last_active()
 
@@ -105,8 +185,30 @@ def before_request():
 def after_request(response):
     """
     Callback that triggers after each request. Currently this is used to set
-    CORS headers to allow a different origin when using the development server.
-    """
+    CORS headers to allow a different origin when using the development server,
+    to keep sessions that have written on the primary database, so that they
+    read their own writes, and to log and record the request instrumentation.
+    """
+    if db.request_wrote():
+        pin_primary(time.time() + settings.postgres.replica_pin)
+
+    stats = instrumentation.end_request()
+    if stats is not None:
+        endpoint = request.endpoint or "unmatched"
+        metrics.REQUEST_DURATION.observe(
+            time.perf_counter() - stats.start, request.method, endpoint
+        )
+        metrics.REQUESTS.inc(request.method, endpoint, response.status_code)
+        metrics.DB_QUERIES.inc(endpoint, amount=stats.queries)
+        APP.logger.info(
+            "%s %s %s: %s",
+            request.method,
+            request.endpoint,
+            response.status_code,
+            stats.summary(),
+        )
+        if APP.debug:
+            response.headers.update(stats.headers())
 
     if "Origin" in request.headers:
         origin = request.headers["Origin"]
@@ -121,10 +223,34 @@ def after_request(response):
     return response
 
 
+@APP.teardown_request
+def teardown_request(exception):  # pylint: disable=unused-argument
+    """
+    Callback that triggers at the end of each request, even if it failed. This
+    is used to return the pooled database connection of the request.
+    """
+    db.close_request_connection()
+
+
 @LOGIN.request_loader
 def load_user_from_request(request):
-    # Try to login using Basic Auth
+    """
+    Loads the user from the request headers for machine clients. Either an API
+    token (`Authorization: Bearer <token>`) or basic auth can be used.
+
+    No session is created for these requests, instead the user is kept for the
+    current request only, see `get_user_uuid`.
+    """
     api_key = request.headers.get("Authorization")
+    if api_key and api_key.startswith("Bearer "):
+        user = da.authenticate_token(api_key[len("Bearer ") :].strip())  # noqa: E203
+        if user:
+            g.user_uuid = user.uuid
+            return user
+        APP.logger.info("Failed login from header with API token")
+        return None
+
+    # Try to login using Basic Auth
     if api_key:
         api_key = api_key.replace("Basic ", "", 1)
         try:
@@ -134,16 +260,13 @@ def load_user_from_request(request):
 
         username = api_key[: api_key.find(b":")]
         password = api_key[api_key.find(b":") + 1 :].decode()  # noqa: E203
-        user = da.authenticate_user(username, password)
+        user = da.authenticate_user_cached(username, password)
 
         if user:
             if user.username != "rapiuser" and user.username != "r-api-system-user":
                 APP.logger.info("User %s logged in from request header", user.username)
 
-            session["user_id"] = user.uuid
-            session.modified = True
-            login_user(user)
-
+            g.user_uuid = user.uuid
             return user
 
         APP.logger.info("Failed login from header for %s", username)
@@ -152,6 +275,14 @@ def load_user_from_request(request):
     return None
 
 
+def get_user_uuid():
+    """
+    Returns the uuid of the logged in user, either from the session or from
+    the request headers.
+    """
+    return session.get("user_id", g.get("user_uuid", None))
+
+
 # pylint: disable=unused-argument
 @LOGIN.user_loader
 def load_user(u_id):
@@ -170,7 +301,7 @@ def get_user():
     Returns information on the current logged in user, or an empty user object
     representing an anonymous user.
     """
-    user = da.fetch_user_info(session.get("user_id", None))
+    user = da.fetch_user_info(get_user_uuid())
     return jsonify(user.frontend_data() if user else None)
 
 
@@ -178,7 +309,7 @@ def get_user():
 @login_required
 def get_active_users():
     minutes = request.args.get("minutes", default=15, type=int)
-    active_users = da.get_active_users(minutes, session.get("user_id", None))
+    active_users = da.get_active_users(minutes, get_user_uuid())
     return jsonify(active_users)
 
 
@@ -189,7 +320,7 @@ def get_users():
     for admin, all users except admin users for managers, and None for regular
     users.
     """
-    users = da.get_users(session.get("user_id", None))
+    users = da.get_users(get_user_uuid())
     return jsonify(users=users)
 
 
@@ -220,11 +351,11 @@ def manage_user(u_id):
             form["id"] = u_id
 
     if request.method == "GET":
-        retval = da.get_user(u_id, session.get("user_id", None))
+        retval = da.get_user(u_id, get_user_uuid())
     if request.method in ("UPDATE", "PATCH"):
-        retval = da.update_user(form, session.get("user_id", None))
+        retval = da.update_user(form, get_user_uuid())
     if request.method == "POST":
-        retval = da.add_user(form, session.get("user_id", None))
+        retval = da.add_user(form, get_user_uuid())
     return jsonify(retval)
 
 
@@ -271,10 +402,29 @@ def manage_roles():
         }
     """
     form = request.json
-    status = da.update_role(form, session.get("user_id", None))
+    status = da.update_role(form, get_user_uuid())
     return jsonify(status)
 
 
+@APP.route("/api/manage/token/<int:u_id>", methods=["POST", "DELETE"])
+@login_required
+def manage_api_token(u_id):
+    """
+    Creates a new API token for the user identified by `u_id` on `POST`, or
+    removes it on `DELETE`. Only admins can manage API tokens.
+
+    The return value will be formatted like:
+        JSON: {
+            status: 'unchanged' | 'updated' | 'created' | 'error',
+            message?: string,
+            data?: <token>
+        }
+    """
+    if request.method == "DELETE":
+        return jsonify(da.revoke_api_token(u_id, get_user_uuid()))
+    return jsonify(da.create_api_token(u_id, get_user_uuid()))
+
+
 @APP.route("/api/manage/herd", methods=["POST", "PATCH"])
 @login_required
 def manage_herd():
@@ -290,23 +440,23 @@ def manage_herd():
     form = request.json
     status = {"status": "error", "message": "Unknown request"}
     if request.method == "POST":
-        status = da.add_herd(form, session.get("user_id", None))
+        status = da.add_herd(form, get_user_uuid())
     elif request.method == "PATCH":
-        status = da.update_herd(form, session.get("user_id", None))
+        status = da.update_herd(form, get_user_uuid())
     return jsonify(status)
 
 
 @APP.route("/api/breeding/date/<birth_date>")
 @login_required
 def breedings_from_date(birth_date):
-    breedings = da.get_breeding_events_by_date(birth_date, session.get("user_id", None))
+    breedings = da.get_breeding_events_by_date(birth_date, get_user_uuid())
     return jsonify(breedings=breedings)
 
 
 @APP.route("/api/breeding/id/<breeding_id>")
 @login_required
 def breeding(breeding_id):
-    breeding = da.get_breeding_event(breeding_id, session.get("user_id", None))
+    breeding = da.get_breeding_event(breeding_id, get_user_uuid())
     return jsonify(breeding=breeding)
 
 
@@ -319,7 +469,7 @@ def herd_breeding_list(h_id):
     calculate breed date from birth date to find a match or take the
     exact birth date if it exists.
     """
-    breedings = da.get_breeding_events_with_ind(h_id, session.get("user_id", None))
+    breedings = da.get_breeding_events_with_ind(h_id, get_user_uuid())
 
     if request.method == "POST":
         form = request.json
@@ -390,9 +540,9 @@ def register_breeding():
     form = request.json
     status = {"status": "error", "message": "Unknown request"}
     if request.method == "POST":
-        status = da.register_breeding(form, session.get("user_id", None))
+        status = da.register_breeding(form, get_user_uuid())
     if request.method == "PATCH":
-        status = da.update_breeding(form, session.get("user_id", None))
+        status = da.update_breeding(form, get_user_uuid())
     return jsonify(status)
 
 
@@ -410,7 +560,7 @@ def delete_breeding():
     breeding_id = request.json
     status = {"status": "error", "message": "Unknown request"}
     if request.method == "POST":
-        status = da.delete_breeding(breeding_id, session.get("user_id", None))
+        status = da.delete_breeding(breeding_id, get_user_uuid())
     return jsonify(status)
 
 
@@ -428,7 +578,7 @@ def register_birth():
     form = request.json
     status = {"status": "error", "message": "Unknown request"}
     if request.method == "POST":
-        status = da.register_birth(form, session.get("user_id", None))
+        status = da.register_birth(form, get_user_uuid())
     return jsonify(status)
 
 
@@ -665,7 +815,7 @@ def genebank(g_id=None):
     Returns information on the genebank given by `g_id`, or a list of all
     genebanks if no `g_id` is given.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     if g_id:
         return jsonify(da.get_genebank(g_id, user_id))
     return jsonify(genebanks=da.get_genebanks(user_id))
@@ -678,7 +828,7 @@ def genebank_individuals(g_id):
     Returns individuals for the genebank given by `g_id`, if allowed for the
     currently logged in user.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     return jsonify(individuals=da.get_individuals(g_id, user_id))
 
 
@@ -688,7 +838,7 @@ def herd(h_id):
     """
     Returns information on the herd given by `h_id`.
     """
-    data = da.get_herd(h_id, session.get("user_id", None))
+    data = da.get_herd(h_id, get_user_uuid())
     return jsonify(data)
 
 
@@ -698,21 +848,19 @@ def individual(i_number):
     """
     Returns information on the individual given by `i_number`.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     ind = da.get_individual(i_number, user_id)
 
     if ind:
-        try:
-            ind["inbreeding"] = "%.2f" % (
-                get_ind_inbreeding(i_number, ind["genebank_id"]) * 100
-            )
-            ind["MK"] = "%.2f" % (
-                get_ind_mean_kinship(i_number, ind["genebank_id"]) * 100
-            )
-        except requests.exceptions.ConnectionError as error:
-            APP.logger.error("%s", error)
-            ind["inbreeding"] = ind["inbreeding"] if "inbreeding" in ind else None
-            ind["MK"] = None
+        values, stale = get_ind_genetics(i_number, ind["genebank_id"])
+        for kind, key in [("inbreeding", "inbreeding"), ("meankinship", "MK")]:
+            if values[kind] is not None:
+                ind[key] = "%.2f" % (values[kind] * 100)
+            else:
+                ind[key] = ind.get(key)
+        # The genebank has changed since the results were computed, or the
+        # R-API could not be reached
+        ind["genetics_stale"] = stale
     return jsonify(ind)
 
 
@@ -731,9 +879,9 @@ def edit_individual():
     form = request.json
     try:
         if request.method == "PATCH":
-            retval = da.update_individual(form, session.get("user_id", None))
+            retval = da.update_individual(form, get_user_uuid())
         if request.method == "POST":
-            retval = da.add_individual(form, session.get("user_id", None))
+            retval = da.add_individual(form, get_user_uuid())
     except Exception as error:
         APP.logger.error("Unexpected error when edit individual: " + str(error))
         return (
@@ -834,14 +982,62 @@ def check_ind_intyg():
     )
 
 
-def get_ind_inbreeding(i_number, g_id):
+def get_ind_genetics(i_number, g_id):
+    """
+    Returns the inbreeding coefficient and mean kinship of the individual given
+    by `i_number`, belonging to the genebank given by `g_id`, as a dict by
+    kind, and whether they are stale. Individuals without results get 0.
+
+    The results are read from the results stored per individual. Results of
+    an older genebank data version, or older than the genetics lifetime, are
+    returned as stale while the genebank results are refreshed in the
+    background. The whole genebank results are
+    only used if none are stored yet, and are then fetched concurrently. If
+    the R-API can't be reached, times out or fails, the result is `None`.
+    """
+    fetchers = {"inbreeding": fetch_inbreeding, "meankinship": fetch_mean_kinship}
+    version = db.get_data_version(g_id)
+    values = {}
+    stale = False
+    missing = {}
+    for kind, fetch in fetchers.items():
+        stored = da.get_individual_genetics(i_number, g_id, kind)
+        if stored is None:
+            missing[kind] = GENETICS_EXECUTOR.submit(
+                get_genebank_genetics, kind, g_id, fetch
+            )
+            continue
+        value, data_version, computed = stored
+        age = datetime.datetime.now() - (computed or datetime.datetime.min)
+        if data_version != version or age.total_seconds() >= GENETICS_LIFETIME:
+            stale = True
+            GENETICS.refresh(kind, g_id, lambda fetch=fetch: fetch(g_id))
+        values[kind] = value if value is not None else 0
+
+    for kind, future in missing.items():
+        try:
+            result, result_stale = future.result()
+        except requests.exceptions.RequestException as error:
+            APP.logger.error("Could not fetch %s: %s", kind, error)
+            result, result_stale = None, True
+        # Failed fetches give no results at all, rather than 0 for everyone
+        values[kind] = result.get(i_number, 0) if result else None
+        stale = stale or result_stale or not result
+    return values, stale
+
+
+def get_genebank_genetics(kind, g_id, fetch):
     """
-    Returns  the inbreeding coefficient of the individual given by `i_number`.
+    Returns the `kind` result of the genebank given by `g_id` from the
+    genetics cache, using `fetch` if it isn't cached, and whether it's stale.
+    Runs in the genetics executor, so the database connection of the thread
+    is closed afterwards.
     """
-    coefficients = get_inbreeding(g_id)
-    if i_number in coefficients:
-        return coefficients[i_number]
-    return 0
+    try:
+        return GENETICS.lookup(kind, g_id, lambda: fetch(g_id))
+    finally:
+        if not db.DATABASE.is_closed():
+            db.DATABASE.close()
 
 
 @APP.route("/api/<int:g_id>/inbreeding/")
@@ -854,15 +1050,21 @@ def inbreeding(g_id):
 
 
 def get_inbreeding(g_id):
+    """
+    Returns the inbreeding coefficients of the genebank given by `g_id`, from
+    the genetics cache.
+    """
+    return GENETICS.get("inbreeding", g_id, lambda: fetch_inbreeding(g_id))
+
+
+def fetch_inbreeding(g_id):
     """
     Fetch ibreeding coefficient from R-API of the genebank given by `g_id`.
     """
-    response = requests.get(
-        "http://{}:{}/inbreeding/{}".format(
-            settings.rapi.host, settings.rapi.port, g_id
-        ),
-        params={},
-        timeout=30,
+    response = RAPI.get(
+        "inbreeding",
+        "/inbreeding/{}".format(g_id),
+        params={"update_from_db": "TRUE"},
     )
 
     if response.status_code == 200:
@@ -881,15 +1083,20 @@ def kinship(g_id):
     return jsonify(get_kinship(str(g_id)))
 
 
-@CACHE.memoize(timeout=KINSHIP_LIFETIME)
 def get_kinship(g_id):
+    """
+    Returns the kinship matrix of the genebank given by `g_id`, from the
+    genetics cache.
+    """
+    return GENETICS.get("kinship", g_id, lambda: fetch_kinship(g_id))
+
+
+def fetch_kinship(g_id):
     """
     Fetch kinship matrix from R-api of the genebank given  by `g_id`.
     """
-    response = requests.get(
-        "http://{}:{}/kinship/{}".format(settings.rapi.host, settings.rapi.port, g_id),
-        params={"update_data": "TRUE"},
-        timeout=30,
+    response = RAPI.get(
+        "kinship", "/kinship/{}".format(g_id), params={"update_data": "TRUE"}
     )
 
     if response.status_code == 200:
@@ -900,16 +1107,6 @@ def get_kinship(g_id):
     return {}
 
 
-def get_ind_mean_kinship(i_number, g_id):
-    """
-    Returns the mean kinship coefficient of the individual given by `i_number`.
-    belonging to the genebank given by `g_id`.
-    In case the individual is not active, we return 0.
-    """
-    mk_values = get_mean_kinship(g_id)
-    return mk_values[i_number] if i_number in mk_values else 0
-
-
 @APP.route("/api/<int:g_id>/meankinship/")
 def mean_kinship(g_id):
     """
@@ -919,15 +1116,21 @@ def mean_kinship(g_id):
 
 
 def get_mean_kinship(g_id):
+    """
+    Returns the mean kinship of the genebank given by `g_id`, from the
+    genetics cache.
+    """
+    return GENETICS.get("meankinship", g_id, lambda: fetch_mean_kinship(g_id))
+
+
+def fetch_mean_kinship(g_id):
     """
     Fetch the mean kinship matrix from R-api of the genebank given  by `g_id`.
     """
-    response = requests.get(
-        "http://{}:{}/meankinship/{}".format(
-            settings.rapi.host, settings.rapi.port, g_id
-        ),
-        params={},
-        timeout=30,
+    response = RAPI.get(
+        "meankinship",
+        "/meankinship/{}".format(g_id),
+        params={"update_from_db": "TRUE"},
     )
 
     if response.status_code == 200:
@@ -944,7 +1147,7 @@ def testbreed():
     APP.logger.info(f"Testbreed calculation input {payload}")
     try:
         # Make sure mother and father are in the active population
-        user_id = session.get("user_id", None)
+        user_id = get_user_uuid()
         father = da.get_individual(payload.get("male", ""), user_id)
         mother = da.get_individual(payload.get("female", ""), user_id)
         if (
@@ -958,13 +1161,7 @@ def testbreed():
         # One/both parents not registrered, thus not present in the kinship matrix
         else:
             payload["update_data"] = "TRUE"
-            response = requests.post(
-                "http://{}:{}/testbreed/".format(
-                    settings.rapi.host, settings.rapi.port
-                ),
-                data=payload,
-                timeout=30,
-            )
+            response = RAPI.post("testbreed", "/testbreed/", data=payload)
             offspring_coi = response.json()["calculated_coi"][0]
     except Exception as ex:  # pylint: disable=broad-except
         APP.logger.error(ex)
@@ -981,7 +1178,7 @@ def update_certificate(i_number):
     """
     Returns an updated pdf of the individual given by `i_number`.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     ind_data = da.get_individual(i_number, user_id)
     # get_individual currently returns a dict, not an individual
     if ind_data is None:
@@ -1029,7 +1226,7 @@ def issue_certificate(i_number):
     """
     Returns an issued pdf certificate of the individual given by `i_number`.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     ind_data = da.get_individual(i_number, user_id)
     # get_individual currently returns a dict, not an individual
     if ind_data is None:
@@ -1042,9 +1239,10 @@ def issue_certificate(i_number):
         try:
             present = check_certificate_s3(ind_number=ind_data["number"])
             if certificate_exists and present:
-                cert = download_certificate_s3(i_number)
-                return create_pdf_response(
-                    pdf_bytes=cert, obj_name=f"{i_number}_certificate.pdf"
+                return create_pdf_stream_response(
+                    i_number,
+                    obj_name=f"{i_number}_certificate.pdf",
+                    request_range=request.range,
                 )
         except Exception as ex:  # pylint: disable=broad-except
             print(ex)
@@ -1054,22 +1252,8 @@ def issue_certificate(i_number):
         if certificate_exists or paper_certificate_exists:
             return jsonify({"response": "Certificate already exists"}), 400
 
-        form = request.json
-        breed_data = db.Breeding.get(ind_data.get("breeding")).as_dict()
-        ind_data.update(**form, issue_digital=True)
-        # keep the ind_data object intact
-        ind_data_copy = copy.copy(ind_data)
-        # Update breeding if litter size has changed
-        if breed_data.get("litter_size") != form.get("litter_size") or breed_data.get(
-            "litter_size6w"
-        ) != form.get("litter_size6w"):
-            breed_data.update(litter_size6w=form.get("litter_size6w"))
-            breed_data.update(litter_size=form.get("litter_size"))
-            da.update_breeding(breed_data, user_id)
-        res = da.update_individual(ind_data, user_id)
-        cert_number = res.get("digital_certificate", None)
-        cert_data = get_certificate_data(ind_data_copy, user_id)
-        cert_data.update(digital_certificate=cert_number)
+        _, cert_data = register_digital_certificate(ind_data, request.json, user_id)
+        cert_number = cert_data["digital_certificate"]
         pdf_bytes = get_certificate(cert_data)
         ind_number = ind_data["number"]
         uploaded = False
@@ -1094,13 +1278,54 @@ def issue_certificate(i_number):
         return jsonify({"response": "Certificate could not be uploaded"}), 400
 
 
+@APP.route("/api/certificates/issue", methods=["POST"])
+@login_required
+def issue_certificates():
+    """
+    Queues a job issuing certificates for all individuals in the posted
+    `individuals` list. Each item is either an individual number, or an object
+    with the individual `number` and the same fields as a single certificate
+    issue.
+
+    Returns the job status, which can be followed with
+    `/api/certificates/jobs/<job_id>`.
+    """
+    user_id = get_user_uuid()
+    individuals = (request.json or {}).get("individuals", None)
+    if not isinstance(individuals, list) or not individuals:
+        return jsonify({"response": "No individuals given"}), 400
+
+    items = []
+    for individual in individuals:
+        item = individual if isinstance(individual, dict) else {"number": individual}
+        if not isinstance(item.get("number", None), str):
+            return jsonify({"response": "Invalid individual in list"}), 400
+        items += [item]
+
+    job = cert_jobs.submit_issue_job(items, user_id)
+    return jsonify(job.as_dict()), 202
+
+
+@APP.route("/api/certificates/jobs/<job_id>", methods=["GET"])
+@login_required
+def certificate_job_status(job_id):
+    """
+    Returns the progress, and the per individual results, of the certificate
+    job given by `job_id`.
+    """
+    job = cert_jobs.get_job(job_id, get_user_uuid())
+    if job is None:
+        return jsonify({"response": "Job not found"}), 404
+    return jsonify(job.as_dict())
+
+
 @APP.route("/api/certificates/preview/<i_number>", methods=["POST", "GET"])
 @login_required
 def preview_certificate(i_number):
     """
     Returns a preview of a pdf certificate of the individual given by `i_number`.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     ind = da.get_individual(i_number, user_id)
     if ind is None:
         return jsonify({"response": "Individual not found"}), 404
@@ -1108,13 +1333,10 @@ def preview_certificate(i_number):
     if request.method == "POST":
         form = request.json
         ind.update(**form, certificate=ind["digital_certificate"])
-        data = get_certificate_data(ind, user_id)
-        pdf_bytes = get_certificate(data)
-    elif request.method == "GET":
-        data = get_certificate_data(ind, user_id)
-        pdf_bytes = get_certificate(data)
+    data = get_certificate_data(ind, user_id)
+    pdf_bytes = get_certificate_preview(data)
 
-    return create_pdf_response(pdf_bytes=pdf_bytes.getvalue(), obj_name="preview.pdf")
+    return create_pdf_response(pdf_bytes=pdf_bytes, obj_name="preview.pdf")
 
 
 @APP.route("/api/certificates/verify/<i_number>", methods=["POST"])
@@ -1123,7 +1345,7 @@ def verify_certificate(i_number):
     """
     Returns whether an pdf certificate has been issued by us and matches our checksum.
     """
-    user_id = session.get("user_id", None)
+    user_id = get_user_uuid()
     ind = da.get_individual(i_number, user_id)
     if ind is None:
         return jsonify({"response": "Individual not found"}), 404
@@ -1155,6 +1377,53 @@ def verify_certificate(i_number):
     )
 
 
+@APP.route("/api/metrics", methods=["GET"])
+@login_required
+def get_metrics():
+    """
+    Returns the application metrics in the Prometheus text format, for admins.
+    Scrapers can log in with basic auth.
+    """
+    if not current_user.is_admin:
+        return jsonify({"response": "Access denied"}), 403
+    return (
+        metrics.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@APP.route("/api/manage/slow_queries", methods=["GET"])
+@login_required
+def get_slow_queries():
+    """
+    Returns the slow queries with the highest total time, aggregated by
+    normalised SQL, for admins. The number of queries returned is given by the
+    `limit` parameter.
+    """
+    if not current_user.is_admin:
+        return jsonify({"response": "Access denied"}), 403
+    limit = request.args.get("limit", default=20, type=int)
+    return jsonify(
+        {
+            "threshold": settings.postgres.slow_query_threshold,
+            "queries": slow_queries.SLOW_QUERY_LOG.top(limit),
+        }
+    )
+
+
+@APP.route("/api/manage/genetics_refresher", methods=["GET"])
+@login_required
+def get_genetics_refresher():
+    """
+    Returns the status of the genetics refresher of this worker, and of the
+    worker refreshing the genetics results, for admins.
+    """
+    if not current_user.is_admin:
+        return jsonify({"response": "Access denied"}), 403
+    return jsonify(REFRESHER.status())
+
+
 @APP.route("/", defaults={"path": ""})
 @APP.route("/<path:path>")  # catch-all to allow react routing
 def main(path):  # pylint: disable=unused-argument
@@ -1164,23 +1433,56 @@ def main(path):  # pylint: disable=unused-argument
     return APP.send_static_file("index.html")
 
 
-def reload_kinship():
-    APP.logger.debug("Calling get_kinship to refresh cache if needed")
-    for p in da.get_all_genebanks():
-        try:
-            get_kinship(p.id)
-        except requests.exceptions.ConnectionError:
-            pass
+def refresh_genetics(g_id):
+    """
+    Refreshes the genetics results of the genebank given by `g_id` that are
+    stale or missing. They are refreshed one at a time, starting with the
+    kinship matrix, so that the R-API reloads the genebank data once and the
+    other results are computed from the same data.
+    """
+    fetchers = [
+        ("kinship", fetch_kinship),
+        ("inbreeding", fetch_inbreeding),
+        ("meankinship", fetch_mean_kinship),
+    ]
+    for kind, fetch in fetchers:
+        GENETICS.refresh(kind, g_id, lambda fetch=fetch: fetch(g_id), background=False)
+
+
+REFRESHER = genetics_refresher.GeneticsRefresher(
+    APP.config["CACHE_DIR"],
+    refresh_genetics,
+    interval=settings.rapi.refresh_interval,
+)
+db.DATA_VERSION_LISTENERS.append(REFRESHER.notify)
+
+
+def flush_last_active():
+    """
+    Writes the collected user last active times to the database, and returns
+    the pooled connection of the scheduler thread.
+    """
+    try:
+        updated = db.LAST_ACTIVE.flush()
+    finally:
+        if not db.DATABASE.is_closed():
+            db.DATABASE.close()
+    APP.logger.debug("Updated last active time for %s users", updated)
 
 
 def initialize_app():
-    # Set up a background job to do reload if needed
-    # call often to minimize window
     scheduler = apscheduler.schedulers.background.BackgroundScheduler()
-    scheduler.add_job(reload_kinship, trigger="interval", seconds=15)
+    scheduler.add_job(
+        metrics.timed_job("flush_last_active", flush_last_active),
+        trigger="interval",
+        seconds=settings.service.last_active_interval,
+    )
     scheduler.start()
-    APP.logger.info("Added background job to refresh kinship cache")
-    reload_kinship()
+    atexit.register(flush_last_active)
+    # One worker refreshes the genetics results when the genebanks change
+    REFRESHER.start()
+    atexit.register(REFRESHER.stop)
+    APP.logger.info("Started genetics refresher")
     # Create loggers depending on Genbanks entry in database
     with db.DATABASE.atomic():
         for genebank in db.Genebank.select():
@@ -1201,3 +1503,5 @@ if not db.verify():
     sys.exit(1)
 
 initialize_app()
+# Requests check out their own pooled connections
+db.close_request_connection()
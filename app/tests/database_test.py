@@ -43,6 +43,7 @@ class DatabaseTest(unittest.TestCase):
         """
         Removes the sqlite3 test database file.
         """
+        db.LAST_ACTIVE.flush()
         try:
             os.stat(self.TEST_DATABASE)
             os.remove(self.TEST_DATABASE)
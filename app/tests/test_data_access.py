@@ -11,6 +11,7 @@ isort:skip_file
 
 from copy import copy
 from datetime import datetime, timedelta
+from unittest import mock
 
 from werkzeug.security import check_password_hash
 
@@ -114,6 +115,54 @@ class TestDataAccess(DatabaseTest):
         user = da.authenticate_user(email, password)
         self.assertEqual(user.email, email)
 
+    def test_api_token(self):
+        """
+        Checks that `utils.data_access.create_api_token` and
+        `utils.data_access.authenticate_token` are working as intended.
+        """
+        forbidden = {"status": "error", "message": "forbidden"}
+        self.assertEqual(da.create_api_token(self.owner.id, self.owner.uuid), forbidden)
+        self.assertEqual(da.create_api_token(self.owner.id, None), forbidden)
+        self.assertEqual(
+            da.create_api_token(12345, self.admin.uuid),
+            {"status": "error", "message": "unknown user"},
+        )
+
+        first = da.create_api_token(self.owner.id, self.admin.uuid)
+        self.assertEqual(first["status"], "created")
+        self.assertEqual(da.authenticate_token(first["data"]).id, self.owner.id)
+
+        # only a digest of the token is stored
+        self.assertFalse(
+            db.Authenticators.select()
+            .where(db.Authenticators.auth_data == first["data"])
+            .exists()
+        )
+
+        # a new token replaces the old one
+        second = da.create_api_token(self.owner.email, skip_role_check=True)
+        self.assertIsNone(da.authenticate_token(first["data"]))
+        self.assertEqual(da.authenticate_token(second["data"]).id, self.owner.id)
+
+        self.assertIsNone(da.authenticate_token(""))
+        self.assertIsNone(da.authenticate_token("pass"))
+
+    def test_authenticate_user_cached(self):
+        """
+        Checks that `utils.data_access.authenticate_user_cached` is working as
+        intended.
+        """
+        email = "test_authenticate"
+        da.register_user(email, "pass")
+        self.assertIsNone(da.authenticate_user_cached(email, "wrong"))
+        self.assertEqual(da.authenticate_user_cached(email, "pass").email, email)
+        self.assertEqual(da.authenticate_user_cached(email, "pass").email, email)
+
+        # changing the password invalidates the cached verification
+        da.register_user(email, "new")
+        self.assertIsNone(da.authenticate_user_cached(email, "pass"))
+        self.assertEqual(da.authenticate_user_cached(email, "new").email, email)
+
     def test_fetch_user_info(self):
         """
         Checks that `utils.data_access.fetch_user_info` return the correct
@@ -124,6 +173,36 @@ class TestDataAccess(DatabaseTest):
         self.assertEqual(user.email, self.admin.email)
         self.assertEqual(user.id, self.admin.id)
 
+    def test_get_active_users(self):
+        """
+        Checks that `utils.data_access.get_active_users` includes activity that
+        is not yet written to the database.
+        """
+        long_ago = datetime.now() - timedelta(days=1)
+        db.User.update(last_active=long_ago).execute()
+        self.assertEqual(da.get_active_users(15, self.admin.uuid), [])
+
+        self.owner.update_last_active()
+        self.assertEqual(db.User.get(db.User.id == self.owner.id).last_active, long_ago)
+        active = da.get_active_users(15, self.admin.uuid)
+        self.assertEqual([u["username"] for u in active], [self.owner.username])
+        self.assertEqual(active[0]["last_active"], self.owner.last_active)
+
+        # flushing writes the timestamps with a single update
+        self.assertEqual(db.LAST_ACTIVE.flush(), 1)
+        self.assertEqual(
+            db.User.get(db.User.id == self.owner.id).last_active,
+            self.owner.last_active,
+        )
+        self.assertEqual(db.LAST_ACTIVE.flush(), 0)
+        active = da.get_active_users(15, self.admin.uuid)
+        self.assertEqual([u["username"] for u in active], [self.owner.username])
+
+        self.assertEqual(
+            da.get_active_users(15, self.owner.uuid),
+            {"status": "error", "message": "Forbidden"},
+        )
+
     def test_get_colors(self):
         """
         Checks that `utils.data_access.get_colors` return the correct
@@ -248,6 +327,76 @@ class TestDataAccess(DatabaseTest):
         unknown = da.update_herd(forms["invalid"], self.admin.uuid)
         self.assertDictEqual(unknown, {"status": "error", "message": "Unknown herd"})
 
+    def test_get_pedigree(self):
+        """
+        Checks that `utils.data_access.get_pedigree` works as intended.
+        """
+        grandmother = db.Individual.create(
+            origin_herd=self.herds[0], number="G1-1711", name="Mormor"
+        )
+        # G1-1911 is the mother of individuals[0], G2-1711 the father
+        mother_breeding = self.parents[0].breeding
+        mother_breeding.father = self.parents[3]
+        mother_breeding.mother = grandmother
+        mother_breeding.save()
+        father_breeding = self.parents[1].breeding
+        father_breeding.father = self.parents[2]
+        father_breeding.save()
+        # an accessible ancestor of an inaccessible one
+        ff_breeding = self.parents[2].breeding
+        ff_breeding.mother = grandmother
+        ff_breeding.save()
+
+        self.assertEqual(da.get_pedigree(self.individuals[0].number, None), {})
+
+        pedigree = da.get_pedigree(self.individuals[0].number, self.admin.uuid)
+        self.assertEqual(
+            {key: value for key, value in pedigree.items() if key.endswith("_number")},
+            {
+                "F_number": self.parents[1].number,
+                "M_number": self.parents[0].number,
+                "FF_number": self.parents[2].number,
+                "MF_number": self.parents[3].number,
+                "MM_number": grandmother.number,
+                "F_genebank_number": "G2",
+                "M_genebank_number": "G1",
+                "FF_genebank_number": "M3",
+                "MF_genebank_number": "M3",
+                "MM_genebank_number": "G1",
+            },
+        )
+        self.assertEqual(pedigree["MM_name"], "Mormor")
+        self.assertEqual(pedigree["MM_genebank_aki"], "1711")
+        self.assertEqual(pedigree["F_birth_date"], "2017-02-01")
+        self.assertEqual(pedigree["F_id"], self.parents[1].id)
+
+        self.assertEqual(
+            set(da.get_pedigree(self.individuals[0].number, self.admin.uuid, 1)),
+            {key for key in pedigree if key[1] == "_"},
+        )
+        self.assertEqual(
+            da.get_pedigree(self.individuals[0].number, self.admin.uuid, 3)[
+                "FFM_number"
+            ],
+            grandmother.number,
+        )
+
+        # inaccessible ancestors are left out, with their ancestors
+        pedigree = da.get_pedigree(self.individuals[0].number, self.viewer.uuid, 3)
+        self.assertEqual(
+            {key.split("_")[0] for key in pedigree},
+            {"F", "M", "MM"},
+        )
+
+        # the whole pedigree is fetched with one query
+        with mock.patch.object(
+            db.DATABASE, "execute_sql", wraps=db.DATABASE.execute_sql
+        ) as execute_sql:
+            da.get_pedigree(self.individuals[0].number, self.admin.uuid, 3)
+            queries = [call[0][0] for call in execute_sql.call_args_list]
+            self.assertEqual(len([q for q in queries if "pedigree" in q]), 1)
+            self.assertEqual(len(queries), 3)  # BEGIN, user, pedigree
+
     def test_get_individual(self):
         """
         Checks that `utils.data_access.get_individual` works as intended.
@@ -260,6 +409,37 @@ class TestDataAccess(DatabaseTest):
             expected = data.as_dict()
             self.assertDictEqual(value, expected)
 
+    def test_individual_genetics(self):
+        """
+        Checks that `utils.data_access.store_genetics` replaces the stored
+        results of a genebank, and that `get_individual_genetics` reads them.
+        """
+        genebank_id = self.genebanks[0].id
+        numbers = [individual.number for individual in self.individuals]
+        self.assertIsNone(da.get_individual_genetics(numbers[0], genebank_id, "x"))
+
+        values = {numbers[0]: 0.1, numbers[1]: 0.2, "unknown": 0.3}
+        before = datetime.now()
+        self.assertEqual(da.store_genetics(genebank_id, "x", values, 3), 2)
+        value, version, computed = da.get_individual_genetics(
+            numbers[0], genebank_id, "x"
+        )
+        self.assertEqual((value, version), (0.1, 3))
+        self.assertTrue(before <= computed <= datetime.now())
+        self.assertEqual(
+            da.get_individual_genetics(numbers[2], genebank_id, "x"),
+            (None, 3, computed),
+        )
+        self.assertIsNone(da.get_individual_genetics(numbers[0], genebank_id, "y"))
+
+        self.assertEqual(da.store_genetics(genebank_id, "x", {numbers[1]: 0.5}, 4), 1)
+        self.assertEqual(
+            da.get_individual_genetics(numbers[0], genebank_id, "x")[:2], (None, 4)
+        )
+        self.assertEqual(
+            da.get_individual_genetics(numbers[1], genebank_id, "x")[:2], (0.5, 4)
+        )
+
     def test_form_to_individual(self):
         """
         Checks that `utils.data_access.form_to_individual` works as intended.
@@ -513,7 +693,6 @@ class TestDataAccess(DatabaseTest):
             self.individuals[1],
             self.individuals[3],
         ]:
-
             active = (
                 (
                     db.HerdTracking.select()
@@ -675,10 +854,12 @@ class TestDataAccess(DatabaseTest):
                 "message": "Date must be formatted as yyyy-mm-dd or yyyy-mm-ddThh:mm:ss.sssZ.",
             },
         )
+        version = db.get_data_version(self.herds[0].genebank.id)
         self.assertEqual(
             da.register_breeding(valid_form, self.admin.uuid),
             {"breeding_id": 10, "status": "success"},
         )
+        self.assertEqual(db.get_data_version(self.herds[0].genebank.id), version + 1)
         self.assertEqual(
             da.register_breeding(valid_form, self.admin.uuid),
             {"status": "error", "message": "Breeding already registered"},
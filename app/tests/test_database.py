@@ -9,12 +9,21 @@ isort:skip_file
 # pylint: disable=too-many-public-methods
 # pylint: disable=too-many-statements
 
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
 from datetime import datetime, timedelta
+from unittest import mock
 
 import utils.data_access as da
 
 # pylint: disable=import-error
 import utils.database as db
+import utils.settings as settings
+import utils.slow_queries as slow_queries
 
 # pylint: disable=import-error
 from tests.database_test import DatabaseTest
@@ -620,6 +629,103 @@ class TestDatabase(DatabaseTest):
         self.assertEqual(self.viewer.accessible_genebanks, [self.genebanks[0].id])
         self.assertEqual(self.owner.accessible_genebanks, [self.genebanks[0].id])
 
+    def test_user_role_cache(self):
+        """
+        Tests that the compiled user roles are cached, and refreshed when the
+        roles, or the genebanks and herds, change.
+        """
+        user = da.register_user("test", "pass")
+        user.add_role("owner", self.herds[0].id)
+        user.add_role("owner", self.herds[2].id)
+        self.assertEqual(user.is_owner, [self.herds[0].herd, self.herds[2].herd])
+
+        # cached roles should not need any queries
+        with mock.patch.object(
+            db.DATABASE, "execute_sql", wraps=db.DATABASE.execute_sql
+        ) as execute_sql:
+            self.assertEqual(
+                user.accessible_genebanks,
+                [self.genebanks[0].id, self.genebanks[1].id],
+            )
+            self.assertEqual(user.is_owner, [self.herds[0].herd, self.herds[2].herd])
+            self.assertEqual(execute_sql.call_count, 0)
+
+        user.remove_role("owner", self.herds[2].id)
+        self.assertEqual(user.is_owner, [self.herds[0].herd])
+        self.assertEqual(user.accessible_genebanks, [self.genebanks[0].id])
+
+        # roles changed through another instance are picked up as well
+        other = db.User.get(db.User.id == user.id)
+        other.add_role("manager", self.genebanks[1].id)
+        self.assertEqual(
+            db.User.get(db.User.id == user.id).accessible_genebanks,
+            [self.genebanks[0].id, self.genebanks[1].id],
+        )
+
+        # genebanks added by another process are picked up after a while
+        genebanks = [genebank.id for genebank in self.genebanks]
+        self.assertEqual(self.admin.accessible_genebanks, genebanks)
+        genebank = db.Genebank.create(name="Other")
+        self.assertEqual(self.admin.accessible_genebanks, genebanks)
+        with mock.patch.object(db, "ROLE_GENERATION_TTL", 0):
+            self.assertEqual(self.admin.accessible_genebanks, genebanks + [genebank.id])
+
+    def test_user_can_edit(self):
+        """
+        Tests the database.User.can_edit and database.User.can_edit_many
+        functions.
+        """
+        # individuals without herd tracking use their origin herd
+        untracked = db.Individual.create(origin_herd=self.herds[0], number="G1-2113")
+        identifiers = [
+            self.individuals[0].id,
+            self.individuals[2].number,
+            self.individuals[3].number,
+            self.individuals[4].id,
+            untracked.number,
+            self.herds[0].herd,
+            self.herds[2].herd,
+            self.genebanks[0].name,
+            self.genebanks[1].name,
+            "G9-9999",
+            "G9",
+            "Unknown",
+            None,
+        ]
+
+        self.assertEqual(set(self.admin.can_edit_many(identifiers).values()), {True})
+        self.assertEqual(set(self.viewer.can_edit_many(identifiers).values()), {False})
+
+        expected = {
+            self.individuals[0].id: True,
+            self.individuals[2].number: False,  # moved to herds[2]
+            self.individuals[3].number: True,
+            self.individuals[4].id: False,
+            untracked.number: True,
+            self.herds[0].herd: True,
+            self.herds[2].herd: False,
+            self.genebanks[0].name: False,
+            self.genebanks[1].name: False,
+            "G9-9999": False,
+            "G9": False,
+            "Unknown": False,
+            None: False,
+        }
+        self.assertDictEqual(self.owner.can_edit_many(identifiers), expected)
+        for identifier, allowed in expected.items():
+            self.assertEqual(self.owner.can_edit(identifier), allowed)
+
+        expected[self.genebanks[0].name] = True
+        self.assertDictEqual(self.manager.can_edit_many(identifiers), expected)
+
+        # the number of queries doesn't depend on the number of identifiers
+        self.manager.roles  # pylint: disable=pointless-statement
+        with mock.patch.object(
+            db.DATABASE, "execute_sql", wraps=db.DATABASE.execute_sql
+        ) as execute_sql:
+            self.manager.can_edit_many(identifiers)
+            self.assertEqual(execute_sql.call_count, 3)
+
     def test_user_frontend_data(self):
         """
         Tests the database.User.frontend_data function.
@@ -780,6 +886,215 @@ class TestDatabase(DatabaseTest):
         """
         self.assertTrue(db.HerdTracking.table_exists())
 
+    def test_connection_pool(self):
+        """
+        Checks that pooled connections are reused, and that the pool records
+        checkouts and timeouts.
+        """
+        self.assertIsNone(db.pool_stats())
+        db.set_test_database(self.TEST_DATABASE, max_connections=1)
+        try:
+            for _ in range(2):
+                db.open_request_connection()
+                self.assertEqual(db.Herd.select().count(), len(self.herds))
+                self.assertEqual(db.pool_stats()["in_use"], 1)
+                db.close_request_connection()
+            stats = db.pool_stats()
+            self.assertEqual((stats["in_use"], stats["idle"]), (0, 1))
+            self.assertEqual(stats["checkouts"], 2)
+
+            # a second thread can't get a connection while one is checked out
+            db.open_request_connection()
+            errors = []
+
+            def other_request():
+                try:
+                    db.open_request_connection()
+                except db.MaxConnectionsExceeded as ex:
+                    errors.append(ex)
+
+            thread = threading.Thread(target=other_request)
+            thread.start()
+            thread.join()
+            db.close_request_connection()
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(db.pool_stats()["timeouts"], 1)
+            self.assertGreater(db.pool_stats()["max_wait_time"], 0)
+        finally:
+            db.DATABASE.close_all()
+            db.set_test_database(self.TEST_DATABASE)
+
+    def test_read_replica(self):
+        """
+        Checks that read only data access goes to the replica, unless the
+        thread has written, the session is pinned, or a transaction is open,
+        that it can't write, and that privileges are read from the primary.
+        """
+        replica = self.TEST_DATABASE + ".replica"
+        shutil.copy(self.TEST_DATABASE, replica)
+        db.set_test_database(self.TEST_DATABASE, replica=replica)
+        try:
+            db.start_request()
+            colors = da.get_colors()
+            self.assertFalse(db.request_wrote())
+
+            db.Color.create(name="nyhet", genebank=self.genebanks[0])
+            self.assertTrue(db.request_wrote())
+            updated = da.get_colors()
+            self.assertNotEqual(updated, colors)
+
+            # a new request reads the replica, unless its session is pinned
+            db.start_request()
+            self.assertEqual(da.get_colors(), colors)
+            db.start_request(pinned=True)
+            self.assertEqual(da.get_colors(), updated)
+
+            db.start_request()
+            with db.DATABASE.atomic():
+                self.assertEqual(da.get_colors(), updated)
+
+            # read only functions can't write, and raw writes are recorded
+            db.start_request()
+            write = db.read_only(
+                lambda: db.Color.update(name="x").where(db.Color.id == 0).execute()
+            )
+            with self.assertRaises(db.ReplicaWriteError):
+                write()
+            with self.assertRaises(db.ReplicaWriteError):
+                db.read_only(lambda: db.DB_PROXY.execute_sql("DELETE FROM color"))()
+            self.assertFalse(db.request_wrote())
+            db.DB_PROXY.execute_sql("SELECT 1")
+            self.assertFalse(db.request_wrote())
+            db.DB_PROXY.execute_sql("UPDATE color SET name = name WHERE 0")
+            self.assertTrue(db.request_wrote())
+
+            # privileges are read from the primary, also in read only functions
+            db.start_request()
+            self.assertIsNotNone(da.get_herd(self.herds[0].herd, self.manager.uuid))
+            db.User.update(privileges="[]").where(
+                db.User.id == self.manager.id
+            ).execute()
+            db.start_request()
+            self.assertIsNone(da.get_herd(self.herds[0].herd, self.manager.uuid))
+        finally:
+            db.set_test_database(self.TEST_DATABASE)
+            os.remove(replica)
+
+    def test_slow_query_log(self):
+        """
+        Checks that slow queries are aggregated by normalised SQL, logged with
+        their caller, redacted parameters and plan, and rate limited.
+        """
+        slow_queries.SLOW_QUERY_LOG.clear()
+        with mock.patch.object(
+            settings.postgres, "slow_query_threshold", 1e-9
+        ), mock.patch.object(
+            settings.postgres, "slow_query_log_rate", 2
+        ), self.assertLogs(
+            "herdbook.slow_queries", level="WARNING"
+        ) as logs:
+            db.User.select().where(db.User.email == "secret@example.com").execute()
+            da.get_colors()
+            db.User.select().where(db.User.email == "other@example.com").execute()
+            db.User.select().where(db.User.id.in_([1, 2, 3])).execute()
+            db.User.select().where(db.User.id.in_([4])).execute()
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("<str:18>", logs.output[0])
+        self.assertNotIn("secret@example.com", logs.output[0])
+        self.assertIn("plan: SCAN t1", logs.output[0])
+        self.assertIn("utils.data_access.get_colors", logs.output[1])
+
+        top = slow_queries.SLOW_QUERY_LOG.top()
+        statements = {entry["sql"]: entry for entry in top}
+        email = [sql for sql in statements if '"email" = ?' in sql]
+        self.assertEqual(len(email), 1)
+        self.assertEqual(statements[email[0]]["count"], 2)
+        in_list = [sql for sql in statements if "IN (...)" in sql]
+        self.assertEqual(len(in_list), 1)
+        self.assertEqual(statements[in_list[0]]["count"], 2)
+        self.assertIsNotNone(statements[email[0]]["plan"])
+        self.assertEqual(
+            [entry["total_time"] for entry in top],
+            sorted([entry["total_time"] for entry in top], reverse=True),
+        )
+
+        self.assertEqual(
+            slow_queries.normalise("SELECT  * FROM t WHERE a = 'x' AND b IN (?, ?)"),
+            "SELECT * FROM t WHERE a = ? AND b IN (...)",
+        )
+        slow_queries.SLOW_QUERY_LOG.clear()
+
+    def test_insert_data(self):
+        """
+        Checks that data files are upserted, with the foreign keys between
+        breedings and individuals set whichever comes first, and that loading
+        a file again doesn't duplicate rows.
+        """
+        herd = self.herds[0].id
+        data = {
+            "Genebank": [{"id": self.genebanks[0].id, "name": "Gotland"}],
+            "Breeding": [
+                {
+                    "id": 1001,
+                    "breeding_herd_id": herd,
+                    "father": 1002,
+                    "mother": 1003,
+                    "birth_date": "2022-01-01",
+                }
+            ],
+            "Individual": [
+                {"id": 1001, "origin_herd": herd, "number": "G1-901", "breeding": 1001},
+                {"id": 1002, "origin_herd": herd, "number": "G1-902", "sex": "male"},
+                {"id": 1003, "origin_herd": herd, "number": "G1-903", "sex": "female"},
+            ],
+            "Unknown": [{"a": [1, {"b": "]"}]}],
+            "Color": [{"name": "Ny färg", "genebank": self.genebanks[0].id}],
+        }
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as infile:
+            json.dump(data, infile, indent=2, ensure_ascii=False)
+        try:
+            for _ in range(2):
+                with self.assertLogs("herdbook.db", level="ERROR"):
+                    loaded = db.insert_data(infile.name, chunk_size=2)
+                self.assertEqual(
+                    loaded, {"Genebank": 1, "Breeding": 1, "Individual": 3, "Color": 1}
+                )
+
+            data["Individual"][1]["sex"] = "female"
+            data["Breeding"][0]["father"] = None
+            with open(infile.name, "w", encoding="utf-8") as outfile:
+                json.dump(data, outfile)
+            db.insert_data(infile.name)
+        finally:
+            os.remove(infile.name)
+
+        self.assertEqual(db.Individual.get_by_id(1001).breeding_id, 1001)
+        self.assertEqual(db.Individual.get_by_id(1002).sex, "female")
+        breeding = db.Breeding.get_by_id(1001)
+        self.assertIsNone(breeding.father_id)
+        self.assertEqual(breeding.mother_id, 1003)
+        self.assertEqual(db.Color.select().where(db.Color.name == "Ny färg").count(), 1)
+
+    def test_json_stream(self):
+        """
+        Checks that tables are read one row at a time across buffer refills,
+        also when their rows aren't read.
+        """
+        text = '{"A": [{"x": "a, b ]}"}, {"x": [1, 2]}], "B": [],\n "C": [{}, {}]}'
+        stream = db.JsonStream(io.StringIO(text), read_size=3)
+        tables = {}
+        for table, rows in stream.tables():
+            tables[table] = list(rows) if table != "B" else None
+        self.assertEqual(
+            tables,
+            {"A": [{"x": "a, b ]}"}, {"x": [1, 2]}], "B": None, "C": [{}, {}]},
+        )
+
+        stream = db.JsonStream(io.StringIO('{"A": [{}] "B": []}'))
+        with self.assertRaises(ValueError):
+            list(stream.tables())
+        self.assertEqual(list(db.JsonStream(io.StringIO(" {} ")).tables()), [])
+
 
 # pylint: disable=too-few-public-methods
 class TestDatabaseMigration(DatabaseTest):
@@ -822,6 +1137,24 @@ class TestDatabaseMigration(DatabaseTest):
             db.CURRENT_SCHEMA_VERSION,
         )
 
+    def test_index_migration(self):
+        """
+        Checks that the index migration adds the indexes that are missing.
+        """
+        db.DATABASE.execute_sql("DROP INDEX user_uuid")
+        db.DATABASE.execute_sql(
+            "DROP INDEX herdtracking_individual_id_herd_tracking_date"
+        )
+        db.SchemaHistory.delete().where(db.SchemaHistory.version >= 13).execute()
+
+        db.check_migrations()
+        indexes = {
+            table: [index.columns for index in db.DATABASE.get_indexes(table)]
+            for table in ["hbuser", "herd_tracking"]
+        }
+        self.assertIn(["uuid"], indexes["hbuser"])
+        self.assertIn(["individual_id", "herd_tracking_date"], indexes["herd_tracking"])
+
     def test_migration_replays(self):
         """
         Run migrations sereral times to verify that all migrations work even
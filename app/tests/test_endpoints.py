@@ -11,10 +11,20 @@ isort:skip_file
 # pylint: disable=wrong-import-position
 
 import base64
+import hashlib
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
 
+import botocore
+import fitz
 import flask
 import requests
 
@@ -24,8 +34,21 @@ os.environ.setdefault(
 )
 
 # pylint: disable=import-error
+import utils.cert_acess as cert_acess  # noqa: E402
+import utils.cert_jobs as cert_jobs  # noqa: E402
+import utils.certificates as certs  # noqa: E402
+import utils.data_access as da  # noqa: E402
+import utils.genetics_cache as genetics_cache  # noqa: E402
 import utils.database as db  # noqa: E402
+import herdbook  # noqa: E402
+import utils.instrumentation as instrumentation  # noqa: E402
+import utils.metrics as metrics  # noqa: E402
+import utils.rapi as rapi  # noqa: E402
+import utils.s3 as s3  # noqa: E402
+import utils.settings as settings  # noqa: E402
+import utils.slow_queries as slow_queries  # noqa: E402
 from herdbook import APP  # noqa: E402
+from cachelib import SimpleCache  # noqa: E402
 from moto import mock_s3  # noqa: E402
 from tests.database_test import DatabaseTest  # noqa: E402
 
@@ -48,8 +71,22 @@ class FlaskTest(DatabaseTest):
         APP.config["SESSION_COOKIE_NAME"] = "test"
         APP.static_folder = "../frontend/"
         self.app = APP.test_client()
+        # S3 is mocked per test, so the client can't be shared between tests
+        self.s3_cache_dir = settings.s3.cache_dir
+        settings.s3.cache_dir = tempfile.mkdtemp()
+        s3.reset_s3_client()
+        # Genetics are refreshed by the tests themselves, not in the background
+        herdbook.REFRESHER.stop()
         super().setUp()
 
+    def tearDown(self):
+        """
+        Removes the S3 object cache of the test.
+        """
+        shutil.rmtree(settings.s3.cache_dir, ignore_errors=True)
+        settings.s3.cache_dir = self.s3_cache_dir
+        super().tearDown()
+
 
 class TestEndpoints(FlaskTest):
     """
@@ -257,6 +294,489 @@ class TestEndpoints(FlaskTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json(), expected_breedings)
 
+    def test_request_loader_token(self):
+        """
+        Checks that `herdbook.load_user_from_request` accepts API tokens, and
+        that header authentication doesn't create sessions.
+        """
+        herd = self.herds[0].herd
+        token = da.create_api_token(self.admin.id, skip_role_check=True)["data"]
+
+        with self.app as context:
+            response = context.get(
+                "/api/breeding/%s" % herd,
+                headers=[("Authorization", "Bearer " + token)],
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                len(response.get_json()["breedings"]),
+                db.Breeding.select()
+                .where(db.Breeding.breeding_herd_id == self.herds[0])
+                .count(),
+            )
+            self.assertNotIn("user_id", flask.session)
+
+        self.assertEqual(
+            self.app.get(
+                "/api/breeding/%s" % herd,
+                headers=[("Authorization", "Bearer not-a-token")],
+            ).get_json(),
+            None,
+        )
+
+        # revoked tokens can't be used
+        self.assertEqual(
+            da.revoke_api_token(self.admin.id, self.admin.uuid), {"status": "updated"}
+        )
+        self.assertEqual(
+            self.app.get(
+                "/api/breeding/%s" % herd,
+                headers=[("Authorization", "Bearer " + token)],
+            ).get_json(),
+            None,
+        )
+
+    def test_request_connection(self):
+        """
+        Checks that requests check out a pooled connection, and return it when
+        the request is done.
+        """
+        db.set_test_database(self.TEST_DATABASE, max_connections=2)
+        try:
+            with self.app as context:
+                context.post(
+                    "/api/login",
+                    json={"username": self.admin.email, "password": "pass"},
+                )
+                response = context.get(f"/api/breeding/{self.herds[0].herd}")
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(db.pool_stats()["in_use"], 0)
+            self.assertGreaterEqual(db.pool_stats()["checkouts"], 2)
+        finally:
+            db.DATABASE.close_all()
+            db.set_test_database(self.TEST_DATABASE)
+
+    def test_replica_session(self):
+        """
+        Checks that sessions and users read their own writes from the primary
+        database, and use the read replica otherwise.
+        """
+        replica = self.TEST_DATABASE + ".replica"
+        shutil.copy(self.TEST_DATABASE, replica)
+        db.set_test_database(self.TEST_DATABASE, replica=replica)
+        try:
+            with self.app as context:
+                context.post(
+                    "/api/login",
+                    json={"username": self.admin.email, "password": "pass"},
+                )
+                response = context.post(
+                    "/api/manage/herd",
+                    json={"genebank": self.genebanks[0].id, "herd": "N001"},
+                )
+                self.assertEqual(response.get_json(), {"status": "success"})
+                self.assertEqual(
+                    context.get("/api/herd/N001").get_json()["herd"], "N001"
+                )
+
+                with context.session_transaction() as sess:
+                    sess["db_primary_until"] = 0
+                herdbook.CACHE.delete(f"db-primary-{self.admin.uuid}")
+                self.assertIsNone(context.get("/api/herd/N001").get_json())
+
+            # Clients without sessions are pinned per user
+            auth = {
+                "Authorization": "Basic "
+                + base64.b64encode(f"{self.admin.email}:pass".encode()).decode()
+            }
+            response = APP.test_client().post(
+                "/api/manage/herd",
+                json={"genebank": self.genebanks[0].id, "herd": "N002"},
+                headers=auth,
+            )
+            self.assertEqual(response.get_json(), {"status": "success"})
+            response = APP.test_client().get("/api/herd/N002", headers=auth)
+            self.assertEqual(response.get_json()["herd"], "N002")
+            herdbook.CACHE.delete(f"db-primary-{self.admin.uuid}")
+            self.assertIsNone(
+                APP.test_client().get("/api/herd/N002", headers=auth).get_json()
+            )
+        finally:
+            db.set_test_database(self.TEST_DATABASE)
+            os.remove(replica)
+
+    def test_request_instrumentation(self):
+        """
+        Checks that the queries and S3 calls of a request are counted, and
+        shown as response headers in debug mode only.
+        """
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            response = context.get(f"/api/breeding/{self.herds[0].herd}")
+            self.assertNotIn("X-Query-Count", response.headers)
+
+            APP.config["DEBUG"] = True
+            try:
+                response = context.get(f"/api/breeding/{self.herds[0].herd}")
+            finally:
+                APP.config["DEBUG"] = False
+            self.assertGreater(int(response.headers["X-Query-Count"]), 0)
+            self.assertGreaterEqual(
+                float(response.headers["X-Query-Time"]),
+                float(response.headers["X-Query-Max-Time"]),
+            )
+            self.assertEqual(response.headers["X-RAPI-Calls"], "0")
+            self.assertEqual(response.headers["X-S3-Calls"], "0")
+
+        s3_mock = mock_s3()
+        s3_mock.start()
+        client = s3.get_s3_client()
+        instrumentation.start_request()
+        client.put_object("G1-1/certificate.pdf", b"data")
+        client.head_object("G1-1/certificate.pdf")
+        da.get_colors()
+        stats = instrumentation.end_request()
+        s3_mock.stop()
+        self.assertEqual(stats.calls["s3"][0], 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertIsNone(instrumentation.current())
+
+    def test_metrics(self):
+        """
+        Checks that the metrics are only shown to admins, also for requests
+        from loopback, which is where nginx forwards all requests from, and
+        that requests, queries, R-API calls, genetics cache lookups and jobs
+        are recorded.
+        """
+        local = {"REMOTE_ADDR": "127.0.0.1"}
+        with self.app as context:
+            response = context.get("/api/metrics", environ_base=local)
+            self.assertNotEqual(response.status_code, 200)
+
+            context.post(
+                "/api/login", json={"username": self.owner.email, "password": "pass"}
+            )
+            response = context.get("/api/metrics", environ_base=local)
+            self.assertEqual(response.status_code, 403)
+            context.get("/api/logout")
+
+        with mock.patch.object(
+            herdbook.RAPI.session, "request"
+        ) as session_request, mock.patch.object(
+            herdbook.RAPI, "breaker", rapi.CircuitBreaker(2, 30)
+        ):
+            session_request.return_value.status_code = 500
+            self.assertEqual(herdbook.fetch_mean_kinship("1"), {})
+            update = {"update_from_db": "TRUE"}
+            self.assertEqual(session_request.call_args[1]["params"], update)
+            session_request.side_effect = requests.exceptions.ConnectionError()
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                herdbook.fetch_inbreeding("1")
+            self.assertEqual(session_request.call_args[1]["params"], update)
+            with self.assertRaises(rapi.CircuitOpen):
+                herdbook.fetch_kinship("1")
+
+        lock_dir = tempfile.mkdtemp()
+        genetics = genetics_cache.GeneticsCache(SimpleCache(), lock_dir, 300)
+        for _ in range(2):
+            genetics.get("kinship", self.genebanks[0].id, lambda: {"G1-1": {}})
+        shutil.rmtree(lock_dir)
+        metrics.timed_job("test_job", lambda: None)()
+        with self.assertRaises(TypeError):
+            metrics.Metric("herdbook_abstract", "Metric without a type")
+
+        # Metrics recorded in threads that have finished are kept
+        thread = threading.Thread(target=metrics.DB_QUERY_DURATION.observe, args=[1])
+        thread.start()
+        thread.join()
+
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            context.get(f"/api/breeding/{self.herds[0].herd}")
+            response = context.get("/api/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        text = response.get_data(as_text=True)
+        for line in [
+            "# TYPE herdbook_request_duration_seconds histogram",
+            'herdbook_request_duration_seconds_bucket{method="GET",'
+            'endpoint="herd_breeding_list",le="+Inf"}',
+            'herdbook_requests_total{method="GET",endpoint="get_metrics",status="403"}',
+            'herdbook_db_queries_total{endpoint="herd_breeding_list"}',
+            'herdbook_db_query_duration_seconds_bucket{le="1.0"}',
+            'herdbook_rapi_request_duration_seconds_count{call="meankinship"}',
+            'herdbook_rapi_errors_total{call="meankinship"}',
+            'herdbook_rapi_errors_total{call="inbreeding"}',
+            'herdbook_rapi_circuit_total{event="reject"}',
+            'herdbook_genetics_cache_total{kind="kinship",result="hit"}',
+            'herdbook_job_duration_seconds_count{job="test_job"}',
+        ]:
+            self.assertIn(line, text)
+
+        samples = dict(
+            line.rsplit(" ", 1) for line in text.splitlines() if line[0] != "#"
+        )
+        self.assertGreaterEqual(
+            float(samples['herdbook_db_query_duration_seconds_bucket{le="1.0"}']), 1
+        )
+        self.assertEqual(
+            samples['herdbook_db_query_duration_seconds_bucket{le="+Inf"}'],
+            samples["herdbook_db_query_duration_seconds_count"],
+        )
+
+    def test_individual_genetics(self):
+        """
+        Checks that the individual endpoint reads the genetics results stored
+        per individual, refreshes them when the genebank has changed or they
+        are too old, and fetches them concurrently, falling back to stale
+        results, when none are stored.
+        """
+        individual = self.individuals[0]
+        genebank_id = individual.current_herd.genebank.id
+        version = db.get_data_version(genebank_id)
+        da.store_genetics(genebank_id, "inbreeding", {individual.number: 0.1}, version)
+        da.store_genetics(
+            genebank_id, "meankinship", {individual.number: 0.25}, version
+        )
+
+        with mock.patch.object(
+            herdbook.RAPI.session, "request"
+        ) as session_request, mock.patch.object(
+            herdbook.GENETICS, "refresh"
+        ) as refresh, self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("10.00", "25.00"))
+            self.assertFalse(data["genetics_stale"])
+            refresh.assert_not_called()
+
+            # Results older than the lifetime are stale too
+            db.IndividualGenetics.update(
+                computed=datetime.now() - timedelta(seconds=herdbook.GENETICS_LIFETIME)
+            ).where(db.IndividualGenetics.kind == "inbreeding").execute()
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("10.00", "25.00"))
+            self.assertTrue(data["genetics_stale"])
+            self.assertEqual(refresh.call_count, 1)
+
+            db.bump_data_version(individual.origin_herd.id)
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("10.00", "25.00"))
+            self.assertTrue(data["genetics_stale"])
+            self.assertEqual(refresh.call_count, 3)
+
+            # Individuals without results of their own get 0
+            data = context.get(
+                f"/api/individual/{self.individuals[1].number}"
+            ).get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("0.00", "0.00"))
+        session_request.assert_not_called()
+
+        # Without stored results, both are fetched from the R-API
+        version = db.get_data_version(genebank_id)
+        da.store_genetics(genebank_id, "inbreeding", {}, version)
+        da.store_genetics(genebank_id, "meankinship", {}, version)
+        fetched = {
+            "inbreeding": {individual.number: 0.2},
+            "meankinship": {individual.number: 0.5},
+        }
+        with mock.patch.object(
+            herdbook.GENETICS,
+            "lookup",
+            side_effect=lambda kind, *_: (fetched[kind], False),
+        ) as lookup, self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("20.00", "50.00"))
+            self.assertFalse(data["genetics_stale"])
+            self.assertEqual(lookup.call_count, 2)
+
+            # Stale cached results are shown as stale
+            lookup.side_effect = lambda kind, *_: (fetched[kind], kind == "inbreeding")
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("20.00", "50.00"))
+            self.assertTrue(data["genetics_stale"])
+
+            # The mean kinship can't be fetched, but the inbreeding can
+            lookup.side_effect = lambda kind, *_: (
+                (fetched[kind], False)
+                if kind == "inbreeding"
+                else herdbook.RAPI.get(kind, "/")
+            )
+            with mock.patch.object(
+                herdbook.RAPI, "breaker", rapi.CircuitBreaker(1, 30)
+            ) as breaker:
+                breaker.record_failure()
+                data = context.get(f"/api/individual/{individual.number}").get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("20.00", None))
+            self.assertTrue(data["genetics_stale"])
+
+            # A hung R-API times out, and is handled the same way
+            with mock.patch.object(
+                herdbook.RAPI.session,
+                "request",
+                side_effect=requests.exceptions.ReadTimeout(),
+            ), mock.patch.object(herdbook.RAPI, "breaker", rapi.CircuitBreaker(5, 30)):
+                response = context.get(f"/api/individual/{individual.number}")
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            self.assertEqual((data["inbreeding"], data["MK"]), ("20.00", None))
+            self.assertTrue(data["genetics_stale"])
+
+        # A failing R-API gives no results, rather than 0
+        lock_dir = tempfile.mkdtemp()
+        genetics = genetics_cache.GeneticsCache(SimpleCache(), lock_dir, 300)
+        with mock.patch.object(
+            herdbook.RAPI.session, "request"
+        ) as session_request, mock.patch.object(
+            herdbook.RAPI, "breaker", rapi.CircuitBreaker(5, 30)
+        ), mock.patch.object(
+            herdbook, "GENETICS", genetics
+        ), self.app as context:
+            session_request.return_value.status_code = 500
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            data = context.get(f"/api/individual/{individual.number}").get_json()
+        self.assertEqual((data["inbreeding"], data["MK"]), (None, None))
+        self.assertTrue(data["genetics_stale"])
+        self.assertEqual(session_request.call_count, 2)
+        shutil.rmtree(lock_dir)
+
+    def test_slow_queries(self):
+        """
+        Checks that the slow queries are listed for admins only.
+        """
+        slow_queries.SLOW_QUERY_LOG.clear()
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.owner.email, "password": "pass"}
+            )
+            response = context.get("/api/manage/slow_queries")
+            self.assertEqual(response.status_code, 403)
+            context.get("/api/logout")
+
+        with mock.patch.object(settings.postgres, "slow_query_threshold", 1e-9):
+            with self.app as context:
+                context.post(
+                    "/api/login",
+                    json={"username": self.admin.email, "password": "pass"},
+                )
+                context.get(f"/api/breeding/{self.herds[0].herd}")
+                response = context.get("/api/manage/slow_queries?limit=3")
+        self.assertEqual(response.status_code, 200)
+        queries = response.get_json()["queries"]
+        self.assertEqual(len(queries), 3)
+        self.assertGreaterEqual(queries[0]["total_time"], queries[1]["total_time"])
+        for key in ["sql", "count", "mean_time", "max_time", "callers"]:
+            self.assertIn(key, queries[0])
+        slow_queries.SLOW_QUERY_LOG.clear()
+
+    def test_genetics_refresher(self):
+        """
+        Checks that the genetics refresher status is shown to admins only.
+        """
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.owner.email, "password": "pass"}
+            )
+            response = context.get("/api/manage/genetics_refresher")
+            self.assertEqual(response.status_code, 403)
+            context.get("/api/logout")
+
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            response = context.get("/api/manage/genetics_refresher")
+        self.assertEqual(response.status_code, 200)
+        status = response.get_json()
+        self.assertEqual(status["pid"], os.getpid())
+        self.assertFalse(status["running"])
+        self.assertFalse(status["is_leader"])
+        self.assertEqual(status["interval"], settings.rapi.refresh_interval)
+
+        # The results of a genebank are refreshed in order, kinship first
+        calls = []
+        genetics = genetics_cache.GeneticsCache(SimpleCache(), tempfile.mkdtemp(), 300)
+        fetchers = {
+            name: mock.Mock(side_effect=lambda _, name=name: calls.append(name))
+            for name in ["fetch_kinship", "fetch_inbreeding", "fetch_mean_kinship"]
+        }
+        with mock.patch.multiple(herdbook, GENETICS=genetics, **fetchers):
+            herdbook.refresh_genetics(self.genebanks[0].id)
+            self.assertEqual(
+                calls, ["fetch_kinship", "fetch_inbreeding", "fetch_mean_kinship"]
+            )
+            self.assertEqual(genetics.refreshing, set())
+        shutil.rmtree(genetics.lock_dir)
+
+    def test_background_connections(self):
+        """
+        Checks that background jobs return their pooled connections.
+        """
+        db.set_test_database(self.TEST_DATABASE, max_connections=2)
+        try:
+            db.LAST_ACTIVE.touch(self.admin.id)
+            job = cert_jobs.CertificateJob([{"number": "G9-9999"}], self.admin.uuid)
+            for target in [herdbook.flush_last_active, job.run]:
+                thread = threading.Thread(target=target)
+                thread.start()
+                thread.join()
+            self.assertEqual(job.status, "done")
+            self.assertEqual(db.pool_stats()["checkouts"], 2)
+            self.assertEqual(db.pool_stats()["in_use"], 0)
+        finally:
+            # sqlite connections can only be closed by the thread that opened
+            # them, so the pool is dropped as it is
+            db.set_test_database(self.TEST_DATABASE)
+
+    def test_request_loader_cache(self):
+        """
+        Checks that successful basic auth verifications are cached, and that no
+        session is created.
+        """
+        herd = self.herds[0].herd
+        auth_head = base64.encodebytes(
+            bytes(self.admin.email, "utf-8") + b":pass"
+        ).strip()
+
+        with mock.patch(
+            "utils.data_access.check_password_hash",
+            wraps=da.check_password_hash,
+        ) as check_password_hash:
+            for _ in range(3):
+                with self.app as context:
+                    response = context.get(
+                        "/api/breeding/%s" % herd,
+                        headers=[("Authorization", b"Basic " + auth_head)],
+                    )
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotIn("user_id", flask.session)
+            self.assertEqual(check_password_hash.call_count, 1)
+
+            # a wrong password is checked every time
+            wrong_head = base64.encodebytes(
+                bytes(self.admin.email, "utf-8") + b":wrong"
+            ).strip()
+            for _ in range(2):
+                self.assertEqual(
+                    self.app.get(
+                        "/api/breeding/%s" % herd,
+                        headers=[("Authorization", b"Basic " + wrong_head)],
+                    ).get_json(),
+                    None,
+                )
+            self.assertEqual(check_password_hash.call_count, 3)
+
     def test_register_breeding(self):
         """
         Checks that `herdbook.register_breeding` works as intended.
@@ -565,6 +1085,457 @@ class TestEndpoints(FlaskTest):
             self.assertEqual(response.get_json(), {"response": "Certificate is valid"})
             mock.stop()
 
+    def test_certificate_bulk_issue(self):
+        """
+        Checks that certificates can be issued in bulk through a job, and that
+        the job status reports per individual results.
+        """
+        individual = self.individuals[3].number
+        individual_2 = self.individuals[4].number
+        individual_3 = self.individuals[2].number
+        issue_form = {
+            "color_id": 3,
+            "birth_date": (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d"),
+            "litter_size": 5,
+            "litter_size6w": 4,
+        }
+
+        mock = mock_s3()
+        mock.start()
+
+        # not logged in
+        self.assertEqual(
+            self.app.post(
+                "/api/certificates/issue", json={"individuals": [individual]}
+            ).get_json(),
+            None,
+        )
+
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            self.assertEqual(
+                context.post("/api/certificates/issue", json={}).status_code, 400
+            )
+            self.assertEqual(
+                context.post(
+                    "/api/certificates/issue", json={"individuals": [{"id": 1}]}
+                ).status_code,
+                400,
+            )
+
+            response = context.post(
+                "/api/certificates/issue",
+                json={
+                    "individuals": [
+                        {"number": individual, **issue_form},
+                        {"number": individual_2, **issue_form},
+                        # issued with the data it already has
+                        individual_3,
+                        # already has a paper certificate
+                        self.individuals[0].number,
+                        "G9-9999",
+                    ]
+                },
+            )
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()["id"]
+
+            for _ in range(600):
+                status = context.get(f"/api/certificates/jobs/{job_id}").get_json()
+                if status["status"] not in ["queued", "running"]:
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual(status["status"], "done")
+            # The workers aren't started with sys.executable, which is uwsgi in
+            # production
+            self.assertEqual(
+                os.fsdecode(multiprocessing.spawn.get_executable()),
+                settings.service.python,
+            )
+            self.assertEqual(status["total"], 5)
+            self.assertEqual(status["issued"], 3)
+            self.assertEqual(status["failed"], 2)
+            self.assertEqual(
+                status["results"][self.individuals[0].number],
+                {"status": "error", "message": "Certificate already exists"},
+            )
+            self.assertEqual(
+                status["results"]["G9-9999"],
+                {"status": "error", "message": "Individual not found"},
+            )
+
+            certificates = set()
+            for number in [individual, individual_2, individual_3]:
+                cert_number = db.Individual.get(
+                    db.Individual.number == number
+                ).digital_certificate
+                certificates.add(cert_number)
+                self.assertEqual(
+                    status["results"][number],
+                    {"status": "issued", "certificate": cert_number},
+                )
+                response = context.post(
+                    f"/api/certificates/verify/{number}",
+                    data=context.get(f"/api/certificates/issue/{number}").data,
+                )
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(certificates), 3)
+
+            self.assertEqual(
+                context.get("/api/certificates/jobs/unknown").status_code, 404
+            )
+
+        # other users can't see the job
+        with self.app as context:
+            context.get("/api/logout")
+            context.post(
+                "/api/login", json={"username": self.owner.email, "password": "pass"}
+            )
+            self.assertEqual(
+                context.get(f"/api/certificates/jobs/{job_id}").status_code, 404
+            )
+        mock.stop()
+
+    def test_certificate_checksums(self):
+        """
+        Checks that certificate checksums are recorded on upload, that
+        verification doesn't download the stored certificate, and that
+        checksums can be backfilled.
+        """
+        individual = self.individuals[3]
+        issue_form = {
+            "color_id": 3,
+            "birth_date": datetime.now() - timedelta(days=30),
+            "litter_size": 5,
+            "litter_size6w": 4,
+        }
+
+        s3_mock = mock_s3()
+        s3_mock.start()
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            pdf_data = context.post(
+                f"/api/certificates/issue/{individual.number}", json=issue_form
+            ).data
+
+            stored = db.CertificateChecksum.get(
+                db.CertificateChecksum.individual == individual.id
+            )
+            self.assertEqual(stored.checksum, hashlib.sha256(pdf_data).hexdigest())
+            self.assertEqual(stored.size, len(pdf_data))
+
+            with mock.patch.object(
+                s3.S3Handler, "get_object", side_effect=AssertionError
+            ) as get_object:
+                response = context.post(
+                    f"/api/certificates/verify/{individual.number}", data=pdf_data
+                )
+                self.assertEqual(response.status_code, 200)
+                get_object.assert_not_called()
+
+        # Certificates uploaded before checksums were recorded
+        stored.delete_instance()
+        missing = db.Individual.get(self.individuals[4].id)
+        missing.digital_certificate = 100100
+        missing.save()
+        self.assertEqual(
+            cert_acess.backfill_certificate_checksums(),
+            {"status": "success", "recorded": 1, "missing": [missing.number]},
+        )
+        self.assertEqual(
+            da.get_certificate_checksum(individual.number),
+            hashlib.sha256(pdf_data).hexdigest(),
+        )
+        self.assertEqual(da.get_unchecksummed_certificates(), [missing.number])
+        s3_mock.stop()
+
+    def test_certificate_template(self):
+        """
+        Checks that the certificate template is read once, and that rendering
+        it doesn't carry data over between certificates.
+        """
+
+        def field_values(pdf_bytes):
+            file_handle = fitz.open(stream=pdf_bytes.getvalue(), filetype="pdf")
+            return {
+                widget.field_name: widget.field_value
+                for page in file_handle
+                for widget in page.widgets()
+                if widget.field_value
+            }
+
+        def image_count(pdf_bytes):
+            file_handle = fitz.open(stream=pdf_bytes.getvalue(), filetype="pdf")
+            return len(file_handle[0].get_images())
+
+        certs.TEMPLATE_CACHE.clear()
+        generator = certs.CertificateGenerator(
+            form=settings.certs.template, form_keys=certs.FORM_KEYS
+        )
+        with mock.patch.object(
+            certs, "CertificateTemplate", wraps=certs.CertificateTemplate
+        ) as template:
+            first = generator.generate_certificate({"name": "Åsa", "color": "B"})
+            second = generator.generate_certificate({"name": "C"})
+            self.assertIn("IdNamn", generator.get_all_fields())
+            self.assertEqual(template.call_count, 1)
+
+        self.assertEqual(field_values(first), {"IdNamn": "Åsa", "IdFärg": "B"})
+        self.assertEqual(field_values(second), {"IdNamn": "C"})
+
+        # the qr code is added in the same pass
+        qr_code = certs.QRHandler(
+            link="https://example.com",
+            size=(42, 42),
+            pos={"x0": 253, "y0": 753, "x1": 295, "y1": 795},
+        )
+        with_qr = generator.generate_certificate({"name": "C"}, qr_code=qr_code)
+        self.assertEqual(field_values(with_qr), {"IdNamn": "C"})
+        self.assertEqual(image_count(with_qr), image_count(second) + 1)
+
+    def test_s3_client(self):
+        """
+        Checks that the S3 client is shared, and that the bucket is only
+        checked when the client is created.
+        """
+        s3_mock = mock_s3()
+        s3_mock.start()
+        with mock.patch.object(s3, "S3Handler", wraps=s3.S3Handler) as handler:
+            client = s3.get_s3_client()
+            self.assertIs(s3.get_s3_client(), client)
+            self.assertEqual(handler.call_count, 1)
+
+        config = client.s3_client.meta.config
+        self.assertEqual(config.max_pool_connections, s3.MAX_POOL_CONNECTIONS)
+        self.assertTrue(config.tcp_keepalive)
+
+        self.assertTrue(client.put_object("test/object", b"data"))
+        self.assertEqual(s3.get_s3_client().get_object("test/object"), b"data")
+
+        s3.reset_s3_client()
+        self.assertIsNot(s3.get_s3_client(), client)
+        s3_mock.stop()
+
+    def test_s3_object_cache(self):
+        """
+        Checks that S3 objects are served from the disk cache once read, as
+        long as the cached version is current, that the cache is invalidated
+        by writes, and that it's bounded in size.
+        """
+        s3_mock = mock_s3()
+        s3_mock.start()
+        client = s3.get_s3_client()
+        client.put_object("G1-1/certificate.pdf", b"first")
+        self.assertEqual(client.get_object("G1-1/certificate.pdf"), b"first")
+
+        with mock.patch.object(
+            client.s3_client, "get_object", wraps=client.s3_client.get_object
+        ) as get_object:
+            self.assertEqual(client.get_object("G1-1/certificate.pdf"), b"first")
+            self.assertIn("IfNoneMatch", get_object.call_args[1])
+            self.assertEqual(get_object.call_count, 1)
+
+            # Objects changed elsewhere are downloaded again
+            client.s3_client.put_object(
+                Body=b"changed", Bucket=client.bucket, Key="G1-1/certificate.pdf"
+            )
+            self.assertEqual(client.get_object("G1-1/certificate.pdf"), b"changed")
+            self.assertEqual(client.get_object("G1-1/certificate.pdf"), b"changed")
+            self.assertEqual(get_object.call_count, 3)
+
+        client.put_object("G1-1/certificate.pdf", b"second")
+        self.assertEqual(client.get_object("G1-1/certificate.pdf"), b"second")
+
+        client.put_object("G1-2/certificate.pdf", b"other")
+        client.get_object("G1-2/certificate.pdf")
+        client.copy_object("G1-1/certificate.pdf", "G1-2/certificate.pdf")
+        self.assertEqual(client.get_object("G1-2/certificate.pdf"), b"second")
+
+        client.delete_object("G1-2/certificate.pdf")
+        with self.assertRaises(Exception):
+            client.get_object("G1-2/certificate.pdf")
+        s3_mock.stop()
+
+        cache = s3.ObjectCache(tempfile.mkdtemp(dir=settings.s3.cache_dir), 10)
+        cache.put("a", '"etag-a"', b"12345", cache.generation)
+        os.utime(cache.path / os.listdir(cache.path)[0], ns=(0, 0))
+        cache.put("b", '"etag-b"', b"123456", cache.generation)
+        self.assertEqual(cache.etag("a"), None)
+        self.assertEqual(cache.etag("b"), "etag-b")
+        self.assertEqual(cache.get("b", "etag-b"), b"123456")
+        self.assertEqual(cache.get("b", "etag-c"), None)
+
+        # fills started before an invalidation are dropped
+        generation = cache.generation
+        cache.invalidate("c")
+        cache.put("c", '"etag-c"', b"1", generation)
+        self.assertFalse(cache.contains("c"))
+
+    def test_certificate_download_stream(self):
+        """
+        Checks that certificates are streamed in chunks with Range support,
+        both from S3 and from the disk cache.
+        """
+        individual = self.individuals[3].number
+        issue_form = {
+            "color_id": 3,
+            "birth_date": datetime.now() - timedelta(days=30),
+            "litter_size": 5,
+            "litter_size6w": 4,
+        }
+        url = f"/api/certificates/issue/{individual}"
+
+        s3_mock = mock_s3()
+        s3_mock.start()
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            pdf_data = context.post(url, json=issue_form).data
+            size = len(pdf_data)
+
+            # from S3
+            response = context.get(url, headers={"Range": "bytes=100-199"})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, pdf_data[100:200])
+            self.assertEqual(response.headers["Content-Range"], f"bytes 100-199/{size}")
+
+            response = context.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, pdf_data)
+            self.assertEqual(response.headers["Content-Length"], str(size))
+            self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+            # from the cache, filled by the full download, once validated
+            client = s3.get_s3_client()
+            etag = client.cache.etag(f"{individual}/certificate.pdf")
+            not_modified = botocore.exceptions.ClientError(
+                {"Error": {"Code": "304"}}, "GetObject"
+            )
+            with mock.patch.object(
+                client.s3_client, "get_object", side_effect=not_modified
+            ) as get_object:
+                response = context.get(url, headers={"Range": "bytes=-10"})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.data, pdf_data[-10:])
+                self.assertEqual(response.headers["Content-Length"], "10")
+                self.assertEqual(
+                    response.headers["Content-Range"],
+                    f"bytes {size - 10}-{size - 1}/{size}",
+                )
+
+                response = context.get(url, headers={"Range": f"bytes={size}-"})
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response.headers["Content-Range"], f"bytes */{size}")
+                self.assertEqual(get_object.call_args[1]["IfNoneMatch"], f'"{etag}"')
+
+            client.cache.invalidate(f"{individual}/certificate.pdf")
+            response = context.get(url, headers={"Range": f"bytes={size}-"})
+            self.assertEqual(response.status_code, 416)
+
+        # chunks are bounded in size
+        stream = client.stream_object(f"{individual}/certificate.pdf")
+        chunks = list(stream.chunks)
+        self.assertEqual(b"".join(chunks), pdf_data)
+        self.assertTrue(all(len(chunk) <= s3.STREAM_CHUNK_SIZE for chunk in chunks))
+        s3_mock.stop()
+
+    def test_certificate_preview_cache(self):
+        """
+        Checks that repeated previews of unchanged certificate data are served
+        from the preview cache, and that the cache is capped in size.
+        """
+        individual = self.individuals[3].number
+        form = {"color_id": 3, "litter_size": 5, "litter_size6w": 4}
+        certs.PREVIEW_CACHE.clear()
+
+        with self.app as context:
+            context.post(
+                "/api/login", json={"username": self.admin.email, "password": "pass"}
+            )
+            with mock.patch.object(
+                cert_acess, "get_certificate", wraps=cert_acess.get_certificate
+            ) as render:
+                first = context.get(f"/api/certificates/preview/{individual}")
+                second = context.get(f"/api/certificates/preview/{individual}")
+                self.assertEqual(first.status_code, 200)
+                self.assertEqual(first.data, second.data)
+                self.assertEqual(render.call_count, 1)
+
+                changed = context.post(
+                    f"/api/certificates/preview/{individual}", json=form
+                )
+                self.assertEqual(changed.status_code, 200)
+                self.assertEqual(render.call_count, 2)
+                context.post(f"/api/certificates/preview/{individual}", json=form)
+                self.assertEqual(render.call_count, 2)
+
+        cache = certs.PreviewCache(10)
+        cache.put("a", b"12345")
+        cache.put("b", b"12345")
+        self.assertEqual(cache.get("a"), b"12345")
+        cache.put("c", b"123")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), b"12345")
+        cache.put("d", b"12345678901")
+        self.assertEqual(cache.get("d"), None)
+        self.assertEqual(cache.size, 8)
+
+    def test_certificate_signer(self):
+        """
+        Checks that the signer and verifier are reused, and that the signing
+        material is only reloaded when the files change.
+        """
+        self.assertIs(certs.get_certificate_signer(), certs.get_certificate_signer())
+        self.assertIs(
+            certs.get_certificate_verifier(), certs.get_certificate_verifier()
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            ca_path = shutil.copy(settings.certs.ca, directory)
+            key_path = shutil.copy(settings.certs.private_key, directory)
+            signer = certs.CertificateSigner(
+                cert_auth=Path(ca_path),
+                private_key=Path(key_path),
+                private_key_pass=None,
+            )
+            verifier = certs.CertificateVerifier(pkcs_ca=Path(ca_path))
+            pdf_bytes = certs.CertificateGenerator(
+                form=settings.certs.template, form_keys=certs.FORM_KEYS
+            ).generate_certificate({"name": "A"})
+
+            with mock.patch(
+                "utils.certificates.load_pem_private_key",
+                wraps=certs.load_pem_private_key,
+            ) as load_key:
+                unsigned = pdf_bytes.getvalue()
+                signed = signer.sign_certificate(pdf_bytes)
+                signer.sign_certificate(pdf_bytes)
+                self.assertEqual(load_key.call_count, 1)
+                self.assertEqual(pdf_bytes.getvalue(), unsigned)
+
+                # replacing the files reloads the signing material
+                stat = os.stat(key_path)
+                os.utime(key_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+                signer.sign_certificate(pdf_bytes)
+                self.assertEqual(load_key.call_count, 2)
+
+            self.assertTrue(verifier.verify_signature(signed.getvalue()))
+            with mock.patch.object(
+                verifier, "_load_pkcs_ca", wraps=verifier._load_pkcs_ca
+            ) as load_ca:
+                verifier.verify_signature(signed.getvalue())
+                self.assertEqual(load_ca.call_count, 0)
+                stat = os.stat(ca_path)
+                os.utime(ca_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+                self.assertTrue(verifier.verify_signature(signed.getvalue()))
+                self.assertEqual(load_ca.call_count, 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the genetics result cache.
+
+isort:skip_file
+"""
+# Fairly lax pylint settings as we want to test a lot of things
+
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-statements
+
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from cachelib import SimpleCache
+
+# pylint: disable=import-error
+import utils.database as db
+import utils.genetics_cache as genetics_cache
+from tests.database_test import DatabaseTest
+
+
+class TestGeneticsCache(DatabaseTest):
+    """
+    Checks that genetics results are cached per genebank data version, and
+    refreshed in the background by one thread at a time.
+    """
+
+    def setUp(self):
+        """
+        Creates an empty cache, with its lock files in a temporary directory.
+        """
+        super().setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.cache = genetics_cache.GeneticsCache(SimpleCache(), self.lock_dir, 300)
+        self.genebank_id = self.genebanks[0].id
+
+    def tearDown(self):
+        """
+        Removes the lock files.
+        """
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+        super().tearDown()
+
+    def wait_for_refresh(self):
+        """
+        Waits for the background refreshes of the cache to finish.
+        """
+        for _ in range(100):
+            if not self.cache.refreshing:
+                return
+            time.sleep(0.05)
+        self.fail("Refresh did not finish")
+
+    def test_hit_and_miss(self):
+        """
+        Checks that results are fetched once, and that failed fetches aren't
+        cached.
+        """
+        fetch = mock.Mock(return_value={})
+        self.assertEqual(self.cache.get("kinship", self.genebank_id, fetch), {})
+        self.assertEqual(self.cache.get("kinship", self.genebank_id, fetch), {})
+        self.assertEqual(fetch.call_count, 2)
+
+        fetch.return_value = {"G1-1": 0.1}
+        for _ in range(3):
+            self.assertEqual(
+                self.cache.get("kinship", self.genebank_id, fetch), {"G1-1": 0.1}
+            )
+        self.assertEqual(fetch.call_count, 3)
+
+        # Results are kept per kind and genebank
+        other = mock.Mock(return_value={"G1-1": 0.2})
+        self.assertEqual(
+            self.cache.get("inbreeding", self.genebank_id, other), {"G1-1": 0.2}
+        )
+        self.assertEqual(
+            self.cache.get("kinship", self.genebanks[1].id, other), {"G1-1": 0.2}
+        )
+
+    def test_stale_while_revalidate(self):
+        """
+        Checks that stale results are served, and looked up as stale, while
+        they are refreshed, both when the genebank data changes and when they
+        are too old.
+        """
+        fetch = mock.Mock(return_value={"G1-1": 0.1})
+        self.cache.get("meankinship", self.genebank_id, fetch)
+
+        db.bump_data_version(self.herds[0].id)
+        fetch.return_value = {"G1-1": 0.2}
+        self.assertEqual(
+            self.cache.lookup("meankinship", self.genebank_id, fetch),
+            ({"G1-1": 0.1}, True),
+        )
+        self.wait_for_refresh()
+        self.assertEqual(
+            self.cache.lookup("meankinship", self.genebank_id, fetch),
+            ({"G1-1": 0.2}, False),
+        )
+        self.assertEqual(fetch.call_count, 2)
+
+        fetch.return_value = {"G1-1": 0.3}
+        with mock.patch.object(self.cache, "lifetime", 0):
+            self.assertEqual(
+                self.cache.get("meankinship", self.genebank_id, fetch), {"G1-1": 0.2}
+            )
+            self.wait_for_refresh()
+        self.assertEqual(
+            self.cache.get("meankinship", self.genebank_id, fetch), {"G1-1": 0.3}
+        )
+
+        # Failed refreshes keep the stale result
+        db.bump_data_version(self.herds[0].id)
+        fetch.return_value = {}
+        self.cache.get("meankinship", self.genebank_id, fetch)
+        self.wait_for_refresh()
+        self.assertEqual(
+            self.cache.get("meankinship", self.genebank_id, fetch), {"G1-1": 0.3}
+        )
+
+    def test_single_flight(self):
+        """
+        Checks that concurrent misses fetch once, and that a refresh isn't
+        started while another thread or worker holds the lock.
+        """
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            return {"G1-1": 0.1}
+
+        fetch_mock = mock.Mock(side_effect=fetch)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.get("kinship", self.genebank_id, fetch_mock)
+                )
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{"G1-1": 0.1}] * 4)
+        self.assertEqual(fetch_mock.call_count, 1)
+
+        db.bump_data_version(self.herds[0].id)
+        key = f"genetics-kinship-{self.genebank_id}"
+        with self.cache._lock(key, blocking=True):  # pylint: disable=W0212
+            self.cache.get("kinship", self.genebank_id, fetch_mock)
+            self.wait_for_refresh()
+        self.assertEqual(fetch_mock.call_count, 1)
+
+    def test_store(self):
+        """
+        Checks that fetched results are stored, and that failing to store them
+        doesn't fail the lookup.
+        """
+        store = mock.Mock()
+        cache = genetics_cache.GeneticsCache(SimpleCache(), self.lock_dir, 300, store)
+        version = db.get_data_version(self.genebank_id)
+
+        cache.get("inbreeding", self.genebank_id, lambda: {})
+        store.assert_not_called()
+        cache.get("inbreeding", self.genebank_id, lambda: {"G1-1": 0.1})
+        store.assert_called_once_with(
+            "inbreeding", self.genebank_id, {"G1-1": 0.1}, version
+        )
+
+        store.side_effect = ValueError("no database")
+        self.assertEqual(
+            cache.get("meankinship", self.genebank_id, lambda: {"G1-1": 0.2}),
+            {"G1-1": 0.2},
+        )
+
+    def test_refresh(self):
+        """
+        Checks that refreshes can be started without reading the result, in
+        the background or not, and that fresh results aren't refreshed.
+        """
+        fetch = mock.Mock(return_value={"G1-1": 0.1})
+        self.cache.get("inbreeding", self.genebank_id, fetch)
+        self.cache.refresh("inbreeding", self.genebank_id, fetch)
+        self.wait_for_refresh()
+        self.assertEqual(fetch.call_count, 1)
+
+        db.bump_data_version(self.herds[0].id)
+        self.cache.refresh("inbreeding", self.genebank_id, fetch)
+        self.wait_for_refresh()
+        self.assertEqual(fetch.call_count, 2)
+
+        # Refreshes can also be made in the calling thread
+        db.bump_data_version(self.herds[0].id)
+        fetch.return_value = {"G1-1": 0.2}
+        self.cache.refresh("inbreeding", self.genebank_id, fetch, background=False)
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(self.cache.refreshing, set())
+        self.assertEqual(
+            self.cache.get("inbreeding", self.genebank_id, fetch), {"G1-1": 0.2}
+        )
+
+    def test_data_version(self):
+        """
+        Checks that the data version is bumped for the genebanks of the given
+        herds only.
+        """
+        versions = [db.get_data_version(genebank.id) for genebank in self.genebanks]
+        db.bump_data_version(self.herds[0].id)
+        self.assertEqual(db.get_data_version(self.genebanks[0].id), versions[0] + 1)
+        self.assertEqual(db.get_data_version(self.genebanks[1].id), versions[1])
+        self.assertEqual(
+            db.get_data_version(str(self.genebanks[0].id)), versions[0] + 1
+        )
+        self.assertIsNone(db.get_data_version("unknown"))
+
+        # Herds in different genebanks bump both, and herds in the same one once
+        db.bump_data_version(self.herds[0], self.herds[1].id, self.herds[2])
+        self.assertEqual(db.get_data_version(self.genebanks[0].id), versions[0] + 2)
+        self.assertEqual(db.get_data_version(self.genebanks[1].id), versions[1] + 1)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the genetics refresher.
+
+isort:skip_file
+"""
+# Fairly lax pylint settings as we want to test a lot of things
+
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-statements
+
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+# pylint: disable=import-error
+import utils.database as db
+import utils.genetics_refresher as genetics_refresher
+from tests.database_test import DatabaseTest
+
+
+class TestGeneticsRefresher(DatabaseTest):
+    """
+    Checks that one refresher at a time refreshes the genetics results, when
+    genebanks change and at an interval.
+    """
+
+    def setUp(self):
+        """
+        Creates two refreshers sharing a temporary lock directory, as if they
+        were in different workers.
+        """
+        super().setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.refresh = mock.Mock()
+        self.refreshers = [
+            genetics_refresher.GeneticsRefresher(
+                self.lock_dir, self.refresh, interval=300, poll=0.05, settle=10
+            )
+            for _ in range(2)
+        ]
+
+    def tearDown(self):
+        """
+        Stops the refreshers and removes the lock directory.
+        """
+        for refresher in self.refreshers:
+            refresher.stop()
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_leader_election(self):
+        """
+        Checks that only one refresher is the leader, and that another takes
+        over when it stops.
+        """
+        first, second = self.refreshers
+        self.assertTrue(first._elect())  # pylint: disable=protected-access
+        self.assertFalse(second._elect())  # pylint: disable=protected-access
+        self.assertTrue(first.leader)
+        self.assertFalse(second.leader)
+
+        first.stop()
+        self.assertFalse(first.leader)
+        self.assertTrue(second._elect())  # pylint: disable=protected-access
+
+    def test_tick(self):
+        """
+        Checks that all genebanks are refreshed at first and after the
+        interval, and otherwise only the ones that changed after a
+        notification.
+        """
+        refresher, other = self.refreshers
+        refresher._elect()  # pylint: disable=protected-access
+        genebank_ids = [genebank.id for genebank in self.genebanks]
+        self.assertEqual(sorted(refresher.tick()), sorted(genebank_ids))
+        self.assertEqual(refresher.tick(), [])
+
+        # Changes are only picked up after a notification, which may come from
+        # another worker
+        db.bump_data_version(self.herds[0].id)
+        self.assertEqual(refresher.tick(), [])
+        other.notify()
+        self.assertEqual(refresher.tick(), [self.genebanks[0].id])
+        self.assertEqual(refresher.tick(), [])
+        self.refresh.assert_called_with(self.genebanks[0].id)
+
+        with mock.patch.object(refresher, "interval", 0):
+            self.assertEqual(len(refresher.tick()), len(genebank_ids))
+
+        # Failing refreshes are logged, and don't stop the others
+        self.refresh.side_effect = ValueError("no R-API")
+        with mock.patch.object(refresher, "interval", 0):
+            self.assertEqual(len(refresher.tick()), len(genebank_ids))
+
+        status = other.status()
+        self.assertFalse(status["is_leader"])
+        self.assertEqual(status["leader"]["runs"], 4)
+        self.assertEqual(status["leader"]["last_error"], "no R-API")
+        self.assertIsNotNone(status["leader"]["last_trigger"])
+        self.assertEqual(
+            status["leader"]["last_full_run"], status["leader"]["last_run"]
+        )
+
+    def test_thread(self):
+        """
+        Checks that a running refresher refreshes changed genebanks when the
+        data version is bumped, and that it can be stopped.
+        """
+        refresher = self.refreshers[0]
+        with mock.patch.object(db, "DATA_VERSION_LISTENERS", [refresher.notify]):
+            refresher.start()
+            self.wait_for_calls(len(self.genebanks))
+            self.assertTrue(refresher.status()["running"])
+
+            db.bump_data_version(self.herds[0].id)
+            self.wait_for_calls(len(self.genebanks) + 1)
+            self.refresh.assert_called_with(self.genebanks[0].id)
+
+        refresher.stop()
+        self.assertFalse(refresher.status()["running"])
+        self.assertFalse(refresher.leader)
+
+    def wait_for_calls(self, count):
+        """
+        Waits for the refresh function to have been called `count` times.
+        """
+        for _ in range(100):
+            if self.refresh.call_count >= count:
+                return
+            time.sleep(0.05)
+        self.fail(f"Refresh was called {self.refresh.call_count} times")
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Query plan regression tests for the hot database access paths.
+
+isort:skip_file
+"""
+# Fairly lax pylint settings as we want to test a lot of things
+
+# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-statements
+
+import re
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+
+import utils.data_access as da
+
+# pylint: disable=import-error
+import utils.database as db
+from tests.database_test import DatabaseTest
+
+# Tables that grow with the herdbook, and mustn't be scanned by the queries
+# tested here.
+LARGE_TABLES = ["herd_tracking", "breeding", "individual", "hbuser"]
+
+SYNTHETIC_INDIVIDUALS = 2000
+SYNTHETIC_USERS = 500
+
+
+class TestQueryPlans(DatabaseTest):
+    """
+    Runs EXPLAIN QUERY PLAN on the queries of the hot access paths, on a
+    database filled with synthetic data, and checks that they use indexes
+    instead of scanning the large tables.
+    """
+
+    def setUp(self):
+        """
+        Adds synthetic individuals, breedings, herd tracking and users to the
+        default test data, and updates the planner statistics.
+        """
+        super().setUp()
+        herd = self.herds[0]
+        start = datetime(2000, 1, 1)
+        with db.DATABASE.atomic():
+            breedings = [
+                {
+                    "breeding_herd_id": herd.id,
+                    "birth_date": start + timedelta(days=n),
+                    "mother": self.individuals[n % 2].id,
+                    "father": self.individuals[2].id,
+                    "litter_size": 4,
+                }
+                for n in range(SYNTHETIC_INDIVIDUALS // 4)
+            ]
+            for chunk in range(0, len(breedings), 100):
+                db.Breeding.insert_many(breedings[chunk : chunk + 100]).execute()
+            breeding_ids = [
+                breeding.id
+                for breeding in db.Breeding.select(db.Breeding.id).order_by(
+                    db.Breeding.id.desc()
+                )
+            ]
+
+            individuals = [
+                {
+                    "origin_herd": herd.id,
+                    "number": f"G1-X{n}",
+                    "breeding": breeding_ids[n % len(breedings)],
+                }
+                for n in range(SYNTHETIC_INDIVIDUALS)
+            ]
+            for chunk in range(0, len(individuals), 100):
+                db.Individual.insert_many(individuals[chunk : chunk + 100]).execute()
+
+            tracking = [
+                {
+                    "herd": self.herds[n % 2].id,
+                    "individual": individual.id,
+                    "herd_tracking_date": start + timedelta(days=n),
+                }
+                for individual in db.Individual.select(db.Individual.id)
+                for n in range(3)
+            ]
+            for chunk in range(0, len(tracking), 100):
+                db.HerdTracking.insert_many(tracking[chunk : chunk + 100]).execute()
+
+            users = [
+                {"email": f"user{n}@example.com", "uuid": uuid.uuid4()}
+                for n in range(SYNTHETIC_USERS)
+            ]
+            for chunk in range(0, len(users), 100):
+                db.User.insert_many(users[chunk : chunk + 100]).execute()
+        db.DATABASE.execute_sql("ANALYZE")
+
+    @staticmethod
+    def captured_queries(func):
+        """
+        Runs `func`, and returns the `(sql, params)` of the select queries it
+        ran.
+        """
+        queries = []
+        execute_sql = db.DATABASE.execute_sql
+
+        def record(sql, params=None, *args, **kwargs):
+            queries.append((sql, params))
+            return execute_sql(sql, params, *args, **kwargs)
+
+        with mock.patch.object(db.DATABASE, "execute_sql", side_effect=record):
+            func()
+        return [
+            (sql, params)
+            for sql, params in queries
+            if sql.lstrip().upper().startswith(("SELECT", "WITH"))
+        ]
+
+    def assertUsesIndexes(self, func):  # pylint: disable=invalid-name
+        """
+        Checks that none of the queries run by `func` scan a large table.
+        """
+        queries = self.captured_queries(func)
+        self.assertTrue(queries)
+        for sql, params in queries:
+            tables = {
+                alias: table for table, alias in re.findall(r'"(\w+)" AS "(\w+)"', sql)
+            }
+            plan = [
+                row[-1]
+                for row in db.DATABASE.execute_sql(
+                    "EXPLAIN QUERY PLAN " + sql, params
+                ).fetchall()
+            ]
+            for detail in plan:
+                scan = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+                self.assertFalse(
+                    scan and tables.get(scan.group(1), scan.group(1)) in LARGE_TABLES,
+                    f"{detail} in plan {plan} of {sql}",
+                )
+
+    def test_latest_herdtracking_entry(self):
+        """
+        Checks that the latest herd of an individual is found through the
+        individual and date index, without sorting its history.
+        """
+        individual = db.Individual.get(db.Individual.number == "G1-X10")
+        self.assertUsesIndexes(lambda: individual.latest_herdtracking_entry)
+
+        sql, params = self.captured_queries(
+            lambda: individual.latest_herdtracking_entry
+        )[0]
+        plan = db.DATABASE.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", [row[-1] for row in plan])
+
+    def test_next_individual_number(self):
+        """
+        Checks that the litters of a herd are found through the herd and birth
+        date index.
+        """
+        breeding = db.Breeding.select().order_by(db.Breeding.id.desc()).get()
+        self.assertUsesIndexes(
+            lambda: db.next_individual_number(
+                self.herds[0].herd, breeding.birth_date, breeding.id
+            )
+        )
+
+    def test_children(self):
+        """
+        Checks that the children of an individual are found through the parent
+        and breeding indexes.
+        """
+        self.assertUsesIndexes(lambda: self.individuals[2].children)
+
+    def test_fetch_user_info(self):
+        """
+        Checks that users are found through the uuid index.
+        """
+        self.assertUsesIndexes(lambda: da.fetch_user_info(self.owner.uuid))
+
+    def test_breeding_events(self):
+        """
+        Checks that the breeding events of a date are found without scanning
+        the breeding table.
+        """
+        birth_date = datetime(2000, 1, 10).date()
+        self.assertUsesIndexes(
+            lambda: db.Breeding.select()
+            .where(db.Breeding.breeding_herd_id == self.herds[0])
+            .where(db.Breeding.birth_date == birth_date)
+            .execute()
+        )
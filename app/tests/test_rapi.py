@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the R-API client.
+
+isort:skip_file
+"""
+import unittest
+from unittest import mock
+
+import requests
+
+# pylint: disable=import-error
+import utils.rapi as rapi
+
+
+class TestRapi(unittest.TestCase):
+    """
+    Checks that the R-API client stops calling the R-API after repeated
+    failures, and tries again after a while.
+    """
+
+    def setUp(self):
+        """
+        Creates a client whose session is mocked.
+        """
+        self.client = rapi.RapiClient(
+            "http://rapi", timeout=5, failure_threshold=2, reset_timeout=30
+        )
+        self.session_request = mock.patch.object(self.client.session, "request").start()
+        self.session_request.return_value.status_code = 200
+        self.clock = mock.patch("utils.rapi.time.monotonic", return_value=0).start()
+
+    def tearDown(self):
+        """
+        Removes the mocks.
+        """
+        mock.patch.stopall()
+
+    def test_request(self):
+        """
+        Checks that requests are made with the pooled session and timeout, and
+        that client errors don't open the circuit breaker.
+        """
+        response = self.client.get("kinship", "/kinship/1", params={"a": "b"})
+        self.assertEqual(response.status_code, 200)
+        self.session_request.assert_called_once_with(
+            "GET", "http://rapi/kinship/1", timeout=5, params={"a": "b"}
+        )
+        self.client.post("testbreed", "/testbreed/", data={})
+        self.assertEqual(self.session_request.call_args[0][0], "POST")
+
+        self.session_request.return_value.status_code = 404
+        for _ in range(3):
+            self.assertEqual(self.client.get("kinship", "/").status_code, 404)
+        self.assertEqual(self.client.breaker.state, "closed")
+
+    def test_circuit_breaker(self):
+        """
+        Checks that the breaker opens after repeated failures, lets one trial
+        call through after the reset timeout, and closes when it succeeds.
+        """
+        self.session_request.return_value.status_code = 500
+        self.client.get("kinship", "/")
+        self.assertEqual(self.client.breaker.state, "closed")
+        self.session_request.side_effect = requests.exceptions.Timeout()
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.get("kinship", "/")
+        self.assertEqual(self.client.breaker.state, "open")
+
+        self.session_request.reset_mock()
+        with self.assertRaises(rapi.CircuitOpen):
+            self.client.get("kinship", "/")
+        self.session_request.assert_not_called()
+
+        # A failed trial opens the breaker again
+        self.clock.return_value = 30
+        self.assertEqual(self.client.breaker.state, "half-open")
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.get("kinship", "/")
+        with self.assertRaises(rapi.CircuitOpen):
+            self.client.get("kinship", "/")
+        self.assertEqual(self.session_request.call_count, 1)
+
+        self.clock.return_value = 60
+        self.session_request.side_effect = None
+        self.session_request.return_value.status_code = 200
+        self.assertTrue(self.client.breaker.allow())
+        # Only one trial is let through at a time
+        self.assertFalse(self.client.breaker.allow())
+        self.client.breaker.record_success()
+        self.assertEqual(self.client.breaker.state, "closed")
+        self.client.get("kinship", "/")
+        self.assertEqual(self.session_request.call_count, 2)
+
+        # Successes reset the failure count
+        self.session_request.return_value.status_code = 503
+        self.client.get("kinship", "/")
+        self.session_request.return_value.status_code = 200
+        self.client.get("kinship", "/")
+        self.session_request.return_value.status_code = 503
+        self.client.get("kinship", "/")
+        self.assertEqual(self.client.breaker.state, "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,11 @@
+import copy
 import datetime
 import hashlib
 
-from flask import make_response
+from flask import Response, make_response
 
 import utils.data_access as da  # isort:skip
+import utils.database as db  # isort:skip
 import utils.certificates as certs  # isort:skip
 import utils.s3 as s3  # isort:skip
 import utils.settings as settings  # isort:skip
@@ -19,6 +21,44 @@ def create_pdf_response(pdf_bytes, obj_name):
     return response
 
 
+def create_pdf_stream_response(ind_number, obj_name, request_range=None):
+    """
+    Returns a http response streaming the certificate of `ind_number` from S3,
+    or the byte range of it given by `request_range`, a parsed HTTP Range
+    header. Only single byte ranges are supported, other ranges are ignored.
+    """
+    byte_range = None
+    if (
+        request_range is not None
+        and request_range.units == "bytes"
+        and len(request_range.ranges) == 1
+    ):
+        byte_range = request_range.ranges[0]
+
+    try:
+        stream = s3.get_s3_client().stream_object(
+            f"{ind_number}/certificate.pdf", byte_range
+        )
+    except s3.InvalidRange as ex:
+        response = make_response("", 416)
+        if ex.size is not None:
+            response.headers["Content-Range"] = f"bytes */{ex.size}"
+        return response
+
+    response = Response(
+        stream.chunks,
+        status=206 if stream.partial else 200,
+        mimetype="application/pdf",
+        direct_passthrough=True,
+    )
+    response.headers["Content-Length"] = stream.length
+    response.headers["Accept-Ranges"] = "bytes"
+    if stream.partial:
+        response.headers["Content-Range"] = stream.content_range
+    response.headers["Content-Disposition"] = "inline; filename=%s" % obj_name
+    return response
+
+
 def sign_data(pdf_bytes):
     """
     Returns digitally signed pdf bytes.
@@ -33,22 +73,19 @@ def verify_signature(pdf_bytes):
     return certs.get_certificate_verifier().verify_signature(pdf_bytes)
 
 
-def get_certificate_checksum(ind_number):
-    """
-    Returns the bytes of the latest certificate
-    """
-    return hashlib.sha256(
-        s3.get_s3_client().get_object(f"{ind_number}/certificate.pdf")
-    ).hexdigest()
-
-
 def upload_certificate(pdf_bytes, ind_number):
     """
-    Triggers a S3 certificate upload
+    Triggers a S3 certificate upload, and records the certificate checksum so
+    that it can be verified without downloading it again.
     """
-    return s3.get_s3_client().put_object(
+    uploaded = s3.get_s3_client().put_object(
         file_name=f"{ind_number}/certificate.pdf", file_data=pdf_bytes
     )
+    if uploaded:
+        da.record_certificate_checksum(
+            ind_number, hashlib.sha256(pdf_bytes).hexdigest(), len(pdf_bytes)
+        )
+    return uploaded
 
 
 def download_certificate_s3(ind_number):
@@ -69,10 +106,36 @@ def check_certificate_s3(ind_number):
 
 def verify_certificate_checksum(ind_number, checksum):
     """
-    Returns whether a certificate exists with the given checksum.
+    Returns whether a certificate exists with the given checksum. Certificates
+    without a recorded checksum are checksummed from S3, and recorded.
+    """
+    stored = da.get_certificate_checksum(ind_number)
+    if stored is None:
+        pdf_bytes = download_certificate_s3(ind_number)
+        stored = hashlib.sha256(pdf_bytes).hexdigest()
+        da.record_certificate_checksum(ind_number, stored, len(pdf_bytes))
+    return stored == checksum
+
+
+def backfill_certificate_checksums():
+    """
+    Records the checksums of the digital certificates in S3 that don't have a
+    recorded checksum yet. Returns a status dict with the number of recorded
+    and missing certificates.
     """
-    s3_sum = get_certificate_checksum(ind_number)
-    return s3_sum == checksum
+    recorded = 0
+    missing = []
+    for ind_number in da.get_unchecksummed_certificates():
+        try:
+            pdf_bytes = download_certificate_s3(ind_number)
+        except Exception:  # pylint: disable=broad-except
+            missing += [ind_number]
+            continue
+        da.record_certificate_checksum(
+            ind_number, hashlib.sha256(pdf_bytes).hexdigest(), len(pdf_bytes)
+        )
+        recorded += 1
+    return {"status": "success", "recorded": recorded, "missing": missing}
 
 
 def flatten_list_of_dcts(in_list):
@@ -90,15 +153,6 @@ def get_certificate_data(ind, user_id):
     """
     Gets all data needed to issue a certificate.
     """
-    parent_keys = [
-        (1, "F"),
-        (1, "M"),
-        (2, "FF"),
-        (2, "MF"),
-        (2, "FM"),
-        (2, "MM"),
-    ]
-
     date = datetime.datetime.utcnow()
     date = date.strftime("%Y%m%d")
     herd = ind["herd"]
@@ -126,51 +180,38 @@ def get_certificate_data(ind, user_id):
     cert_data_lst = []
     cert_data_lst.append(ind)
     cert_data_lst.append(extra_data)
-    for level, a_type in parent_keys:
-        cert_data_lst.append(_get_parent(ind, user_id, level, a_type))
+    # parents and grandparents, as F_*, M_*, FF_*, MF_*, FM_* and MM_* fields
+    cert_data_lst.append(da.get_pedigree(ind["number"], user_id, depth=2))
 
     return flatten_list_of_dcts(cert_data_lst)
 
 
-def _get_parent(ind, user_id, ancestry_level, ancestry_type):
-    ancestries = {
-        (1, "F"): "father",
-        (1, "M"): "mother",
-        (2, "FF"): "father",
-        (2, "MF"): "father",
-        (2, "FM"): "mother",
-        (2, "MM"): "mother",
-    }
-    try:
-        if ancestry_level == 1:
-            ancestor = ind.get(ancestries[(1, ancestry_type)], None)
-            idv = da.get_individual(ancestor["number"], user_id)
-
-        elif ancestry_level == 2:
-            ancestor = ind.get(ancestries[(1, ancestry_type[0])], None)
-            parent = da.get_individual(ancestor["number"], user_id)
-            grand_ancestor = parent.get(ancestries[(2, ancestry_type)], None)
-            if grand_ancestor["number"] is None:
-                return None
-            idv = da.get_individual(grand_ancestor["number"], user_id)
-
-    except TypeError as ex:
-        print(ex)
-        return None
-
-    ndict = dict()
-    for key in idv.keys():
-        ndict[key] = ancestry_type + "_" + key
-
-    parent_ind = dict()
-    for old_key, val in idv.items():
-        parent_ind[ndict[old_key]] = val
-
-    genebank = parent_ind[ancestry_type + "_" + "number"].split("-")
-    parent_ind[ancestry_type + "_" + "genebank_aki"] = genebank[1]
-    parent_ind[ancestry_type + "_" + "genebank_number"] = genebank[0]
+def register_digital_certificate(ind_data, form, user_id):
+    """
+    Assigns a digital certificate number to the individual in `ind_data`,
+    after updating it (and its breeding, if the form changes the litter size)
+    with the data in `form`.
 
-    return parent_ind
+    Returns the result of the individual update, and the certificate data to
+    generate the certificate from.
+    """
+    breed_data = db.Breeding.get(ind_data.get("breeding")).as_dict()
+    ind_data.update(**form, issue_digital=True)
+    # keep the ind_data object intact
+    ind_data_copy = copy.copy(ind_data)
+    # Update breeding if the form changes the litter size
+    litter = {
+        key: form[key]
+        for key in ["litter_size", "litter_size6w"]
+        if key in form and form[key] != breed_data.get(key)
+    }
+    if litter:
+        breed_data.update(**litter)
+        da.update_breeding(breed_data, user_id)
+    res = da.update_individual(ind_data, user_id)
+    cert_data = get_certificate_data(ind_data_copy, user_id)
+    cert_data.update(digital_certificate=res.get("digital_certificate", None))
+    return res, cert_data
 
 
 def get_certificate(data):
@@ -197,12 +238,22 @@ def get_certificate(data):
             "y1": qr_y_pos,
         },
     )
-    # Unsigned bytes without qr code
-    unsigned_pdf_bytes = certificate.generate_certificate(form_data=data)
-
     # Unsigned bytes with qr code
-    unsigned_pdf_bytes_qr = certificate.add_qrcode_to_certificate(
-        unsigned_pdf_bytes, qr_code
-    )
+    return certificate.generate_certificate(form_data=data, qr_code=qr_code)
 
-    return unsigned_pdf_bytes_qr
+
+def get_certificate_preview(data):
+    """
+    Returns the bytes of an unsigned certificate preview. Previews are cached,
+    so repeated previews of unchanged data with the same template aren't
+    rendered again.
+    """
+    template = certs.get_certificate_template(settings.certs.template)
+    key = certs.preview_key(
+        data, str(settings.certs.template), template.version, settings.service.host
+    )
+    pdf_bytes = certs.PREVIEW_CACHE.get(key)
+    if pdf_bytes is None:
+        pdf_bytes = get_certificate(data).getvalue()
+        certs.PREVIEW_CACHE.put(key, pdf_bytes)
+    return pdf_bytes
@@ -0,0 +1,237 @@
+"""
+Background jobs for issuing digital certificates in bulk.
+
+The database updates of a job are made one individual at a time in the job
+thread, as certificate numbers are assigned sequentially. The certificates
+are then rendered and signed in a process pool, and uploaded to S3 from a
+thread pool as they are finished.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import utils.cert_acess as cert_acess  # isort:skip
+import utils.data_access as da  # isort:skip
+import utils.settings as settings  # isort:skip
+
+logger = logging.getLogger("herdbook.cert")
+
+UPLOAD_WORKERS = 8
+JOB_RETENTION = 24 * 3600
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+JOB_RUNNER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="certificate-jobs")
+
+
+def render_certificate(cert_data):
+    """
+    Returns the signed certificate PDF bytes for `cert_data`. This is run in
+    the worker processes, so it must not touch the database.
+    """
+    pdf_bytes = cert_acess.get_certificate(cert_data)
+    return cert_acess.sign_data(pdf_bytes).getvalue()
+
+
+def upload_certificate(pdf_bytes, number):
+    """
+    Uploads the certificate of `number` from an upload thread, and closes the
+    database connection the thread used to record the checksum.
+    """
+    try:
+        return cert_acess.upload_certificate(pdf_bytes, number)
+    finally:
+        if not da.DATABASE.is_closed():
+            da.DATABASE.close()
+
+
+class CertificateJob:
+    """
+    A queued bulk certificate issue, and its per individual results.
+    """
+
+    def __init__(self, items, user_uuid):
+        self.id = uuid.uuid4().hex  # pylint: disable=invalid-name
+        self.user_uuid = str(user_uuid)
+        self.items = items
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def set_result(self, number, status, **kwargs):
+        """
+        Sets the result for the individual `number`.
+        """
+        with self.lock:
+            self.results[number] = {"status": status, **kwargs}
+
+    def as_dict(self):
+        """
+        Returns the job status as a dict.
+        """
+        with self.lock:
+            results = {number: dict(result) for number, result in self.results.items()}
+        statuses = [result["status"] for result in results.values()]
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": len(self.items),
+            "issued": statuses.count("issued"),
+            "failed": statuses.count("error"),
+            "results": results,
+        }
+
+    def run(self):
+        """
+        Issues the certificates of the job.
+        """
+        self.status = "running"
+        logger.info(f"Certificate job {self.id} issuing {len(self.items)} certificates")
+        try:
+            prepared = self._prepare()
+            self._render_and_upload(prepared)
+            self.status = "done"
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.error(f"Certificate job {self.id} failed: {ex}")
+            self.status = "error"
+        finally:
+            # The job runner thread isn't a request, so return its pooled
+            # connection here
+            if not da.DATABASE.is_closed():
+                da.DATABASE.close()
+        self.finished = time.time()
+        status = self.as_dict()
+        logger.info(
+            f"Certificate job {self.id} {self.status}, "
+            f"{status['issued']} of {status['total']} certificates issued"
+        )
+
+    def _prepare(self):
+        """
+        Assigns certificate numbers, and returns a list of `(number,
+        certificate data)` tuples for the individuals that passed.
+        """
+        prepared = []
+        for item in self.items:
+            number = item["number"]
+            form = {key: value for key, value in item.items() if key != "number"}
+            try:
+                ind_data = da.get_individual(number, self.user_uuid)
+                if ind_data is None:
+                    self.set_result(number, "error", message="Individual not found")
+                    continue
+                if ind_data.get("digital_certificate", None) or ind_data.get(
+                    "certificate", None
+                ):
+                    self.set_result(
+                        number, "error", message="Certificate already exists"
+                    )
+                    continue
+                res, cert_data = cert_acess.register_digital_certificate(
+                    ind_data, form, self.user_uuid
+                )
+                if res.get("status", None) == "error":
+                    self.set_result(number, "error", message=res["message"])
+                    continue
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error(f"Could not register certificate for {number}: {ex}")
+                self.set_result(number, "error", message="Could not update individual")
+                continue
+            self.set_result(
+                number, "pending", certificate=cert_data["digital_certificate"]
+            )
+            prepared += [(number, cert_data)]
+        return prepared
+
+    def _render_and_upload(self, prepared):
+        """
+        Renders and signs the prepared certificates, uploading each of them as
+        soon as it's finished.
+        """
+        if not prepared:
+            return
+
+        workers = min(settings.service.certificate_workers, len(prepared))
+        # Spawned workers don't inherit the locks and connections of the
+        # server threads. They are started with the configured interpreter, as
+        # sys.executable is the uwsgi binary in production.
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(settings.service.python)
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context
+        ) as renderer, ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploader:
+            renders = {
+                renderer.submit(render_certificate, cert_data): (number, cert_data)
+                for number, cert_data in prepared
+            }
+            uploads = {}
+            for future in as_completed(renders):
+                number, cert_data = renders[future]
+                try:
+                    pdf_bytes = future.result()
+                except Exception as ex:  # pylint: disable=broad-except
+                    logger.error(f"Could not render certificate for {number}: {ex}")
+                    self.set_result(
+                        number, "error", message="Certificate could not be created"
+                    )
+                    continue
+                upload = uploader.submit(upload_certificate, pdf_bytes, number)
+                uploads[upload] = (number, cert_data)
+
+            for future in as_completed(uploads):
+                number, cert_data = uploads[future]
+                cert_number = cert_data["digital_certificate"]
+                try:
+                    uploaded = future.result()
+                except Exception as ex:  # pylint: disable=broad-except
+                    logger.error(f"Could not upload certificate for {number}: {ex}")
+                    uploaded = False
+                if uploaded:
+                    logger.info(
+                        f"Digital certificate for {number} was created with number {cert_number}"
+                    )
+                    self.set_result(number, "issued", certificate=cert_number)
+                else:
+                    self.set_result(
+                        number,
+                        "error",
+                        certificate=cert_number,
+                        message="Certificate could not be uploaded",
+                    )
+
+
+def submit_issue_job(items, user_uuid):
+    """
+    Queues a job issuing certificates for `items`, a list of dicts with the
+    individual `number` and the certificate form data, and returns the job.
+    """
+    job = CertificateJob(items, user_uuid)
+    now = time.time()
+    with JOBS_LOCK:
+        for job_id in list(JOBS):
+            finished = JOBS[job_id].finished
+            if finished is not None and now - finished > JOB_RETENTION:
+                del JOBS[job_id]
+        JOBS[job.id] = job
+    JOB_RUNNER.submit(job.run)
+    return job
+
+
+def get_job(job_id, user_uuid):
+    """
+    Returns the job `job_id` if it was submitted by the user `user_uuid`, or
+    if the user is an admin, otherwise `None`.
+    """
+    with JOBS_LOCK:
+        job = JOBS.get(job_id, None)
+    if job is None:
+        return None
+    if job.user_uuid != str(user_uuid):
+        user = da.fetch_user_info(user_uuid)
+        if user is None or not user.is_admin:
+            return None
+    return job
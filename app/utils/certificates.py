@@ -2,12 +2,16 @@
 PDF certificate handler
 """
 import datetime
+import hashlib
+import json
 import logging
+import os
+import threading
+from collections import OrderedDict
 from io import BytesIO
 from pathlib import Path
 
 import fitz
-import pdfrw
 import qrcode
 import utils.settings as settings
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
@@ -64,6 +68,90 @@ FORM_KEYS = {
     "IntygasPlats": "",  # Physical id (Only in cert?)
 }
 
+TEMPLATE_CACHE = {}
+TEMPLATE_CACHE_LOCK = threading.Lock()
+
+SIGNER = None
+VERIFIER = None
+SIGNING_LOCK = threading.Lock()
+
+
+def file_version(*paths):
+    """
+    Returns a value that changes whenever any of the files in `paths` is
+    modified or replaced (as done by the cert_reloader when rsyncing new
+    certificates into place).
+    """
+    version = []
+    for path in paths:
+        stat = os.stat(path)
+        version += [(stat.st_ino, stat.st_size, stat.st_mtime_ns)]
+    return tuple(version)
+
+
+class PreviewCache:
+    """
+    A least recently used cache of rendered certificate previews, capped to
+    `max_size` bytes in total.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached preview for `key`, or `None`.
+        """
+        with self.lock:
+            pdf_bytes = self.entries.get(key, None)
+            if pdf_bytes is not None:
+                self.entries.move_to_end(key)
+            return pdf_bytes
+
+    def put(self, key, pdf_bytes):
+        """
+        Caches `pdf_bytes` as `key`, evicting the least recently used previews
+        until the cache fits in `max_size`.
+        """
+        if len(pdf_bytes) > self.max_size:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = pdf_bytes
+            self.size += len(pdf_bytes)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+PREVIEW_CACHE = PreviewCache(settings.certs.preview_cache_size)
+
+
+def preview_key(data, *versions):
+    """
+    Returns a key identifying a preview rendered from the certificate `data`
+    with the template and settings given by `versions`.
+    """
+    digest = hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    )
+    for version in versions:
+        digest.update(repr(version).encode("utf-8"))
+    return digest.hexdigest()
+
 
 class QRHandler:  # pylint: disable=too-few-public-methods
     """
@@ -109,91 +197,122 @@ class CertificateGenerator:
         assert isinstance(form_keys, dict)
         self.form_keys = form_keys
 
-    def generate_certificate(self, form_data):
+    def generate_certificate(self, form_data, qr_code=None):
         """
-        Fills the PDF form with the data provided in form_data.
+        Fills the PDF form with the data provided in form_data, and adds the
+        qr code, if given, in the desired location.
         """
         logger.debug("Adding data to certificate...")
-        reader = pdfrw.PdfReader(self.form)
-        writer = pdfrw.PdfWriter(version="1.7", compress=False)
+        return get_certificate_template(self.form).render(
+            form_data, self.form_keys, qr_code
+        )
 
-        for page in reader.pages:
-            annotations = page["/Annots"]
-            if annotations is None:
+    def get_all_fields(self):
+        """
+        Utility for retrieving all annotations of the pdf.
+        """
+        logger.debug("Fetching keys of all fields...")
+        return list(get_certificate_template(self.form).fields)
+
+
+class CertificateTemplate:
+    """
+    A PDF form read into memory, with the form field widgets mapped by field
+    key.
+
+    Certificates are rendered from the template in a single open/save cycle,
+    filling the fields and adding the qr code on the same document.
+    """
+
+    def __init__(self, form, version):
+        assert isinstance(form, Path)
+        self.version = version
+        # The template is rewritten without object streams, as the signature
+        # can't be added to documents where objects from object streams have
+        # been updated.
+        with fitz.open(form) as file_handle:
+            self.data = file_handle.tobytes()
+
+        self.fields = {}
+        file_handle = fitz.open(stream=self.data, filetype="pdf")
+        for page in file_handle:
+            widgets = list(page.widgets())
+            if not widgets:
                 logger.debug("There are no annotations in this PDF")
                 continue
 
-            for annotation in annotations:
-                if annotation["/Subtype"] == "/Widget":
-                    if annotation["/T"]:
-                        key = annotation["/T"][1:-1]
-                        form_key = FORM_KEYS.get(key, None)
-                        if form_key:
-                            val = form_data.get(form_key, "")
-                            vals = self._encode_pdf_string(val)
-                            annotation.update(pdfrw.PdfDict(AP=vals, V=vals, Ff=1))
-
-        reader.Root.AcroForm.update(
-            pdfrw.PdfDict(NeedAppearances=pdfrw.PdfObject("true"))
-        )
-        buffered = BytesIO()
-        writer.write(buffered, reader)
-        return buffered
-
-    @staticmethod
-    def add_qrcode_to_certificate(pdf_bytes, qr_code):
+            for widget in widgets:
+                if widget.field_name:
+                    self.fields.setdefault(widget.field_name, []).append(widget.xref)
+
+        # The AcroForm dict is usually an indirect object, and fitz can't set
+        # keys through indirect references.
+        catalog = file_handle.pdf_catalog()
+        kind, value = file_handle.xref_get_key(catalog, "AcroForm")
+        if kind == "xref":
+            self.need_appearances = (int(value.split()[0]), "NeedAppearances")
+        else:
+            self.need_appearances = (catalog, "AcroForm/NeedAppearances")
+        file_handle.close()
+
+    def render(self, form_data, form_keys, qr_code=None):
         """
-        Adds the qr code to the PDF in the desired location.
+        Returns the PDF bytes of the form filled with the data in `form_data`,
+        where `form_keys` maps the PDF field keys to `form_data` keys, and with
+        `qr_code` added on the first page.
         """
-        logger.debug("Adding qrcode to PDF...")
-
         try:
-            file_handle = fitz.open(stream=pdf_bytes, filetype="pdf")
-            page = file_handle[0]
+            file_handle = fitz.open(stream=self.data, filetype="pdf")
         except BaseException:
             logger.debug("Failed to read PDF data")
             raise
 
-        page.insert_image(
-            fitz.Rect(
-                qr_code.qrcode_pos["x0"],
-                qr_code.qrcode_pos["y0"],
-                qr_code.qrcode_pos["x1"],
-                qr_code.qrcode_pos["y1"],
-            ),
-            stream=qr_code.bytes,
-            keep_proportion=True,
-            overlay=False,
-        )
+        # Only the field values are set, and the fields made read-only. As in
+        # the template, viewers generate the appearance streams.
+        for key, xrefs in self.fields.items():
+            form_key = form_keys.get(key, None)
+            if not form_key:
+                continue
+            value = fitz.get_pdf_str(str(form_data.get(form_key, None) or ""))
+            for xref in xrefs:
+                file_handle.xref_set_key(xref, "V", value)
+                file_handle.xref_set_key(xref, "AP", "null")
+                file_handle.xref_set_key(xref, "Ff", "1")
+        file_handle.xref_set_key(*self.need_appearances, "true")
+
+        if qr_code is not None:
+            logger.debug("Adding qrcode to PDF...")
+            file_handle[0].insert_image(
+                fitz.Rect(
+                    qr_code.qrcode_pos["x0"],
+                    qr_code.qrcode_pos["y0"],
+                    qr_code.qrcode_pos["x1"],
+                    qr_code.qrcode_pos["y1"],
+                ),
+                stream=qr_code.bytes,
+                keep_proportion=True,
+                overlay=False,
+            )
+
         buffered = BytesIO()
         file_handle.save(buffered)
+        file_handle.close()
         return buffered
 
-    def get_all_fields(self):
-        """
-        Utility for retrieving all annotations of the pdf.
-        """
-        logger.debug("Fetching keys of all fields...")
-        annots = []
-        reader = pdfrw.PdfReader(self.form)
-        for page in reader.pages:
-            annotations = page["/Annots"]
-            if annotations is None:
-                logger.debug("There are no field annotations in this PDF")
-                continue
-
-            for annotation in annotations:
-                if annotation["/Subtype"] == "/Widget":
-                    if annotation["/T"]:
-                        key = annotation["/T"][1:-1]
-                        annots.append(key)
-        return annots
 
-    @staticmethod
-    def _encode_pdf_string(value):
-        if value:
-            return pdfrw.objects.pdfstring.PdfString.encode(str(value))
-        return pdfrw.objects.pdfstring.PdfString.encode("")
+def get_certificate_template(form):
+    """
+    Returns the certificate template at `form`. The template is read once per
+    process, and again only if the file is modified.
+    """
+    version = os.stat(form).st_mtime_ns
+    with TEMPLATE_CACHE_LOCK:
+        template = TEMPLATE_CACHE.get(str(form), None)
+        if template is None or template.version != version:
+            logger.debug("Reading certificate template %s", form)
+            template = CertificateTemplate(form, version)
+            TEMPLATE_CACHE[str(form)] = template
+    return template
 
 
 class CertificateSigner:  # pylint: disable=too-few-public-methods
@@ -213,10 +332,14 @@ class CertificateSigner:  # pylint: disable=too-few-public-methods
         self.pkcs_key = private_key
         assert isinstance(private_key_pass, (bytes, type(None)))
         self.private_key_pass = private_key_pass
+        self.lock = threading.Lock()
+        self.version = None
+        self.material = None
 
     def sign_certificate(self, pdf_bytes):
         """
-        Signs a PDF using a pkcs certificate.
+        Signs a PDF using a pkcs certificate. Returns a new buffer with the
+        signed PDF, leaving `pdf_bytes` unchanged.
         """
         private_key, certificate = self._load_key_and_certificate()
         date = datetime.datetime.utcnow()
@@ -237,45 +360,65 @@ class CertificateSigner:  # pylint: disable=too-few-public-methods
             "signingdate": date,
             "reason": "Signerat för Gotlandskaninen",
         }
-        datau = pdf_bytes.getbuffer()
-        signature = cms.sign(
-            datau=datau,
-            udct=dct,
-            key=private_key,
-            cert=certificate,
-            othercerts=[],
-            algomd="sha256",
-        )
-
-        buffered = BytesIO()
-        buffered.write(datau)
+        with pdf_bytes.getbuffer() as datau:
+            signature = cms.sign(
+                datau=datau,
+                udct=dct,
+                key=private_key,
+                cert=certificate,
+                othercerts=[],
+                algomd="sha256",
+            )
+
+            buffered = BytesIO()
+            buffered.write(datau)
         buffered.write(signature)
 
         return buffered
 
     def _load_key_and_certificate(self):
-        with open(self.pkcs_ca, "rb") as ca_cert:
-            ca_data = ca_cert.read()
+        """
+        Returns the parsed private key and certificate, which are only read
+        from disk again when the files change.
+        """
+        version = file_version(self.pkcs_ca, self.pkcs_key)
+        with self.lock:
+            if self.version != version:
+                logger.debug("Loading signing key and certificate")
+                with open(self.pkcs_ca, "rb") as ca_cert:
+                    ca_data = ca_cert.read()
 
-        with open(self.pkcs_key, "rb") as key:
-            key_data = key.read()
+                with open(self.pkcs_key, "rb") as key:
+                    key_data = key.read()
 
-        private_key = load_pem_private_key(key_data, password=self.private_key_pass)
-        cert_auth = load_pem_x509_certificate(ca_data)
+                private_key = load_pem_private_key(
+                    key_data, password=self.private_key_pass
+                )
+                cert_auth = load_pem_x509_certificate(ca_data)
+                self.material = (private_key, cert_auth)
+                self.version = version
 
-        return private_key, cert_auth
+            return self.material
 
 
 def get_certificate_signer():
     """
-    Return a pdf verifier for the certificates
+    Return a pdf signer for the certificates. The signer is shared within the
+    process, and is replaced only if the configured certificate paths change.
     """
-    signer = CertificateSigner(
-        cert_auth=settings.certs.ca,
-        private_key=settings.certs.private_key,
-        private_key_pass=None,
-    )
-    return signer
+    global SIGNER  # pylint: disable=global-statement
+    with SIGNING_LOCK:
+        if (
+            SIGNER is None
+            or SIGNER.pkcs_ca != settings.certs.ca
+            or SIGNER.pkcs_key != settings.certs.private_key
+        ):
+            SIGNER = CertificateSigner(
+                cert_auth=settings.certs.ca,
+                private_key=settings.certs.private_key,
+                private_key_pass=None,
+            )
+        return SIGNER
 
 
 class CertificateVerifier:  # pylint: disable=too-few-public-methods
@@ -288,8 +431,23 @@ class CertificateVerifier:  # pylint: disable=too-few-public-methods
         pkcs_ca,
     ):
         assert isinstance(pkcs_ca, Path)
+        self.pkcs_ca = pkcs_ca
+        self.lock = threading.Lock()
+        self.version = file_version(pkcs_ca)
         self.trusted_ca = self._load_pkcs_ca(pkcs_ca)
 
+    def _refresh(self):
+        """
+        Reloads the trusted certificate authority if the file has changed.
+        """
+        version = file_version(self.pkcs_ca)
+        with self.lock:
+            if self.version != version:
+                logger.debug("Reloading certificate authority for verification")
+                self.trusted_ca = self._load_pkcs_ca(self.pkcs_ca)
+                self.version = version
+            return self.trusted_ca
+
     @staticmethod
     def _load_pkcs_ca(pkcs_ca):
         trusted_cert_pems = []
@@ -307,8 +465,9 @@ class CertificateVerifier:  # pylint: disable=too-few-public-methods
         Checks whether a signature is valid or not.
         """
         hash_ok, signature_ok, cert_ok = False, False, False
+        trusted_ca = self._refresh()
         try:
-            hash_ok, signature_ok, cert_ok = pdf.verify(pdf_bytes, self.trusted_ca)
+            hash_ok, signature_ok, cert_ok = pdf.verify(pdf_bytes, trusted_ca)
             assert all((hash_ok, signature_ok, cert_ok))
             logger.debug(f"PDF has a valid signatur {cert_ok}")
             return True
@@ -319,10 +478,13 @@ class CertificateVerifier:  # pylint: disable=too-few-public-methods
 
 def get_certificate_verifier():
     """
-    Return a pdf verifier for the certificates
+    Return a pdf verifier for the certificates. The verifier is shared within
+    the process, and is replaced only if the configured CA path changes.
     """
-
-    verifier = CertificateVerifier(
-        pkcs_ca=settings.certs.ca,
-    )
-    return verifier
+    global VERIFIER  # pylint: disable=global-statement
+    with SIGNING_LOCK:
+        if VERIFIER is None or VERIFIER.pkcs_ca != settings.certs.ca:
+            VERIFIER = CertificateVerifier(
+                pkcs_ca=settings.certs.ca,
+            )
+        return VERIFIER
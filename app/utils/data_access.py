@@ -5,7 +5,12 @@ database.
 
 # pylint: disable=too-many-lines
 
+import hashlib
+import hmac
 import logging
+import secrets
+import threading
+import time
 import uuid
 from datetime import date, datetime, timedelta
 
@@ -15,29 +20,55 @@ from peewee import (
     DoesNotExist,
     IntegrityError,
     PeeweeException,
+    Select,
+    Value,
     fn,
 )
 
 # pylint: disable=import-error
 
 from utils.database import DB_PROXY as DATABASE  # isort:skip
+from utils.database import LAST_ACTIVE  # isort: skip
 from utils.database import Authenticators  # isort: skip
 from utils.database import Bodyfat  # isort: skip
 from utils.database import Breeding  # isort: skip
+from utils.database import CertificateChecksum  # isort: skip
 from utils.database import Color  # isort: skip
 from utils.database import Genebank  # isort: skip
 from utils.database import Herd  # isort: skip
 from utils.database import HerdTracking  # isort: skip
 from utils.database import Individual  # isort: skip
+from utils.database import IndividualGenetics  # isort: skip
 from utils.database import User  # isort: skip
 from utils.database import Weight  # isort: skip
+from utils.database import bump_data_version  # isort: skip
+from utils.database import clear_role_cache  # isort: skip
 from utils.database import next_individual_number  # isort: skip
+from utils.database import on_primary  # isort: skip
+from utils.database import read_only  # isort: skip
+from utils.database import select_current_herds  # isort: skip
 import utils.s3 as s3  # isort:skip
 
 from werkzeug.security import check_password_hash, generate_password_hash  # isort:skip
 
 logger = logging.getLogger("herdbook.da")
 
+# Authenticators.auth value for API tokens.
+API_TOKEN_AUTH = "apitoken"
+
+# Successful basic auth verifications are remembered for a short while, keyed by
+# a salted digest of the credentials, so that machine clients that send their
+# password on each request don't pay for a password hash check every time.
+CREDENTIAL_CACHE_TTL = 60
+CREDENTIAL_CACHE_SIZE = 1024
+CREDENTIAL_CACHE_SALT = secrets.token_bytes(32)
+CREDENTIAL_CACHE = {}
+CREDENTIAL_CACHE_LOCK = threading.Lock()
+
+# Genetics results are stored, and individuals looked up, in batches of this
+# size.
+GENETICS_BATCH_SIZE = 500
+
 # Helper functions
 
 
@@ -154,6 +185,7 @@ def register_user(
         )
     with DATABASE.atomic():
         authenticator.save()
+    clear_credential_cache()
 
     return user
 
@@ -192,6 +224,156 @@ def authenticate_user(name, password):
     return None
 
 
+def _credential_digest(name, password):
+    """
+    Returns a salted digest of the credentials `name` and `password`.
+    """
+    if isinstance(name, bytes):
+        name = name.decode(errors="replace")
+    return hmac.new(
+        CREDENTIAL_CACHE_SALT,
+        f"{name}\0{password}".encode(),
+        hashlib.sha256,
+    ).digest()
+
+
+def clear_credential_cache():
+    """
+    Forgets all cached credential verifications.
+    """
+    with CREDENTIAL_CACHE_LOCK:
+        CREDENTIAL_CACHE.clear()
+
+
+def authenticate_user_cached(name, password):
+    """
+    Like `authenticate_user`, but successful verifications are cached for
+    `CREDENTIAL_CACHE_TTL` seconds.
+    """
+    if not name or not password:
+        return None
+    key = _credential_digest(name, password)
+    now = time.monotonic()
+    with CREDENTIAL_CACHE_LOCK:
+        cached = CREDENTIAL_CACHE.get(key)
+    if cached and cached[1] > now:
+        user = fetch_user_info(cached[0])
+        if user:
+            return user
+
+    user = authenticate_user(name, password)
+    if user:
+        with CREDENTIAL_CACHE_LOCK:
+            if len(CREDENTIAL_CACHE) >= CREDENTIAL_CACHE_SIZE:
+                for expired in [k for k, v in CREDENTIAL_CACHE.items() if v[1] <= now]:
+                    del CREDENTIAL_CACHE[expired]
+            if len(CREDENTIAL_CACHE) < CREDENTIAL_CACHE_SIZE:
+                CREDENTIAL_CACHE[key] = (user.uuid, now + CREDENTIAL_CACHE_TTL)
+    return user
+
+
+def _token_digest(token):
+    """
+    Returns the digest that is stored for the API token `token`.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_api_token(target, user_uuid=None, skip_role_check=False):
+    """
+    Creates a new API token for the user given by `target` (a user id, e-mail
+    or username), replacing any previous token, if the user identified by
+    `user_uuid` is an admin. Only a digest of the token is stored, so the
+    token can't be retrieved again later.
+
+    The response will be on the format:
+        JSON: {
+                status: 'created' | 'error',
+                message?: string,
+                data?: <token>
+            }
+
+    Optionally takes a flag to skip role verification for system use.
+    """
+    if not skip_role_check:
+        user = fetch_user_info(user_uuid)
+        if user is None or not user.is_admin:
+            return {"status": "error", "message": "forbidden"}
+
+    try:
+        with DATABASE.atomic():
+            if isinstance(target, int) or str(target).isdigit():
+                target_user = User.get(User.id == int(target))
+            else:
+                target_user = User.get(
+                    (User.email == target) | (User.username == target)
+                )
+    except DoesNotExist:
+        return {"status": "error", "message": "unknown user"}
+
+    token = secrets.token_urlsafe(32)
+    with DATABASE.atomic():
+        Authenticators.delete().where(
+            (Authenticators.user == target_user.id)
+            & (Authenticators.auth == API_TOKEN_AUTH)
+        ).execute()
+        Authenticators(
+            user=target_user.id, auth=API_TOKEN_AUTH, auth_data=_token_digest(token)
+        ).save()
+    logger.info("Created API token for user %s", target_user.username)
+    return {"status": "created", "data": token}
+
+
+def revoke_api_token(target, user_uuid=None):
+    """
+    Removes the API token of the user given by the user id `target`, if the
+    user identified by `user_uuid` is an admin.
+    """
+    user = fetch_user_info(user_uuid)
+    if user is None or not user.is_admin:
+        return {"status": "error", "message": "forbidden"}
+
+    with DATABASE.atomic():
+        removed = (
+            Authenticators.delete()
+            .where(
+                (Authenticators.user == target)
+                & (Authenticators.auth == API_TOKEN_AUTH)
+            )
+            .execute()
+        )
+    return {"status": "updated" if removed else "unchanged"}
+
+
+def authenticate_token(token):
+    """
+    Authenticates an API token. Returns the user info for the token owner on
+    success, or None on failure.
+
+    The token is looked up by its digest, so the lookup doesn't depend on how
+    much of a guessed token is correct.
+    """
+    if not token:
+        return None
+    digest = _token_digest(token)
+    try:
+        with DATABASE.atomic():
+            user_info = (
+                User.select()
+                .join(Authenticators, on=(Authenticators.user == User.id))
+                .where(
+                    (Authenticators.auth == API_TOKEN_AUTH)
+                    & (Authenticators.auth_data == digest)
+                )
+                .get()
+            )
+        return user_info
+    except DoesNotExist:
+        pass
+    logger.info("Failed login attempt with API token")
+    return None
+
+
 def change_password(active_user, changed_user, form):
     """
     Changes password for user changed_user. Returns
@@ -238,6 +420,7 @@ def change_password(active_user, changed_user, form):
         )
     with DATABASE.atomic():
         authenticator.save()
+    clear_credential_cache()
 
     return True
 
@@ -365,9 +548,11 @@ def linked_accounts(user):
     return None
 
 
+@on_primary
 def fetch_user_info(user_id):
     """
-    Fetches user information for a given user id.
+    Fetches user information for a given user id. The primary is always used,
+    as the privileges of the user are checked from it.
     """
     try:
         with DATABASE.atomic():
@@ -405,6 +590,7 @@ def get_active_users(minutes, user_uuid=None):
     """
     Returns a list of currently active users
 
+    Activity that is not yet written to the database is included as well.
     """
     user = fetch_user_info(user_uuid)
     time_ago = datetime.now() - timedelta(minutes=minutes)
@@ -412,15 +598,18 @@ def get_active_users(minutes, user_uuid=None):
         return {"status": "error", "message": "Not logged in"}
     if not (user.is_admin or user.is_manager):
         return {"status": "error", "message": "Forbidden"}
+    pending = LAST_ACTIVE.pending_since(time_ago)
     try:
-        active_users = User.select().where(User.last_active >= time_ago)
+        active_users = User.select().where(
+            (User.last_active >= time_ago) | (User.id.in_(list(pending)))
+        )
     except DoesNotExist:
         return None
     return [
         {
             "username": user.username,
             "fullname": user.fullname,
-            "last_active": user.last_active,
+            "last_active": pending.get(user.id, user.last_active),
         }
         for user in active_users
     ]
@@ -624,6 +813,7 @@ def update_role(operation, user_uuid=None, skip_role_check=False):
 # Genebank functions
 
 
+@read_only
 def get_colors():
     """
     Returns all legal colors for all genebanks, like:
@@ -687,6 +877,7 @@ def herd_to_herdid(lookup_herd):
         return herd.id
 
 
+@read_only
 def get_herd(herd_id, user_uuid=None):
     """
     Returns information on the herd given by `herd_id`, including a list of all
@@ -764,6 +955,8 @@ def update_herd(form, user_uuid):
                 if hasattr(herd, key):
                     setattr(herd, key, value)
             herd.save()
+        # Owner roles resolve to the genebank of the herd, which may have moved.
+        clear_role_cache()
         logger.info(f"User:{user.username} Updated herd: {herd.short_info()}")
         return {"status": "updated"}
     except DoesNotExist:
@@ -828,6 +1021,242 @@ def get_individual(individual_id, user_uuid=None):
         return None
 
 
+def get_pedigree(individual_number, user_uuid=None, depth=2):
+    """
+    Returns the ancestors of the individual `individual_number` up to `depth`
+    generations back, as a flat dict of prefixed fields.
+
+    Each ancestor is identified by the parent sides leading to it, so that `F`
+    and `M` are the father and mother, `MF` is the mother's father, `FM` the
+    father's mother, `MFF` the father of `MF`, and so on. The fields of each
+    ancestor are prefixed with its identifier, as in `MF_name`.
+
+    The fields are `id`, `number`, `name`, `sex`, `color`, `birth_date`,
+    `genebank_number` and `genebank_aki`. Ancestors that the user identified
+    by `user_uuid` doesn't have access to, and their ancestors, are left out.
+    """
+    user = fetch_user_info(user_uuid)
+    if user is None:
+        return {}
+
+    # Find the pedigree with a recursive query over the breeding parents.
+    pedigree = (
+        Individual.select(
+            Individual.id,
+            Value("").cast("text"),
+            Value(0),
+        )
+        .where(Individual.number == individual_number)
+        .cte("pedigree", recursive=True, columns=("id", "prefix", "depth"))
+    )
+    parents = (
+        Breeding.select(
+            Breeding.id.alias("breeding_id"),
+            Breeding.father.alias("parent_id"),
+            Value("F").alias("side"),
+        )
+        .union_all(
+            Breeding.select(
+                Breeding.id.alias("breeding_id"),
+                Breeding.mother.alias("parent_id"),
+                Value("M").alias("side"),
+            )
+        )
+        .alias("parents")
+    )
+    ancestors = (
+        Individual.select(
+            parents.c.parent_id,
+            pedigree.c.prefix.concat(parents.c.side),
+            pedigree.c.depth + 1,
+        )
+        .join(pedigree, on=(pedigree.c.id == Individual.id))
+        .join(
+            parents, on=(parents.c.breeding_id == Individual.breeding), src=Individual
+        )
+        .where((pedigree.c.depth < depth) & parents.c.parent_id.is_null(False))
+    )
+    pedigree = pedigree.union_all(ancestors)
+
+    query = (
+        select_current_herds(
+            Individual.id.in_(Select([pedigree], [pedigree.c.id])),
+            pedigree.c.prefix,
+            Individual.id,
+            Individual.number,
+            Individual.name,
+            Individual.sex,
+            Color.name.alias("color"),
+            Breeding.birth_date,
+        )
+        .join(pedigree, on=(pedigree.c.id == Individual.id), src=Individual)
+        .join(Color, JOIN.LEFT_OUTER, on=(Color.id == Individual.color), src=Individual)
+        .join(
+            Breeding,
+            JOIN.LEFT_OUTER,
+            on=(Breeding.id == Individual.breeding),
+            src=Individual,
+        )
+        .where(pedigree.c.depth > 0)
+        .order_by(fn.LENGTH(pedigree.c.prefix), pedigree.c.prefix)
+        .with_cte(pedigree)
+    )
+
+    fields = {}
+    accessible = {""}
+    for row in query.dicts():
+        prefix = row.pop("prefix")
+        # left out if the child or the ancestor itself isn't accessible
+        if prefix[:-1] not in accessible:
+            continue
+        if row.pop("genebank_id") not in user.accessible_genebanks:
+            continue
+        accessible.add(prefix)
+        row.pop("herd_id")
+        if row["birth_date"]:
+            row["birth_date"] = row["birth_date"].strftime("%Y-%m-%d")
+        genebank = row["number"].split("-")
+        row["genebank_number"] = genebank[0]
+        row["genebank_aki"] = genebank[1] if len(genebank) > 1 else None
+        for key, value in row.items():
+            fields[f"{prefix}_{key}"] = value
+    return fields
+
+
+def record_certificate_checksum(individual_number, checksum, size):
+    """
+    Records the sha256 `checksum` and `size` of the digital certificate of the
+    individual `individual_number`, replacing any earlier record. Returns
+    `False` if the individual doesn't exist.
+    """
+    try:
+        individual = Individual.get(Individual.number == individual_number)
+    except DoesNotExist:
+        return False
+
+    CertificateChecksum.insert(
+        individual=individual,
+        checksum=checksum,
+        size=size,
+        uploaded=datetime.now(),
+    ).on_conflict(
+        conflict_target=[CertificateChecksum.individual],
+        preserve=[
+            CertificateChecksum.checksum,
+            CertificateChecksum.size,
+            CertificateChecksum.uploaded,
+        ],
+    ).execute()
+    return True
+
+
+def get_certificate_checksum(individual_number):
+    """
+    Returns the recorded sha256 checksum of the digital certificate of the
+    individual `individual_number`, or `None` if there is no record.
+    """
+    return (
+        CertificateChecksum.select(CertificateChecksum.checksum)
+        .join(Individual)
+        .where(Individual.number == individual_number)
+        .scalar()
+    )
+
+
+def get_unchecksummed_certificates():
+    """
+    Returns the numbers of the individuals that have a digital certificate
+    without a recorded checksum.
+    """
+    query = (
+        Individual.select(Individual.number)
+        .join(CertificateChecksum, JOIN.LEFT_OUTER)
+        .where(
+            Individual.digital_certificate.is_null(False)
+            & CertificateChecksum.id.is_null()
+        )
+        .order_by(Individual.number)
+    )
+    return [individual.number for individual in query]
+
+
+def store_genetics(genebank_id, kind, values, data_version):
+    """
+    Replaces the stored `kind` genetics results of the genebank given by
+    `genebank_id` with `values`, a dict of results by individual number,
+    computed from the genebank data version `data_version`. Results of
+    unknown individuals are skipped. Returns the number of stored results.
+    """
+    numbers = list(values)
+    computed = datetime.now()
+    rows = []
+    for start in range(0, len(numbers), GENETICS_BATCH_SIZE):
+        query = Individual.select(Individual.id, Individual.number).where(
+            Individual.number.in_(numbers[start : start + GENETICS_BATCH_SIZE])
+        )
+        for individual in query:
+            rows += [
+                {
+                    "individual": individual.id,
+                    "genebank": genebank_id,
+                    "kind": kind,
+                    "value": values[individual.number],
+                    "data_version": data_version,
+                    "computed": computed,
+                }
+            ]
+
+    with DATABASE.atomic():
+        IndividualGenetics.delete().where(
+            (IndividualGenetics.genebank == genebank_id)
+            & (IndividualGenetics.kind == kind)
+        ).execute()
+        for start in range(0, len(rows), GENETICS_BATCH_SIZE):
+            IndividualGenetics.insert_many(
+                rows[start : start + GENETICS_BATCH_SIZE]
+            ).execute()
+    return len(rows)
+
+
+@read_only
+def get_individual_genetics(individual_number, genebank_id, kind):
+    """
+    Returns the stored `kind` genetics result of the individual
+    `individual_number`, the data version it was computed from and when it was
+    computed, as a tuple. The result is `None` if the individual has no stored
+    result, while other individuals of the genebank given by `genebank_id`
+    have. Returns `None` if no results are stored for the genebank.
+    """
+    stored = (
+        IndividualGenetics.select(
+            IndividualGenetics.value,
+            IndividualGenetics.data_version,
+            IndividualGenetics.computed,
+        )
+        .join(Individual)
+        .where(
+            (Individual.number == individual_number) & (IndividualGenetics.kind == kind)
+        )
+        .first()
+    )
+    if stored is not None:
+        return stored.value, stored.data_version, stored.computed
+
+    stored = (
+        IndividualGenetics.select(
+            IndividualGenetics.data_version, IndividualGenetics.computed
+        )
+        .where(
+            (IndividualGenetics.genebank == genebank_id)
+            & (IndividualGenetics.kind == kind)
+        )
+        .first()
+    )
+    if stored is None:
+        return None
+    return None, stored.data_version, stored.computed
+
+
 # Feel free to clean this up!
 # pylint: disable=too-many-branches
 def form_to_individual(form, user=None):
@@ -1032,6 +1461,7 @@ def add_individual(form, user_uuid):
         update_bodyfat(individual, form["bodyfat"], user.username)
 
     individual.save()
+    bump_data_version(herd, individual.origin_herd_id)
 
     try:
         update_herdtracking_values(
@@ -1247,6 +1677,7 @@ def update_individual(form, user_uuid):
                     raise exception
 
             individual.save()
+            bump_data_version(individual.current_herd, individual.origin_herd_id)
 
             # Move the certificate to the new number.
             if new_number and individual.digital_certificate:
@@ -1400,6 +1831,7 @@ def update_bodyfat(individual, bodyfat, username):
                     ).save()
 
 
+@read_only
 def get_individuals(genebank_id, user_uuid=None):
     """
     Returns all individuals for a given `genebank_id` that the user identified
@@ -1609,6 +2041,7 @@ def get_breeding_event(breed_id, user_uuid):
     return []
 
 
+@read_only
 def get_breeding_events(herd_id, user_uuid):
     """
     Returns a list of all breeding events given by `herd_id`.
@@ -1623,7 +2056,11 @@ def get_breeding_events(herd_id, user_uuid):
             return []
 
         with DATABASE.atomic():
-            query = Breeding.select().where(Breeding.breeding_herd_id == herd)
+            query = (
+                Breeding.select()
+                .where(Breeding.breeding_herd_id == herd)
+                .order_by(Breeding.id)
+            )
             return [b.as_dict() for b in query.iterator()]
     except DoesNotExist:
         logger.warning("Unknown herd %s", herd_id)
@@ -1631,6 +2068,7 @@ def get_breeding_events(herd_id, user_uuid):
     return []
 
 
+@read_only
 def get_breeding_events_with_ind(herd_id, user_uuid):
     """
     Returns a list of all breeding events given by `herd_id`
@@ -1688,6 +2126,7 @@ def get_breeding_events_with_ind(herd_id, user_uuid):
     return []
 
 
+@read_only
 def get_breeding_events_by_date(birth_date, user_uuid):
     """
     Returns a list of all breeding events in the system.
@@ -1779,6 +2218,7 @@ def register_breeding(form, user_uuid):
             breed_notes=form.get("notes", None),
         )
         breeding.save()
+        bump_data_version(breeding.breeding_herd_id_id)
         logger.info(f"User:{user.username} added breeding: {breeding.as_dict()}")
         return {"status": "success", "breeding_id": breeding.id}
 
@@ -1811,7 +2251,7 @@ def delete_breeding(id, user_uuid):
 
     # A user can insert a breeding event if they have permission to edit at
     # least one of the parents.
-    if not (user.can_edit(breeding.mother.number)):
+    if not user.can_edit(breeding.mother_id):
         return {"status": "error", "message": "Du har inte rätt behörighet"}
 
     errors = []
@@ -1836,6 +2276,7 @@ def delete_breeding(id, user_uuid):
     try:
         with DATABASE.atomic():
             Breeding.delete().where(Breeding.id == id).execute()
+            bump_data_version(breeding.breeding_herd_id_id)
             logger.info(
                 f"User:{user.username} deleted empty breeding: {breeding.as_dict()}"
             )
@@ -1878,9 +2319,7 @@ def register_birth(form, user_uuid):
 
     # A user can insert a breeding event if they have permission to edit at
     # least one of the parents.
-    if not (
-        user.can_edit(breeding.mother.number) or user.can_edit(breeding.father.number)
-    ):
+    if not any(user.can_edit_many([breeding.mother_id, breeding.father_id]).values()):
         return {"status": "error", "message": "Forbidden"}
 
     errors = []
@@ -1912,6 +2351,7 @@ def register_birth(form, user_uuid):
         breeding.litter_size6w = form.get("litter_size6w", None)
         breeding.birth_notes = form.get("notes", None)
         breeding.save()
+        bump_data_version(breeding.breeding_herd_id_id)
         logger.info(f"User:{user.username} added birth: {breeding.as_dict()}")
         return {"status": "success"}
 
@@ -1952,9 +2392,7 @@ def update_breeding(form, user_uuid):
 
     # A user can insert a breeding event if they have permission to edit at
     # least one of the parents.
-    if not (
-        user.can_edit(breeding.mother.number) or user.can_edit(breeding.father.number)
-    ):
+    if not any(user.can_edit_many([breeding.mother_id, breeding.father_id]).values()):
         return {"status": "error", "message": "Forbidden"}
     update_logger = logging.getLogger(
         f"{breeding.mother.current_herd.genebank.name}_update"
@@ -2039,6 +2477,7 @@ def update_breeding(form, user_uuid):
         breeding.breed_notes = form.get("breed_notes", breeding.breed_notes)
         breeding.litter_size6w = form.get("litter_size6w", breeding.litter_size6w)
         breeding.save()
+        bump_data_version(breeding.breeding_herd_id_id)
         return {"status": "success"}
 
 
@@ -4,17 +4,24 @@ Database handler for 'the herdbook'.
 """
 # pylint: disable=too-many-lines
 
+import functools
 import json
 import logging
 import re
 import sys
+import threading
+import time
 from datetime import datetime, timedelta
 
+import utils.instrumentation as instrumentation
 import utils.settings as settings
+import utils.slow_queries as slow_queries
 from flask_login import UserMixin
 from peewee import (
+    JOIN,
     AutoField,
     BooleanField,
+    Case,
     CharField,
     DateField,
     DateTimeField,
@@ -25,52 +32,423 @@ from peewee import (
     IntegerField,
     Model,
     OperationalError,
+    PeeweeException,
     PostgresqlDatabase,
     Proxy,
     Select,
+    SelectBase,
     SqliteDatabase,
     TextField,
     UUIDField,
+    chunked,
     fn,
 )
 from playhouse.migrate import PostgresqlMigrator, SqliteMigrator, migrate
+from playhouse.pool import (
+    MaxConnectionsExceeded,
+    PooledDatabase,
+    PooledPostgresqlDatabase,
+    PooledSqliteDatabase,
+)
+
+CURRENT_SCHEMA_VERSION = 16
+
+
+class ReplicaWriteError(PeeweeException):
+    """
+    Raised when a `read_only` data access function tries to write.
+    """
+
+
+# Statements that don't write, see `is_read_sql`
+READ_STATEMENTS = ("SELECT", "WITH", "EXPLAIN", "SHOW")
+
+
+def is_read_sql(sql):
+    """
+    Returns `True` if the raw `sql` statement only reads.
+    """
+    words = sql.split(None, 1)
+    return bool(words) and words[0].upper() in READ_STATEMENTS
+
 
-CURRENT_SCHEMA_VERSION = 11
-DB_PROXY = Proxy()
+class RoutingProxy(Proxy):
+    """
+    Database proxy that sends the select queries of `read_only` data access
+    functions to a read replica, if one is set, and all other queries to the
+    primary database. Other queries of `read_only` functions raise a
+    `ReplicaWriteError`. Writes through the proxy are recorded per thread, so
+    that a request that has written keeps reading from the primary.
+    """
+
+    __slots__ = ("obj", "_callbacks", "replica", "local")
+
+    def __init__(self):
+        super().__init__()
+        self.replica = None
+        self.local = threading.local()
+
+    def __getattr__(self, attr):
+        if attr == "execute":
+            return self._execute
+        if attr == "execute_sql":
+            return self._execute_sql
+        if self._use_replica():
+            return getattr(self.replica, attr)
+        if self.obj is None:
+            raise AttributeError("Cannot use uninitialized Proxy.")
+        return getattr(self.obj, attr)
+
+    def _use_replica(self):
+        return self.replica is not None and getattr(self.local, "use_replica", False)
+
+    def _execute(self, query, **kwargs):
+        read = isinstance(query, SelectBase)
+        if self._use_replica():
+            if not read:
+                raise ReplicaWriteError(f"Write in read only function: {query}")
+            return self.replica.execute(query, **kwargs)
+        if not read:
+            self.local.wrote = True
+        return self.obj.execute(query, **kwargs)
+
+    def _execute_sql(self, sql, *args, **kwargs):
+        read = is_read_sql(sql)
+        if self._use_replica():
+            if not read:
+                raise ReplicaWriteError(f"Write in read only function: {sql}")
+            return self.replica.execute_sql(sql, *args, **kwargs)
+        if not read:
+            self.local.wrote = True
+        return self.obj.execute_sql(sql, *args, **kwargs)
+
+
+DB_PROXY = RoutingProxy()
 DATABASE = None
+REPLICA = None
 DATABASE_MIGRATOR = None
 
+# Connection pool waits longer than this are logged, in seconds
+SLOW_POOL_WAIT = 1.0
+
+# Compiled user roles, keyed by user id. See `User.roles`.
+ROLE_CACHE = {}
+ROLE_CACHE_LOCK = threading.Lock()
+# The genebank and herd generation is read again after this many seconds
+ROLE_GENERATION_TTL = 5
+ROLE_GENERATION = {"value": None, "checked": None}
+
 logger = logging.getLogger("herdbook.db")
 
 
-def set_test_database(name):
+def clear_role_cache(user_id=None):
+    """
+    Drops the compiled roles of the user given by `user_id`, or of all users
+    if no `user_id` is given.
+    """
+    with ROLE_CACHE_LOCK:
+        if user_id is None:
+            ROLE_CACHE.clear()
+            ROLE_GENERATION["checked"] = None
+        else:
+            ROLE_CACHE.pop(user_id, None)
+
+
+def role_generation():
+    """
+    Returns the generation of the genebanks and herds, which changes when one
+    is added or removed, also by another process such as `insert_data`. Roles
+    resolve herds and genebanks, so roles compiled for another generation are
+    compiled again. The generation is read at most every
+    `ROLE_GENERATION_TTL` seconds.
+    """
+    now = time.monotonic()
+    with ROLE_CACHE_LOCK:
+        checked = ROLE_GENERATION["checked"]
+        if checked is not None and now - checked < ROLE_GENERATION_TTL:
+            return ROLE_GENERATION["value"]
+    genebanks = Genebank.select(fn.COUNT(Genebank.id), fn.MAX(Genebank.id))
+    herds = Herd.select(fn.COUNT(Herd.id), fn.MAX(Herd.id))
+    value = genebanks.tuples().get() + herds.tuples().get()
+    with ROLE_CACHE_LOCK:
+        ROLE_GENERATION["value"] = value
+        ROLE_GENERATION["checked"] = now
+    return value
+
+
+class PoolStatsMixin:
+    """
+    Records how long connections take to check out from the connection pool
+    of a pooled database, and how many checkouts time out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def connect(self, reuse_if_open=False):
+        """
+        Checks out a connection from the pool for the calling thread.
+        """
+        if reuse_if_open and not self.is_closed():
+            return False
+        start = time.monotonic()
+        try:
+            connected = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            with self.stats_lock:
+                self.timeouts += 1
+            logger.error("Timed out waiting for a database connection")
+            raise
+        waited = time.monotonic() - start
+        with self.stats_lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        if waited > SLOW_POOL_WAIT:
+            logger.warning("Waited %.2f s for a database connection", waited)
+        return connected
+
+    def pool_stats(self):
+        """
+        Returns the usage statistics of the pool as a dict.
+        """
+        with self.stats_lock:
+            return {
+                "max_connections": self._max_connections,
+                "in_use": len(self._in_use),
+                "idle": len(self._connections),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+            }
+
+
+class QueryStatsMixin:
+    """
+    Records the number and time of the queries run while serving a request,
+    see `utils.instrumentation`, and logs slow queries, see
+    `utils.slow_queries`.
+    """
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        """
+        Runs and times a query.
+        """
+        start = time.perf_counter()
+        try:
+            cursor = super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            instrumentation.record_query(elapsed)
+        threshold = settings.postgres.slow_query_threshold
+        if threshold and elapsed >= threshold:
+            slow_queries.SLOW_QUERY_LOG.record(
+                sql, params, elapsed, functools.partial(self.explain, sql, params)
+            )
+        return cursor
+
+    def explain(self, sql, params=None):
+        """
+        Returns the query plan of the select query `sql` as a list of lines,
+        or `None` if it isn't a select query. Other statements aren't
+        explained, as a failing EXPLAIN would abort the transaction on
+        postgres.
+        """
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            return None
+        if isinstance(self, SqliteDatabase):
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            prefix = "EXPLAIN "
+        try:
+            cursor = super().execute_sql(prefix + sql, params)
+            return [str(row[-1]) for row in cursor.fetchall()]
+        except PeeweeException as error:
+            logger.warning("Could not explain slow query: %s", error)
+            return None
+
+
+class InstrumentedSqliteDatabase(QueryStatsMixin, SqliteDatabase):
+    """
+    Sqlite3 database with query statistics, used for testing.
+    """
+
+
+class InstrumentedPostgresqlDatabase(QueryStatsMixin, PostgresqlDatabase):
+    """
+    Postgres database with query statistics.
+    """
+
+
+class InstrumentedPooledPostgresqlDatabase(
+    QueryStatsMixin, PoolStatsMixin, PooledPostgresqlDatabase
+):
+    """
+    Pooled postgres database with query and pool statistics.
+    """
+
+
+class InstrumentedPooledSqliteDatabase(
+    QueryStatsMixin, PoolStatsMixin, PooledSqliteDatabase
+):
+    """
+    Pooled sqlite3 database with query and pool statistics, used to test
+    pooling.
+    """
+
+
+def set_replica(database):
+    """
+    Sets `database` as the read replica, or removes the replica if `database`
+    is `None`.
+    """
+    global REPLICA  # pylint: disable=global-statement
+    if REPLICA is not None and not REPLICA.is_closed():
+        REPLICA.close()
+    REPLICA = database
+    DB_PROXY.replica = database
+
+
+def set_test_database(name, max_connections=0, replica=None):
     """
     This function sets the database to a named sqlite3 database for testing.
+    If `max_connections` is given, a connection pool of that size is used. If
+    `replica` is given, the named sqlite3 database is used as read replica.
     """
     global DATABASE, DATABASE_MIGRATOR  # pylint: disable=global-statement
-    DATABASE = SqliteDatabase(name)
+    if max_connections:
+        DATABASE = InstrumentedPooledSqliteDatabase(
+            name, max_connections=max_connections, timeout=1
+        )
+    else:
+        DATABASE = InstrumentedSqliteDatabase(name)
 
     # Assume Sqlite to be connected always.
     DB_PROXY.initialize(DATABASE)
+    set_replica(InstrumentedSqliteDatabase(replica) if replica else None)
+    clear_role_cache()
 
     DATABASE_MIGRATOR = SqliteMigrator(DATABASE)
 
 
-def set_database(name, host=None, port=None, user=None, password=None):
+# pylint: disable=too-many-arguments
+def set_database(
+    name,
+    host=None,
+    port=None,
+    user=None,
+    password=None,
+    max_connections=0,
+    stale_timeout=None,
+    pool_timeout=None,
+    replica_host=None,
+    replica_port=None,
+):
     """
     This function makes it possible to set the database manually when settings
-    aren't loaded.
+    aren't loaded. If `max_connections` is given, connections are pooled, and
+    pooled connections older than `stale_timeout` seconds are reconnected.
+    Checkouts from a full pool wait up to `pool_timeout` seconds. If
+    `replica_host` is given, the database there is used as read replica.
     """
     global DATABASE, DATABASE_MIGRATOR  # pylint: disable=global-statement
-    DATABASE = PostgresqlDatabase(
-        name, host=host, port=port, user=user, password=password
-    )
+
+    def create(host, port):
+        if max_connections:
+            return InstrumentedPooledPostgresqlDatabase(
+                name,
+                host=host,
+                port=port,
+                user=user,
+                password=password,
+                max_connections=max_connections,
+                stale_timeout=stale_timeout,
+                timeout=pool_timeout,
+            )
+        return InstrumentedPostgresqlDatabase(
+            name, host=host, port=port, user=user, password=password
+        )
+
+    DATABASE = create(host, port)
 
     DB_PROXY.initialize(DATABASE)
+    set_replica(create(replica_host, replica_port) if replica_host else None)
+    clear_role_cache()
 
     DATABASE_MIGRATOR = PostgresqlMigrator(DATABASE)
 
 
+def read_only(func):
+    """
+    Decorator for data access functions that only read, sending their queries
+    to the read replica. The primary is used instead if there is no replica,
+    if the current request has written or belongs to a session that has
+    recently written (see `start_request`), or if a transaction is open.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        local = DB_PROXY.local
+        if (
+            REPLICA is None
+            or getattr(local, "use_replica", False)
+            or getattr(local, "pinned", False)
+            or getattr(local, "wrote", False)
+            or DATABASE.in_transaction()
+        ):
+            return func(*args, **kwargs)
+        local.use_replica = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.use_replica = False
+
+    return wrapper
+
+
+def on_primary(func):
+    """
+    Decorator for data access functions that must read from the primary, such
+    as authorization lookups, as a lagging replica could still grant revoked
+    privileges. They may be called from `read_only` functions.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        local = DB_PROXY.local
+        use_replica = getattr(local, "use_replica", False)
+        local.use_replica = False
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.use_replica = use_replica
+
+    return wrapper
+
+
+def start_request(pinned=False):
+    """
+    Resets the routing state of the current thread at the start of a request.
+    If `pinned` is set, all queries of the request go to the primary.
+    """
+    DB_PROXY.local.use_replica = False
+    DB_PROXY.local.wrote = False
+    DB_PROXY.local.pinned = pinned
+
+
+def request_wrote():
+    """
+    Returns whether the current request has written to the primary.
+    """
+    return getattr(DB_PROXY.local, "wrote", False)
+
+
 if "pytest" in sys.modules or "unittest" in sys.modules:
     logger.info("No settings for database, using test database")
     set_test_database("herdbook")
@@ -83,6 +461,11 @@ else:
         settings.postgres.port,
         settings.postgres.user,
         settings.postgres.password,
+        settings.postgres.max_connections,
+        settings.postgres.stale_timeout,
+        settings.postgres.pool_timeout,
+        settings.postgres.replica_host,
+        settings.postgres.replica_port,
     )
 
 
@@ -106,6 +489,40 @@ def disconnect():
         DATABASE.close()
 
 
+def is_pooled():
+    """
+    Returns whether the database connections are pooled.
+    """
+    return isinstance(DATABASE, PooledDatabase)
+
+
+def pool_stats():
+    """
+    Returns the usage statistics of the connection pool, or `None` if the
+    database isn't pooled.
+    """
+    if not isinstance(DATABASE, PoolStatsMixin):
+        return None
+    return DATABASE.pool_stats()
+
+
+def open_request_connection():
+    """
+    Checks out a pooled connection for the current request.
+    """
+    if is_pooled():
+        DATABASE.connect(reuse_if_open=True)
+
+
+def close_request_connection():
+    """
+    Returns the pooled connections of the current request to the pool.
+    """
+    for database in (DATABASE, REPLICA):
+        if isinstance(database, PooledDatabase) and not database.is_closed():
+            database.close()
+
+
 def is_connected():
     """
     Wrapper around `DATABASE.is_connection_usable()`.
@@ -147,10 +564,14 @@ class Genebank(BaseModel):
 
     This table keep tracks of the names of genebanks.
     A genebank is comprised of several herds of animals.
+
+    The data version is increased when the individuals or breedings of the
+    genebank change, see `bump_data_version`.
     """
 
     id = AutoField(primary_key=True, column_name="genebank_id")
     name = CharField(100, unique=True)
+    data_version = IntegerField(default=0)
 
     def short_info(self):
         """
@@ -409,10 +830,49 @@ class Breeding(BaseModel):
 
     class Meta:  # pylint: disable=too-few-public-methods
         """
-        Add a unique index to mother+father+birth_date
+        Add a unique index to mother+father+birth_date, and an index for the
+        breedings of a herd by date.
         """
 
-        indexes = ((("mother", "father", "birth_date"), True),)
+        indexes = (
+            (("mother", "father", "birth_date"), True),
+            (("breeding_herd_id", "birth_date"), False),
+        )
+
+
+# Functions called without arguments when a genebank data version is bumped
+DATA_VERSION_LISTENERS = []
+
+
+def bump_data_version(*herds):
+    """
+    Increases the data versions of the genebanks of `herds`, given as herds or
+    herd ids, so that genetics results computed from the old data are
+    refreshed, and calls the `DATA_VERSION_LISTENERS`. Each genebank is only
+    bumped once, also if several of the herds are in it.
+    """
+    herd_ids = [getattr(herd, "id", herd) for herd in herds]
+    Genebank.update(data_version=Genebank.data_version + 1).where(
+        Genebank.id.in_(Herd.select(Herd.genebank).where(Herd.id.in_(herd_ids)))
+    ).execute()
+    for listener in DATA_VERSION_LISTENERS:
+        listener()
+
+
+def get_data_version(genebank_id):
+    """
+    Returns the data version of the genebank given by `genebank_id`, or
+    `None` if there is no such genebank.
+    """
+    try:
+        genebank_id = int(genebank_id)
+    except (TypeError, ValueError):
+        return None
+    return (
+        Genebank.select(Genebank.data_version)
+        .where(Genebank.id == genebank_id)
+        .scalar()
+    )
 
 
 def next_individual_number(herd, birth_date, breeding_event):
@@ -595,6 +1055,7 @@ class Individual(BaseModel):
                 HerdTracking.select()
                 .where(HerdTracking.individual == self.id)
                 .order_by(HerdTracking.herd_tracking_date.desc())
+                .limit(1)
             ).execute()
 
             if len(ht_history):
@@ -843,6 +1304,73 @@ class Bodyfat(BaseModel):
     bodyfat_date = DateField()
 
 
+class UserRoles:  # pylint: disable=too-few-public-methods
+    """
+    The roles of a user compiled into plain id lists, so that permission
+    checks don't have to parse the privileges or look up herds.
+
+    `version` is the raw privileges string that the roles were compiled from,
+    and the genebank and herd generation they were compiled for.
+    """
+
+    def __init__(self, privileges, version):
+        self.version = version
+        self.is_admin = False
+        self.managed_genebanks = []
+        self.viewed_genebanks = []
+        self.owned_herd_ids = []
+        for role in privileges:
+            if role["level"] == "admin":
+                self.is_admin = True
+            elif role["level"] == "manager":
+                self.managed_genebanks += [role["genebank"]]
+            elif role["level"] == "viewer":
+                self.viewed_genebanks += [role["genebank"]]
+            elif role["level"] == "owner":
+                self.owned_herd_ids += [role["herd"]]
+
+        # Resolve the owned herds, and all genebanks for admins, in one query.
+        herds = {}
+        genebanks = []
+        if self.is_admin or self.owned_herd_ids:
+            query = (
+                Genebank.select(
+                    Genebank.id.alias("genebank_id"),
+                    Herd.id.alias("herd_id"),
+                    Herd.herd,
+                )
+                .join(
+                    Herd,
+                    JOIN.LEFT_OUTER,
+                    on=(
+                        (Herd.genebank == Genebank.id)
+                        & Herd.id.in_(self.owned_herd_ids)
+                    ),
+                )
+                .order_by(Genebank.id)
+            )
+            if not self.is_admin:
+                query = query.where(Herd.id.is_null(False))
+            for row in query.dicts():
+                if row["genebank_id"] not in genebanks:
+                    genebanks += [row["genebank_id"]]
+                if row["herd_id"] is not None:
+                    herds[row["herd_id"]] = (row["herd"], row["genebank_id"])
+
+        self.owned_herds = [
+            herds[h_id][0] for h_id in self.owned_herd_ids if h_id in herds
+        ]
+        if self.is_admin:
+            self.accessible_genebanks = genebanks
+        else:
+            self.accessible_genebanks = []
+            for role in privileges:
+                if role["level"] in ["viewer", "manager"]:
+                    self.accessible_genebanks += [role["genebank"]]
+                elif role["level"] == "owner" and role["herd"] in herds:
+                    self.accessible_genebanks += [herds[role["herd"]][1]]
+
+
 class User(BaseModel, UserMixin):
     """
     Table keeping track of system users.
@@ -852,14 +1380,18 @@ class User(BaseModel, UserMixin):
     username = TextField(unique=True, null=True)
     email = TextField()
     fullname = TextField(null=True)
-    uuid = UUIDField()
+    uuid = UUIDField(index=True)
     validated = BooleanField(default=False)
     _privileges = TextField(column_name="privileges", default="[]")
     last_active = DateTimeField(default=datetime.now)
 
     def update_last_active(self):
+        """
+        Marks the user as active now. The timestamp is written to the database
+        in batches by `LAST_ACTIVE.flush()`.
+        """
         self.last_active = datetime.now()
-        self.save()
+        LAST_ACTIVE.touch(self.id, self.last_active)
 
     @property
     def privileges(self):
@@ -917,6 +1449,7 @@ class User(BaseModel, UserMixin):
         privs += [role]
         self.privileges = privs
         self.save()
+        clear_role_cache(self.id)
 
     def has_role(self, level, target_id=None):
         """
@@ -962,6 +1495,26 @@ class User(BaseModel, UserMixin):
             new_privs += [role]
         self.privileges = new_privs
         self.save()
+        clear_role_cache(self.id)
+
+    @property
+    def roles(self):
+        """
+        Returns the `UserRoles` compiled from the user privileges.
+
+        The compiled roles are cached per user and privilege version, so the
+        herd and genebank lookups are only done when the privileges, or the
+        genebanks and herds, change.
+        """
+        version = (self._privileges, role_generation())
+        with ROLE_CACHE_LOCK:
+            roles = ROLE_CACHE.get(self.id)
+        if roles is None or roles.version != version:
+            roles = UserRoles(self.privileges, version)
+            if self.id is not None:
+                with ROLE_CACHE_LOCK:
+                    ROLE_CACHE[self.id] = roles
+        return roles
 
     @property
     def is_admin(self):
@@ -969,7 +1522,7 @@ class User(BaseModel, UserMixin):
         Returns `True` if the admin permission is in the user privileges, false
         otherwise.
         """
-        return "admin" in [p["level"] for p in self.privileges]
+        return self.roles.is_admin
 
     @property
     def is_manager(self):
@@ -977,11 +1530,7 @@ class User(BaseModel, UserMixin):
         Returns a list of id's of the genebanks that the user is manager of, or
         `None`.
         """
-        genebanks = []
-        for role in self.privileges:
-            if role["level"] == "manager":
-                genebanks += [role["genebank"]]
-        return genebanks or None
+        return list(self.roles.managed_genebanks) or None
 
     @property
     def is_owner(self):
@@ -989,27 +1538,14 @@ class User(BaseModel, UserMixin):
         Returns a list of id's of the herds that the user is owner of, or
         `None`.
         """
-        herds = []
-        for role in self.privileges:
-            if role["level"] == "owner":
-                herds += [Herd.get(role["herd"]).herd]
-        return herds or None
+        return list(self.roles.owned_herds) or None
 
     @property
     def accessible_genebanks(self):
         """
         Returns a list of all genebank id's that the user has access to.
         """
-        if self.is_admin:
-            return [g.id for g in Genebank(database=DATABASE).select()]
-        has_access = []
-        for role in self.privileges:
-            if role["level"] in ["viewer", "manager"]:
-                has_access += [role["genebank"]]
-            elif role["level"] == "owner":
-                herd = Herd.get(role["herd"])
-                has_access += [herd.genebank.id]
-        return has_access
+        return list(self.roles.accessible_genebanks)
 
     def frontend_data(self):
         """
@@ -1070,61 +1606,85 @@ class User(BaseModel, UserMixin):
         `^(([GM]X1)|[a-zA-Z][0-9]+)$`: herd
         and genebank otherwise.
         """
+        return self.can_edit_many([identifier])[identifier]
+
+    def can_edit_many(self, identifiers):
+        """
+        Batch version of `can_edit`. Returns a dict mapping each of the given
+        `identifiers` to `true` if the user is allowed to edit that item.
+
+        Individuals, herds and genebanks are resolved with (at most) one query
+        each, regardless of the number of identifiers.
+        """
+        roles = self.roles
         # admins can edit anything
-        if self.is_admin:
-            return True
+        if roles.is_admin:
+            return {identifier: True for identifier in identifiers}
+
+        individual_ids = []
+        individual_numbers = []
+        herd_names = []
+        genebank_names = []
+        for identifier in identifiers:
+            if identifier is None:
+                continue
+            if isinstance(identifier, int):
+                individual_ids += [identifier]
+            elif re.match("^([a-zA-Z][0-9]+-[0-9]+)$", identifier):
+                individual_numbers += [identifier]
+            elif re.match("^(([GM]X1)|[a-zA-Z][0-9]+)$", identifier):
+                herd_names += [identifier]
+            else:
+                genebank_names += [identifier]
 
-        if isinstance(identifier, int):
-            try:
-                with DATABASE.atomic():
-                    individual = Individual.get(Individual.id == identifier)
-                    if (
-                        self.is_owner
-                        and individual.current_herd.herd in self.is_owner
-                        or self.is_manager
-                        and individual.current_herd.genebank_id in self.is_manager
-                    ):
-                        return True
-            except DoesNotExist:
-                pass
+        def editable(herd_id, genebank_id):
+            return (
+                herd_id in roles.owned_herd_ids
+                or genebank_id in roles.managed_genebanks
+            )
 
-        elif re.match("^([a-zA-Z][0-9]+-[0-9]+)$", identifier):
-            try:
-                with DATABASE.atomic():
-                    individual = Individual.get(Individual.number == identifier)
-                    if (
-                        self.is_owner
-                        and individual.current_herd.herd in self.is_owner
-                        or self.is_manager
-                        and individual.current_herd.genebank_id in self.is_manager
-                    ):
-                        return True
-            except DoesNotExist:
-                pass
+        editable_individuals = set()
+        editable_herds = set()
+        editable_genebanks = set()
+
+        # Users without any edit roles can't edit anything, so there's no need
+        # to look anything up.
+        if roles.owned_herd_ids or roles.managed_genebanks:
+            if individual_ids or individual_numbers:
+                query = select_current_herds(
+                    Individual.id.in_(individual_ids)
+                    | Individual.number.in_(individual_numbers),
+                    Individual.id,
+                    Individual.number,
+                )
+                for row in query.dicts():
+                    if editable(row["herd_id"], row["genebank_id"]):
+                        editable_individuals.update([row["id"], row["number"]])
 
-        elif re.match("^(([GM]X1)|[a-zA-Z][0-9]+)$", identifier):
-            try:
-                with DATABASE.atomic():
-                    herd = Herd.get(Herd.herd == identifier)
-                    if (
-                        self.is_owner
-                        and herd.herd in self.is_owner
-                        or self.is_manager
-                        and herd.genebank_id in self.is_manager
-                    ):
-                        return True
-            except DoesNotExist:
-                pass
-        else:
-            try:
-                with DATABASE.atomic():
-                    genebank = Genebank.get(Genebank.name == identifier)
-                    if self.is_manager and genebank.id in self.is_manager:
-                        return True
-            except DoesNotExist:
-                pass
+            if herd_names:
+                query = Herd.select(Herd.id, Herd.herd, Herd.genebank).where(
+                    Herd.herd.in_(herd_names)
+                )
+                for herd in query:
+                    if editable(herd.id, herd.genebank_id):
+                        editable_herds.add(herd.herd)
 
-        return False
+            if genebank_names and roles.managed_genebanks:
+                query = Genebank.select(Genebank.id, Genebank.name).where(
+                    Genebank.name.in_(genebank_names)
+                )
+                for genebank in query:
+                    if genebank.id in roles.managed_genebanks:
+                        editable_genebanks.add(genebank.name)
+
+        result = {}
+        for identifier in identifiers:
+            result[identifier] = (
+                identifier in editable_individuals
+                or identifier in editable_herds
+                or identifier in editable_genebanks
+            )
+        return result
 
     class Meta:  # pylint: disable=too-few-public-methods
         """
@@ -1136,6 +1696,108 @@ class User(BaseModel, UserMixin):
         table_name = "hbuser"
 
 
+def select_current_herds(selected, *fields):
+    """
+    Returns a query selecting `fields` of the individuals matching `selected`,
+    joined with their current `Herd`, and with the `herd_id` and `genebank_id`
+    of the current herd added to the selected fields.
+
+    The current herd is found the same way as `Individual.current_herd`, by
+    ranking the herdtracking values of the individuals by date, and falling
+    back to the origin herd if there are none, but for all individuals at once.
+    """
+    tracking = (
+        HerdTracking.select(
+            HerdTracking.individual.alias("i_id"),
+            HerdTracking.herd.alias("herd_id"),
+            fn.ROW_NUMBER()
+            .over(
+                order_by=[
+                    HerdTracking.herd_tracking_date.desc(),
+                    HerdTracking.id.desc(),
+                ],
+                partition_by=[HerdTracking.individual],
+            )
+            .alias("rank"),
+        )
+        .join(Individual, on=(HerdTracking.individual == Individual.id))
+        .where(selected)
+    )
+    return (
+        Individual.select(
+            *fields,
+            Herd.id.alias("herd_id"),
+            Herd.genebank.alias("genebank_id"),
+        )
+        .join(
+            tracking,
+            JOIN.LEFT_OUTER,
+            on=((tracking.c.i_id == Individual.id) & (tracking.c.rank == 1)),
+        )
+        .join(
+            Herd,
+            on=(Herd.id == fn.COALESCE(tracking.c.herd_id, Individual.origin_herd)),
+        )
+        .where(selected)
+    )
+
+
+class LastActiveTracker:
+    """
+    Keeps track of when users were last active in memory, so that requests
+    don't need to write to the user table. The collected timestamps are
+    written with a single bulk UPDATE by `flush()`, which is called
+    periodically by the server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def touch(self, user_id, when=None):
+        """
+        Records that the user given by `user_id` was active at `when`, or now.
+        """
+        when = when or datetime.now()
+        with self.lock:
+            if self.pending.get(user_id, when) <= when:
+                self.pending[user_id] = when
+
+    def pending_since(self, since):
+        """
+        Returns a dict of user id's and timestamps that are not yet written to
+        the database and newer than `since`.
+        """
+        with self.lock:
+            return {u_id: t for u_id, t in self.pending.items() if t >= since}
+
+    def flush(self):
+        """
+        Writes all pending timestamps to the database, and returns the number
+        of updated users.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+
+        try:
+            with DATABASE.atomic():
+                User.update(last_active=Case(User.id, list(pending.items()))).where(
+                    User.id.in_(list(pending))
+                ).execute()
+        except PeeweeException as exception:
+            logger.error("Could not update last active times: %s", exception)
+            # keep the timestamps for the next flush, unless there are newer
+            for user_id, when in pending.items():
+                self.touch(user_id, when)
+            return 0
+        return len(pending)
+
+
+LAST_ACTIVE = LastActiveTracker()
+
+
 class UserMessage(BaseModel):
     """
     Table storing messages to be displayed to users.
@@ -1203,10 +1865,12 @@ class HerdTracking(BaseModel):
         """
         The Meta class is read automatically for Model information, and is used
         here to set the table name, as the table name is in snake case, which
-        didn't fit the camel case class names.
+        didn't fit the camel case class names. The index is used to find the
+        latest herd of an individual.
         """
 
         table_name = "herd_tracking"
+        indexes = ((("individual", "herd_tracking_date"), False),)
 
 
 class Authenticators(BaseModel):
@@ -1220,6 +1884,61 @@ class Authenticators(BaseModel):
     auth_data = TextField(null=True)
 
 
+class CertificateChecksum(BaseModel):
+    """
+    Checksums of the digital certificates stored in S3, recorded on upload so
+    that certificates can be verified without downloading the stored copy.
+    """
+
+    id = AutoField(primary_key=True, column_name="certificate_checksum_id")
+    individual = ForeignKeyField(Individual, unique=True)
+    checksum = CharField(64)
+    size = IntegerField()
+    uploaded = DateTimeField(default=datetime.now)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """
+        The Meta class is read automatically for Model information, and is used
+        here to set the table name, as the table name is in snake case, which
+        didn't fit the camel case class names.
+        """
+
+        table_name = "certificate_checksum"
+
+
+class IndividualGenetics(BaseModel):
+    """
+    Per individual genetics results of the R-API, such as the inbreeding
+    coefficient or the mean kinship. They are stored whenever the results of
+    a genebank are fetched, so that the results of a single individual can be
+    read without fetching those of the whole genebank. `data_version` is the
+    genebank data version the results were computed from, and `computed` is
+    when they were fetched.
+    """
+
+    id = AutoField(primary_key=True, column_name="individual_genetics_id")
+    individual = ForeignKeyField(Individual)
+    genebank = ForeignKeyField(Genebank)
+    kind = CharField(20)
+    value = FloatField()
+    data_version = IntegerField(null=True)
+    computed = DateTimeField(null=True)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """
+        The Meta class is read automatically for Model information, and is used
+        here to set the table name, as the table name is in snake case, which
+        didn't fit the camel case class names. The indexes are used to look up
+        the results of an individual, and to replace those of a genebank.
+        """
+
+        table_name = "individual_genetics"
+        indexes = (
+            (("individual", "kind"), True),
+            (("genebank", "kind"), False),
+        )
+
+
 class SchemaHistory(BaseModel):
     """
     Contains schema migration history for the database.
@@ -1247,11 +1966,203 @@ MODELS = [
     GenebankReport,
     HerdTracking,
     Authenticators,
+    CertificateChecksum,
+    IndividualGenetics,
     SchemaHistory,
 ]
 
 
-def insert_data(filename="default_data.json"):
+# Rows inserted per statement by insert_data
+INSERT_CHUNK_SIZE = 1000
+
+# Foreign keys between breedings and individuals, which reference each other,
+# so insert_data sets them once both are loaded
+DEFERRED_FOREIGN_KEYS = {
+    "Breeding": ("father", "mother"),
+    "Individual": ("breeding",),
+}
+
+
+class JsonStream:
+    """
+    Reads json values one at a time from the file `infile`, so that large
+    files don't have to be read into memory. Only objects, arrays and strings
+    can be read with `value`, as a number at the end of the buffer may be
+    incomplete.
+    """
+
+    def __init__(self, infile, read_size=65536):
+        self.infile = infile
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Reads more of the file into the buffer, and returns `False` at the end
+        of the file.
+        """
+        chunk = self.infile.read(self.read_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace, and returns the next character, or "" at the end of
+        the file.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, chars):
+        """
+        Reads the next character, which must be one of `chars`, and returns it.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of '{chars}' but found '{char}'")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Reads the next json value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def rows(self):
+        """
+        Yields the values of the array that has been opened, one at a time.
+        """
+        if self.peek() == "]":
+            self.expect("]")
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def tables(self):
+        """
+        Yields the name and an iterator over the rows of each table, for a
+        file formatted as described in `insert_data`.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            table = self.value()
+            self.expect(":")
+            self.expect("[")
+            rows = self.rows()
+            yield table, rows
+            # Skip the rows that weren't read
+            for _ in rows:
+                pass
+            if self.expect(",}") == "}":
+                return
+
+
+def insert_rows(model, rows, deferred):
+    """
+    Upserts the `rows` of `model` on their primary key, one statement per set
+    of keys. The values of the `DEFERRED_FOREIGN_KEYS` are left out, and
+    added to `deferred` by model and field names instead.
+
+    Rows without a primary key are inserted one by one unless an equal row
+    exists, so that loading a file again doesn't duplicate them.
+    """
+    # pylint: disable=protected-access
+    primary_key = model._meta.primary_key.name
+    deferred_names = DEFERRED_FOREIGN_KEYS.get(model.__name__, ())
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+
+    for keys, group in groups.items():
+        names = [model._meta.combined[key].name for key in keys]
+        if primary_key not in names:
+            for row in group:
+                model.get_or_create(**row)
+            continue
+
+        id_key = keys[names.index(primary_key)]
+        later = [
+            (key, name) for key, name in zip(keys, names) if name in deferred_names
+        ]
+        if later:
+            pending = deferred.setdefault((model, tuple(name for _, name in later)), [])
+            for row in group:
+                pending.append((row[id_key], [row[key] for key, _ in later]))
+            later_keys = {key for key, _ in later}
+            group = [
+                {key: value for key, value in row.items() if key not in later_keys}
+                for row in group
+            ]
+
+        update = [
+            model._meta.fields[name]
+            for name in names
+            if name != primary_key and name not in deferred_names
+        ]
+        query = model.insert_many(group)
+        if update:
+            query = query.on_conflict(
+                conflict_target=[model._meta.primary_key], preserve=update
+            )
+        else:
+            query = query.on_conflict_ignore()
+        query.execute()
+
+
+def update_deferred(deferred, chunk_size):
+    """
+    Sets the foreign keys collected in `deferred` by `insert_rows`, with one
+    statement per `chunk_size` rows.
+    """
+    # pylint: disable=protected-access
+    for (model, names), pending in deferred.items():
+        primary_key = model._meta.primary_key.name
+        objects = [
+            model(**{primary_key: row_id}, **dict(zip(names, values)))
+            for row_id, values in pending
+        ]
+        model.bulk_update(objects, fields=list(names), batch_size=chunk_size)
+
+
+def reset_sequences(models):
+    """
+    Sets the id sequences of `models` past their largest id, as rows inserted
+    with ids don't advance them. Sqlite has no sequences to reset.
+    """
+    if isinstance(DATABASE, SqliteDatabase):
+        return
+    # pylint: disable=protected-access
+    for model in models:
+        primary_key = model._meta.primary_key
+        if not isinstance(primary_key, AutoField):
+            continue
+        sequence = fn.pg_get_serial_sequence(
+            model._meta.table_name, primary_key.column_name
+        )
+        model.select(fn.setval(sequence, fn.COALESCE(fn.MAX(primary_key), 1))).scalar()
+
+
+def insert_data(filename="default_data.json", chunk_size=INSERT_CHUNK_SIZE):
     """
     Takes a json file, `filename`, and inserts the data into the database. If
     the data contains id values, the data will be updated if already in the
@@ -1272,21 +2183,53 @@ def insert_data(filename="default_data.json"):
         [... more table names with data lists]
     }
     ```
-    """
-    infile = open(filename)
-    data = json.load(infile)
-    infile.close()
 
-    for table, values in data.items():
-        if table not in [m.__name__ for m in MODELS]:
-            logger.error("Unknown data table '%s' in file '%s'", table, filename)
-            continue
-        model = [m for m in MODELS if m.__name__ == table][0]
-        logger.info("Inserting %s data from %s", model.__name__, filename)
-        # insert one-by-one so that we can upsert
-        for value in values:
-            model(DATABASE).get_or_create(**value)
-    DATABASE.commit()
+    The file is read one row at a time, and the rows are inserted in chunks
+    of `chunk_size` rows, in one transaction. Breedings and individuals
+    reference each other, so the foreign keys between them are set once both
+    are loaded. Returns the number of rows loaded per table.
+    """
+    models = {model.__name__: model for model in MODELS}
+    loaded = {}
+    deferred = {}
+    start = time.perf_counter()
+    with open(filename, encoding="utf-8") as infile, DATABASE.atomic():
+        if not isinstance(DATABASE, SqliteDatabase):
+            # Only affects constraints that were created as deferrable
+            DATABASE.execute_sql("SET CONSTRAINTS ALL DEFERRED")
+        for table, rows in JsonStream(infile).tables():
+            if table not in models:
+                logger.error("Unknown data table '%s' in file '%s'", table, filename)
+                continue
+            logger.info("Inserting %s data from %s", table, filename)
+            table_start = time.perf_counter()
+            count = 0
+            for chunk in chunked(rows, chunk_size):
+                insert_rows(models[table], chunk, deferred)
+                count += len(chunk)
+            elapsed = time.perf_counter() - table_start
+            logger.info(
+                "Inserted %s %s rows in %.2f s (%.0f rows/s)",
+                count,
+                table,
+                elapsed,
+                count / elapsed if elapsed else 0,
+            )
+            loaded[table] = loaded.get(table, 0) + count
+
+        update_deferred(deferred, chunk_size)
+        reset_sequences([models[table] for table in loaded])
+
+    elapsed = time.perf_counter() - start
+    total = sum(loaded.values())
+    logger.info(
+        "Inserted %s rows from %s in %.2f s (%.0f rows/s)",
+        total,
+        filename,
+        elapsed,
+        total / elapsed if elapsed else 0,
+    )
+    return loaded
 
 
 def init():
@@ -1658,6 +2601,141 @@ def migrate_10_to_11():
         ).execute()
 
 
+def migrate_11_to_12():
+    """
+    Migrate between schema version 11 and 12.
+    """
+    with DATABASE.atomic():
+        if "individual" not in DATABASE.get_tables():
+            # Can't run migration
+            SchemaHistory.insert(  # pylint: disable=E1120
+                version=12,
+                comment="not yet bootstrapped, skipping",
+                applied=datetime.now(),
+            ).execute()
+            return
+
+        if "certificate_checksum" not in DATABASE.get_tables():
+            CertificateChecksum.create_table()
+        SchemaHistory.insert(  # pylint: disable=E1120
+            version=12,
+            comment="Add certificate_checksum table",
+            applied=datetime.now(),
+        ).execute()
+
+
+def migrate_12_to_13():
+    """
+    Migrate between schema version 12 and 13.
+    """
+    with DATABASE.atomic():
+        if "herd_tracking" not in DATABASE.get_tables():
+            # Can't run migration
+            SchemaHistory.insert(  # pylint: disable=E1120
+                version=13,
+                comment="not yet bootstrapped, skipping",
+                applied=datetime.now(),
+            ).execute()
+            return
+
+        indexes = [
+            ("herd_tracking", ["individual_id", "herd_tracking_date"]),
+            ("breeding", ["breeding_herd_id", "birth_date"]),
+            ("breeding", ["mother_id"]),
+            ("breeding", ["father_id"]),
+            ("individual", ["breeding_id"]),
+            ("hbuser", ["uuid"]),
+        ]
+        for table, columns in indexes:
+            existing = [index.columns for index in DATABASE.get_indexes(table)]
+            if columns not in existing:
+                migrate(DATABASE_MIGRATOR.add_index(table, columns, False))
+        SchemaHistory.insert(  # pylint: disable=E1120
+            version=13,
+            comment="Add indexes for herd tracking, breeding and user lookups",
+            applied=datetime.now(),
+        ).execute()
+
+
+def migrate_13_to_14():
+    """
+    Migrate between schema version 13 and 14.
+    """
+    with DATABASE.atomic():
+        if "genebank" not in DATABASE.get_tables():
+            # Can't run migration
+            SchemaHistory.insert(  # pylint: disable=E1120
+                version=14,
+                comment="not yet bootstrapped, skipping",
+                applied=datetime.now(),
+            ).execute()
+            return
+
+        cols = [x.name for x in DATABASE.get_columns("genebank")]
+
+        if "data_version" not in cols:
+            migrate(
+                DATABASE_MIGRATOR.add_column(
+                    "genebank", "data_version", IntegerField(default=0)
+                )
+            )
+        SchemaHistory.insert(  # pylint: disable=E1120
+            version=14, comment="Add data_version to genebank", applied=datetime.now()
+        ).execute()
+
+
+def migrate_14_to_15():
+    """
+    Migrate between schema version 14 and 15.
+    """
+    with DATABASE.atomic():
+        if "individual" not in DATABASE.get_tables():
+            # Can't run migration
+            SchemaHistory.insert(  # pylint: disable=E1120
+                version=15,
+                comment="not yet bootstrapped, skipping",
+                applied=datetime.now(),
+            ).execute()
+            return
+
+        if "individual_genetics" not in DATABASE.get_tables():
+            IndividualGenetics.create_table()
+        SchemaHistory.insert(  # pylint: disable=E1120
+            version=15,
+            comment="Add individual_genetics table",
+            applied=datetime.now(),
+        ).execute()
+
+
+def migrate_15_to_16():
+    """
+    Migrate between schema version 15 and 16.
+    """
+    with DATABASE.atomic():
+        if "individual_genetics" not in DATABASE.get_tables():
+            # Can't run migration
+            SchemaHistory.insert(  # pylint: disable=E1120
+                version=16,
+                comment="not yet bootstrapped, skipping",
+                applied=datetime.now(),
+            ).execute()
+            return
+
+        cols = [x.name for x in DATABASE.get_columns("individual_genetics")]
+
+        if "computed" not in cols:
+            migrate(
+                DATABASE_MIGRATOR.add_column(
+                    "individual_genetics", "computed", DateTimeField(null=True)
+                )
+            )
+        SchemaHistory.insert(  # pylint: disable=E1120
+            version=16,
+            comment="Add computed to individual_genetics",
+            applied=datetime.now(),
+        ).execute()
+
+
 def check_migrations():
     """
     Check if the database needs any migrations run and run those if that's the case.
@@ -0,0 +1,199 @@
+"""
+Cache for the genetics results of the R-API, that is the kinship matrix, the
+inbreeding coefficients and the mean kinship of a genebank.
+
+Results are stored in a cache backend shared by all workers, together with
+the data version of the genebank they were computed from. Results that are
+older than the cache lifetime, or computed from an older data version, are
+still served while they are refreshed in the background. Only one refresh per
+result runs at a time, across threads and workers, which is ensured with a
+lock file next to the cache. Callers only wait for the R-API when there is no
+result at all, and then only one of them makes the request.
+
+Fetched results can also be stored elsewhere, such as per individual in the
+database, by giving a `store` function.
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import utils.database as db  # isort:skip
+import utils.metrics as metrics  # isort:skip
+
+logger = logging.getLogger("herdbook.genetics")
+
+
+class GeneticsCache:
+    """
+    Stale-while-revalidate cache of genetics results, stored in `backend`, a
+    flask-caching or cachelib cache, with lock files in `lock_dir`. Results
+    are refreshed when they are older than `lifetime` seconds. If `store` is
+    given, it's called with the kind, genebank id, result and data version of
+    each fetched result.
+    """
+
+    def __init__(self, backend, lock_dir, lifetime, store=None):
+        self.backend = backend
+        self.lock_dir = lock_dir
+        self.lifetime = lifetime
+        self.store = store
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+
+    def get(self, kind, genebank_id, fetch):
+        """
+        Returns the `kind` result of the genebank given by `genebank_id`.
+        `fetch` is called without arguments to get the result from the R-API,
+        and returns a falsy value if it failed. Failed results aren't cached.
+        """
+        return self.lookup(kind, genebank_id, fetch)[0]
+
+    def lookup(self, kind, genebank_id, fetch):
+        """
+        Returns the `kind` result of the genebank given by `genebank_id`, like
+        `get`, and whether it's stale, that is older than the cache lifetime
+        or computed from an older data version, and being refreshed.
+        """
+        key = f"genetics-{kind}-{genebank_id}"
+        version = db.get_data_version(genebank_id)
+        entry = self.backend.get(key)
+        if entry is not None:
+            if self._is_fresh(entry, version):
+                metrics.GENETICS_CACHE.inc(kind, "hit")
+                return entry["value"], False
+            metrics.GENETICS_CACHE.inc(kind, "stale")
+            self._refresh_in_background(kind, genebank_id, version, fetch)
+            return entry["value"], True
+
+        metrics.GENETICS_CACHE.inc(kind, "miss")
+        with self._lock(key, blocking=True):
+            # Another thread or worker may have fetched it while we waited
+            entry = self.backend.get(key)
+            if entry is not None:
+                return entry["value"], not self._is_fresh(entry, version)
+            return self._fetch(kind, genebank_id, version, fetch), False
+
+    def refresh(self, kind, genebank_id, fetch, background=True):
+        """
+        Starts a background refresh of the `kind` result of the genebank given
+        by `genebank_id`, unless it's fresh or already being refreshed. Without
+        `background`, the refresh is made in the calling thread instead, and
+        has finished when this returns.
+        """
+        version = db.get_data_version(genebank_id)
+        if background:
+            self._refresh_in_background(kind, genebank_id, version, fetch)
+        elif self._start_refresh(kind, genebank_id):
+            self._refresh(kind, genebank_id, version, fetch)
+
+    def _is_fresh(self, entry, version):
+        """
+        Returns `True` if the cache `entry` is of the data `version`, and
+        younger than the cache lifetime.
+        """
+        return (
+            entry["version"] == version
+            and time.time() - entry["fetched"] < self.lifetime
+        )
+
+    def _fetch(self, kind, genebank_id, version, fetch):
+        """
+        Fetches, caches and stores the `kind` result of the genebank given by
+        `genebank_id`, and returns it.
+        """
+        value = fetch()
+        if not value:
+            return value
+        entry = {"value": value, "version": version, "fetched": time.time()}
+        # Stale results are served until they are replaced
+        self.backend.set(f"genetics-{kind}-{genebank_id}", entry, timeout=0)
+        if self.store is not None:
+            try:
+                self.store(kind, genebank_id, value, version)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error("Could not store %s of %s: %s", kind, genebank_id, ex)
+        return value
+
+    def _refresh_in_background(self, kind, genebank_id, version, fetch):
+        """
+        Starts a refresh of the `kind` result of the genebank given by
+        `genebank_id`, unless this worker is already refreshing it.
+        """
+        if not self._start_refresh(kind, genebank_id):
+            return
+        threading.Thread(
+            target=self._refresh_thread,
+            args=(kind, genebank_id, version, fetch),
+            name=f"refresh-genetics-{kind}-{genebank_id}",
+            daemon=True,
+        ).start()
+
+    def _start_refresh(self, kind, genebank_id):
+        """
+        Marks the `kind` result of the genebank given by `genebank_id` as being
+        refreshed in this worker, and returns `False` if it already was.
+        """
+        key = f"genetics-{kind}-{genebank_id}"
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+        return True
+
+    def _refresh_thread(self, kind, genebank_id, version, fetch):
+        """
+        Runs `_refresh` in a background thread, closing the database
+        connection of the thread when it's done.
+        """
+        try:
+            self._refresh(kind, genebank_id, version, fetch)
+        finally:
+            if not db.DATABASE.is_closed():
+                db.DATABASE.close()
+
+    def _refresh(self, kind, genebank_id, version, fetch):
+        """
+        Refreshes the `kind` result of the genebank given by `genebank_id`,
+        unless another worker is already refreshing it, and marks it as no
+        longer being refreshed.
+        """
+        key = f"genetics-{kind}-{genebank_id}"
+        try:
+            with self._lock(key, blocking=False) as locked:
+                if not locked:
+                    return
+                entry = self.backend.get(key)
+                if entry is not None and self._is_fresh(entry, version):
+                    return
+                metrics.GENETICS_CACHE.inc(kind, "refresh")
+                if not self._fetch(kind, genebank_id, version, fetch):
+                    metrics.GENETICS_CACHE.inc(kind, "refresh_error")
+        except Exception as ex:  # pylint: disable=broad-except
+            metrics.GENETICS_CACHE.inc(kind, "refresh_error")
+            logger.error("Could not refresh %s: %s", key, ex)
+        finally:
+            with self.refreshing_lock:
+                self.refreshing.discard(key)
+
+    @contextmanager
+    def _lock(self, key, blocking):
+        """
+        Context manager holding the lock file of `key`, giving whether the
+        lock was taken. Without `blocking`, it gives `False` instead of
+        waiting if another thread or worker holds the lock.
+        """
+        path = os.path.join(self.lock_dir, f"herdbook-{key}.lock")
+        with open(path, "a", encoding="utf-8") as lock_file:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,243 @@
+"""
+Background refresher of the genetics results of the genebanks, run by one
+worker at a time.
+
+Every worker starts a refresher, but only the one holding the leader lock file
+refreshes results. The others keep trying to take the lock, so that another
+worker takes over when the leader exits. Writes that change a genebank call
+`notify`, which touches a trigger file next to the lock, and the leader then
+refreshes the genebanks whose data version has changed. All genebanks are
+refreshed every `interval` seconds as a safety net, for results that have
+expired or were evicted from the cache.
+
+The leader writes its status to a file next to the lock, so that it can be
+shown by any worker.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import utils.database as db  # isort:skip
+import utils.metrics as metrics  # isort:skip
+
+logger = logging.getLogger("herdbook.genetics")
+
+
+class GeneticsRefresher:
+    """
+    Calls `refresh` with the id of each genebank whose genetics results
+    should be refreshed, in the worker holding the leader lock in `lock_dir`.
+    The leader checks for changes every `poll` seconds, and keeps checking
+    the data versions for `settle` seconds after a notification, as the
+    notifying transaction may not have been committed yet.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, lock_dir, refresh, interval=300, poll=1, settle=10):
+        self.lock_dir = lock_dir
+        self.refresh = refresh
+        self.interval = interval
+        self.poll = poll
+        self.settle = settle
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock_file = None
+        self.versions = {}
+        self.trigger_mtime = None
+        self.pending_until = 0
+        self.last_full = None
+        self.state = {
+            "last_run": None,
+            "last_full_run": None,
+            "last_trigger": None,
+            "runs": 0,
+            "refreshed": [],
+            "last_error": None,
+        }
+
+    def _path(self, name):
+        """
+        Returns the path of the refresher file `name` in the lock directory.
+        """
+        return os.path.join(self.lock_dir, f"herdbook-genetics-refresher.{name}")
+
+    @property
+    def leader(self):
+        """
+        Returns `True` if this worker is the leader.
+        """
+        return self.lock_file is not None
+
+    def start(self):
+        """
+        Starts the refresher thread.
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, name="genetics-refresher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the refresher thread, and gives up the leadership.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._resign()
+
+    def notify(self):
+        """
+        Notifies the leader, in any worker, that a genebank has changed.
+        """
+        try:
+            with open(self._path("trigger"), "a", encoding="utf-8"):
+                os.utime(self._path("trigger"))
+        except OSError as ex:
+            logger.error("Could not notify the genetics refresher: %s", ex)
+        self.wakeup.set()
+
+    def status(self):
+        """
+        Returns the status of the refresher in this worker, and the last
+        status written by the leader.
+        """
+        try:
+            with open(self._path("json"), encoding="utf-8") as status_file:
+                leader = json.load(status_file)
+        except (OSError, ValueError):
+            leader = None
+        return {
+            "pid": os.getpid(),
+            "running": self.thread is not None and self.thread.is_alive(),
+            "is_leader": self.leader,
+            "interval": self.interval,
+            "leader": leader,
+        }
+
+    def _run(self):
+        """
+        Runs the refresher until it's stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                if not self.leader:
+                    self._elect()
+                if self.leader:
+                    self.tick()
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error("Genetics refresher failed: %s", ex)
+                self.state["last_error"] = str(ex)
+            finally:
+                if not db.DATABASE.is_closed():
+                    db.DATABASE.close()
+            self.wakeup.wait(self.poll)
+            self.wakeup.clear()
+
+    def _elect(self):
+        """
+        Tries to take the leader lock, and returns whether this worker is the
+        leader.
+        """
+        lock_file = open(  # pylint: disable=consider-using-with
+            self._path("lock"), "a", encoding="utf-8"
+        )
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        self.trigger_mtime = self._trigger_mtime()
+        self.last_full = None
+        logger.info("Worker %s is now refreshing genetics results", os.getpid())
+        return True
+
+    def _resign(self):
+        """
+        Releases the leader lock, if this worker holds it.
+        """
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _trigger_mtime(self):
+        """
+        Returns the modification time of the trigger file, or `None` if there
+        is none.
+        """
+        try:
+            return os.stat(self._path("trigger")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def tick(self):
+        """
+        Refreshes the genebanks that have changed, or all genebanks if the
+        last full refresh is older than the interval. Returns the ids of the
+        refreshed genebanks.
+        """
+        now = time.monotonic()
+        mtime = self._trigger_mtime()
+        if mtime != self.trigger_mtime:
+            self.trigger_mtime = mtime
+            self.pending_until = now + self.settle
+            self.state["last_trigger"] = datetime.now().isoformat()
+
+        full = self.last_full is None or now - self.last_full >= self.interval
+        if not full and now >= self.pending_until:
+            return []
+
+        start = time.perf_counter()
+        versions = dict(
+            db.Genebank.select(db.Genebank.id, db.Genebank.data_version).tuples()
+        )
+        if full:
+            self.last_full = now
+            changed = list(versions)
+        else:
+            changed = [
+                genebank_id
+                for genebank_id, version in versions.items()
+                if self.versions.get(genebank_id) != version
+            ]
+        self.versions = versions
+        if not changed:
+            return []
+
+        for genebank_id in changed:
+            try:
+                self.refresh(genebank_id)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error("Could not refresh genebank %s: %s", genebank_id, ex)
+                self.state["last_error"] = str(ex)
+        metrics.JOB_DURATION.observe(time.perf_counter() - start, "refresh_genetics")
+
+        self.state["last_run"] = datetime.now().isoformat()
+        if full:
+            self.state["last_full_run"] = self.state["last_run"]
+        self.state["runs"] += 1
+        self.state["refreshed"] = changed
+        self._write_status()
+        return changed
+
+    def _write_status(self):
+        """
+        Writes the leader status, so that other workers can show it.
+        """
+        status = dict(self.state, pid=os.getpid())
+        path = self._path("json")
+        try:
+            with open(f"{path}.tmp", "w", encoding="utf-8") as status_file:
+                json.dump(status, status_file)
+            os.replace(f"{path}.tmp", path)
+        except OSError as ex:
+            logger.error("Could not write the genetics refresher status: %s", ex)
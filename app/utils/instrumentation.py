@@ -0,0 +1,118 @@
+"""
+Per request instrumentation of database queries, and of the R-API and S3
+calls made while serving a request.
+
+The statistics are kept per thread, from `start_request` to `end_request`.
+Work done outside of requests isn't recorded there, but all queries and calls
+are recorded in the application wide `utils.metrics`.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import utils.metrics as metrics  # isort:skip
+
+LOCAL = threading.local()
+
+DURATIONS = {"rapi": metrics.RAPI_DURATION, "s3": metrics.S3_DURATION}
+ERRORS = {"rapi": metrics.RAPI_ERRORS, "s3": metrics.S3_ERRORS}
+
+
+class RequestStats:  # pylint: disable=too-few-public-methods
+    """
+    Query and call statistics for a single request. Times are in seconds.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.max_query_time = 0.0
+        self.calls = {"rapi": [0, 0.0], "s3": [0, 0.0]}
+
+    def headers(self):
+        """
+        Returns the statistics as response headers, with times in ms.
+        """
+        headers = {
+            "X-Request-Time": f"{(time.perf_counter() - self.start) * 1000:.1f}",
+            "X-Query-Count": str(self.queries),
+            "X-Query-Time": f"{self.query_time * 1000:.1f}",
+            "X-Query-Max-Time": f"{self.max_query_time * 1000:.1f}",
+        }
+        for kind, (count, elapsed) in self.calls.items():
+            name = "RAPI" if kind == "rapi" else kind.upper()
+            headers[f"X-{name}-Calls"] = str(count)
+            headers[f"X-{name}-Time"] = f"{elapsed * 1000:.1f}"
+        return headers
+
+    def summary(self):
+        """
+        Returns the statistics as a log line.
+        """
+        return (
+            f"{self.queries} queries in {self.query_time * 1000:.1f} ms "
+            f"(max {self.max_query_time * 1000:.1f} ms), "
+            f"R-API {self.calls['rapi'][0]} calls in "
+            f"{self.calls['rapi'][1] * 1000:.1f} ms, "
+            f"S3 {self.calls['s3'][0]} calls in {self.calls['s3'][1] * 1000:.1f} ms, "
+            f"total {(time.perf_counter() - self.start) * 1000:.1f} ms"
+        )
+
+
+def start_request():
+    """
+    Starts recording statistics for the request of the current thread.
+    """
+    LOCAL.stats = RequestStats()
+
+
+def end_request():
+    """
+    Stops recording, and returns the statistics of the request of the current
+    thread, or `None` if none were recorded.
+    """
+    stats = getattr(LOCAL, "stats", None)
+    LOCAL.stats = None
+    return stats
+
+
+def current():
+    """
+    Returns the statistics of the request of the current thread, or `None`.
+    """
+    return getattr(LOCAL, "stats", None)
+
+
+def record_query(elapsed):
+    """
+    Records a database query that took `elapsed` seconds.
+    """
+    metrics.DB_QUERY_DURATION.observe(elapsed)
+    stats = current()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_time += elapsed
+        stats.max_query_time = max(stats.max_query_time, elapsed)
+
+
+@contextmanager
+def timed(kind, operation):
+    """
+    Context manager recording the time of an external call of `kind`, either
+    "rapi" or "s3", doing `operation`. Calls raising an exception are counted
+    as errors.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS[kind].inc(operation)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        DURATIONS[kind].observe(elapsed, operation)
+        stats = current()
+        if stats is not None:
+            stats.calls[kind][0] += 1
+            stats.calls[kind][1] += elapsed
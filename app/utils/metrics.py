@@ -0,0 +1,269 @@
+"""
+Application metrics, rendered in the Prometheus text format.
+
+Recorded values are kept in per thread shards, so that recording a value only
+touches a dict owned by the recording thread, and the server threads never
+wait on each other. A lock is only taken the first time a thread records a
+metric, and when the shards are merged for rendering.
+"""
+import abc
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+REGISTRY = []
+REGISTRY_LOCK = threading.Lock()
+
+
+def escape(value):
+    """
+    Returns `value` escaped for use as a label value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric(abc.ABC):
+    """
+    Base class of the metric types, keeping the values of each label value
+    combination in per thread shards.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+        with REGISTRY_LOCK:
+            REGISTRY.append(self)
+
+    def _shard(self):
+        """
+        Returns the shard of the current thread.
+        """
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    @staticmethod
+    @abc.abstractmethod
+    def _merge(target, shard):
+        """
+        Adds the values of `shard` to `target`.
+        """
+
+    def collect(self):
+        """
+        Returns the values of all threads, merged by label values. The shards
+        of threads that have finished are folded into the retired values.
+        """
+        with self.lock:
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self._merge(self.retired, shard)
+            self.shards = live
+            merged = {}
+            self._merge(merged, self.retired)
+        for _, shard in live:
+            self._merge(merged, shard.copy())
+        return merged
+
+    def _label_string(self, values, extra=None):
+        """
+        Returns the label string of the label `values`, and of the `extra`
+        label pair.
+        """
+        pairs = [
+            f'{name}="{escape(value)}"' for name, value in zip(self.labels, values)
+        ]
+        if extra is not None:
+            pairs.append(f'{extra[0]}="{escape(extra[1])}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abc.abstractmethod
+    def samples(self, values, value):
+        """
+        Returns the sample lines of the label `values`.
+        """
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text format.
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, value in sorted(self.collect().items()):
+            lines += self.samples(values, value)
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+    """
+
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        """
+        Increases the count of the label `values` by `amount`.
+        """
+        shard = self._shard()
+        shard[values] = shard.get(values, 0) + amount
+
+    @staticmethod
+    def _merge(target, shard):
+        for values, value in shard.items():
+            target[values] = target.get(values, 0) + value
+
+    def samples(self, values, value):
+        return [f"{self.name}{self._label_string(values)} {value}"]
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, counted in buckets. Each label value
+    combination keeps the count of every bucket, followed by the count above
+    the last bucket, and the sum of the observed values.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value, *values):
+        """
+        Records `value` for the label `values`.
+        """
+        shard = self._shard()
+        counts = shard.get(values, None)
+        if counts is None:
+            counts = shard[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _merge(target, shard):
+        for values, counts in shard.items():
+            counts = list(counts)
+            if values in target:
+                target[values] = [a + b for a, b in zip(target[values], counts)]
+            else:
+                target[values] = counts
+
+    def samples(self, values, value):
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ("+Inf",), value[:-1]):
+            cumulative += count
+            labels = self._label_string(values, ("le", bucket))
+            lines += [f"{self.name}_bucket{labels} {cumulative}"]
+        labels = self._label_string(values)
+        lines += [
+            f"{self.name}_sum{labels} {value[-1]}",
+            f"{self.name}_count{labels} {cumulative}",
+        ]
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "herdbook_request_duration_seconds",
+    "Request latency by route.",
+    ["method", "endpoint"],
+)
+REQUESTS = Counter(
+    "herdbook_requests_total",
+    "Requests by route and response status.",
+    ["method", "endpoint", "status"],
+)
+DB_QUERIES = Counter(
+    "herdbook_db_queries_total",
+    "Database queries made while serving requests, by route.",
+    ["endpoint"],
+)
+DB_QUERY_DURATION = Histogram(
+    "herdbook_db_query_duration_seconds",
+    "Database query latency.",
+    buckets=QUERY_BUCKETS,
+)
+RAPI_DURATION = Histogram(
+    "herdbook_rapi_request_duration_seconds",
+    "R-API request latency by call.",
+    ["call"],
+)
+RAPI_ERRORS = Counter(
+    "herdbook_rapi_errors_total",
+    "Failed R-API requests by call.",
+    ["call"],
+)
+RAPI_CIRCUIT = Counter(
+    "herdbook_rapi_circuit_total",
+    "R-API circuit breaker openings, closings and rejected calls.",
+    ["event"],
+)
+S3_DURATION = Histogram(
+    "herdbook_s3_operation_duration_seconds",
+    "S3 operation latency by operation.",
+    ["operation"],
+)
+S3_ERRORS = Counter(
+    "herdbook_s3_errors_total",
+    "Failed S3 operations by operation.",
+    ["operation"],
+)
+GENETICS_CACHE = Counter(
+    "herdbook_genetics_cache_total",
+    "Genetics cache lookups and refreshes by kind and result.",
+    ["kind", "result"],
+)
+JOB_DURATION = Histogram(
+    "herdbook_job_duration_seconds",
+    "Background job run time by job.",
+    ["job"],
+    buckets=JOB_BUCKETS,
+)
+
+
+def timed_job(name, func):
+    """
+    Returns `func` wrapped to record its run time as the background job
+    `name`.
+    """
+
+    @wraps(func)
+    def job(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            JOB_DURATION.observe(time.perf_counter() - start, name)
+
+    return job
+
+
+def render():
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    with REGISTRY_LOCK:
+        metrics = list(REGISTRY)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
@@ -0,0 +1,160 @@
+"""
+Client for the R-API, which computes the genetics results of the genebanks.
+
+Requests go through a pooled `requests.Session`, so that connections are
+reused between requests and threads. A circuit breaker stops calling the
+R-API after repeated failures, for example while the R container restarts,
+so that callers fail fast instead of waiting for the request timeout.
+"""
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils.instrumentation as instrumentation  # isort:skip
+import utils.metrics as metrics  # isort:skip
+
+logger = logging.getLogger("herdbook.rapi")
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    Raised instead of calling the R-API while the circuit breaker is open. It
+    is a connection error, so that callers handle it like an unreachable
+    R-API.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, and then rejects
+    calls for `reset_timeout` seconds. After that a single trial call is let
+    through, which closes the breaker if it succeeds, and opens it again if it
+    fails.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    @property
+    def state(self):
+        """
+        Returns the state of the breaker, "closed", "open" or "half-open".
+        """
+        with self.lock:
+            if self.opened is None:
+                return "closed"
+            if self.trial or time.monotonic() - self.opened >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """
+        Returns `True` if a call may be made now.
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        """
+        Records a successful call, closing the breaker.
+        """
+        with self.lock:
+            closed = self.opened is not None
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+        if closed:
+            metrics.RAPI_CIRCUIT.inc("close")
+            logger.info("R-API is back, closing the circuit breaker")
+
+    def record_failure(self):
+        """
+        Records a failed call, opening the breaker if there were too many.
+        """
+        with self.lock:
+            self.failures += 1
+            opened = self.trial or (
+                self.opened is None and self.failures >= self.failure_threshold
+            )
+            if opened:
+                self.opened = time.monotonic()
+                self.trial = False
+        if opened:
+            metrics.RAPI_CIRCUIT.inc("open")
+            logger.error(
+                "R-API failed %s times, rejecting calls for %s s",
+                self.failures,
+                self.reset_timeout,
+            )
+
+
+class RapiClient:
+    """
+    Client for the R-API at `url`, with at most `pool_size` connections.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, url, timeout=30, failure_threshold=5, reset_timeout=30, pool_size=10
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, call, path, **kwargs):
+        """
+        Makes a `method` request to `path` for the R-API `call`, and returns
+        the response. Raises `CircuitOpen` without calling the R-API while
+        the circuit breaker is open. Connection errors, timeouts and server
+        errors count as failures of the R-API.
+        """
+        if not self.breaker.allow():
+            metrics.RAPI_CIRCUIT.inc("reject")
+            metrics.RAPI_ERRORS.inc(call)
+            raise CircuitOpen(f"R-API circuit breaker is open, not calling {call}")
+
+        try:
+            with instrumentation.timed("rapi", call):
+                response = self.session.request(
+                    method, self.url + path, timeout=self.timeout, **kwargs
+                )
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        if response.status_code != 200:
+            metrics.RAPI_ERRORS.inc(call)
+        return response
+
+    def get(self, call, path, **kwargs):
+        """
+        Makes a GET request, see `request`.
+        """
+        return self.request("GET", call, path, **kwargs)
+
+    def post(self, call, path, **kwargs):
+        """
+        Makes a POST request, see `request`.
+        """
+        return self.request("POST", call, path, **kwargs)
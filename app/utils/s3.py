@@ -1,13 +1,217 @@
 """
 S3 client handler.
 """
+import hashlib
 import logging
+import os
+import tempfile
+import threading
 from pathlib import Path
 
 import boto3
 import botocore
+import utils.instrumentation as instrumentation
 import utils.settings as settings
 
+# Enough connections for the server threads and the certificate upload workers
+MAX_POOL_CONNECTIONS = 32
+STREAM_CHUNK_SIZE = 64 * 1024
+
+S3_CLIENT = None
+S3_CLIENT_LOCK = threading.Lock()
+
+
+class ObjectCache:
+    """
+    A size bounded on-disk cache of S3 objects. Each object is stored in a
+    file named by the hashed object name and the ETag of the cached version,
+    and the least recently read files are removed when the cache is full.
+    Callers validate the cached version against S3 before using it, as the
+    cache directory is shared by the workers, and an object may be changed by
+    another worker while it's being cached.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def _files(self, object_name):
+        prefix = hashlib.sha256(object_name.encode("utf-8")).hexdigest()
+        return list(self.path.glob(f"{prefix}.*"))
+
+    def etag(self, object_name):
+        """
+        Returns the ETag of the cached version of `object_name`, without
+        quotes, or `None` if it isn't cached.
+        """
+        for path in self._files(object_name):
+            return path.name.split(".", 1)[1]
+        return None
+
+    def open(self, object_name, etag):
+        """
+        Returns an open binary file with the cached bytes of the version `etag`
+        of `object_name`, or `None`.
+        """
+        prefix = hashlib.sha256(object_name.encode("utf-8")).hexdigest()
+        path = self.path / f"{prefix}.{etag}"
+        try:
+            handle = path.open("rb")
+            os.utime(path)
+        except OSError:
+            return None
+        return handle
+
+    def get(self, object_name, etag):
+        """
+        Returns the cached bytes of the version `etag` of `object_name`, or
+        `None`.
+        """
+        handle = self.open(object_name, etag)
+        if handle is None:
+            return None
+        with handle:
+            return handle.read()
+
+    def contains(self, object_name):
+        """
+        Returns whether `object_name` is cached.
+        """
+        return bool(self._files(object_name))
+
+    def put(self, object_name, etag, data, generation):
+        """
+        Caches `data` as the version `etag` of `object_name`, unless the cache
+        has been invalidated since `generation` was read.
+        """
+        if len(data) > self.max_size:
+            return
+        temp_file = self.create_temp()
+        with temp_file:
+            temp_file.write(data)
+        self.commit(object_name, etag, temp_file.name, generation)
+
+    def create_temp(self):
+        """
+        Returns a new temporary file in the cache directory, to be filled and
+        then committed or discarded.
+        """
+        return tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False)
+
+    def commit(self, object_name, etag, temp_name, generation):
+        """
+        Moves the temporary file `temp_name` into the cache as the version
+        `etag` of `object_name`, unless the cache has been invalidated since
+        `generation` was read.
+        """
+        prefix = hashlib.sha256(object_name.encode("utf-8")).hexdigest()
+        etag = "".join(c for c in etag if c.isalnum() or c == "-")
+        with self.lock:
+            if generation != self.generation:
+                os.unlink(temp_name)
+                return
+            for path in self._files(object_name):
+                path.unlink(missing_ok=True)
+            os.replace(temp_name, self.path / f"{prefix}.{etag}")
+            self._evict()
+
+    def invalidate(self, object_name):
+        """
+        Removes `object_name` from the cache.
+        """
+        with self.lock:
+            self.generation += 1
+            for path in self._files(object_name):
+                path.unlink(missing_ok=True)
+
+    def _evict(self):
+        entries = []
+        for path in self.path.iterdir():
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries += [(stat.st_mtime_ns, stat.st_size, path)]
+        size = sum(entry[1] for entry in entries)
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            size -= file_size
+
+
+class InvalidRange(Exception):
+    """
+    Raised when a requested byte range is outside of an object of `size`
+    bytes, if the size is known.
+    """
+
+    def __init__(self, message, size=None):
+        super().__init__(message)
+        self.size = size
+
+
+class ObjectStream:  # pylint: disable=too-few-public-methods
+    """
+    A S3 object, or a byte range of it, streamed in chunks.
+    """
+
+    def __init__(self, chunks, size, start, length):
+        self.chunks = chunks
+        self.size = size
+        self.start = start
+        self.length = length
+
+    @property
+    def partial(self):
+        """
+        Whether only part of the object is streamed.
+        """
+        return self.length != self.size
+
+    @property
+    def content_range(self):
+        """
+        The HTTP Content-Range of the streamed part.
+        """
+        return f"bytes {self.start}-{self.start + self.length - 1}/{self.size}"
+
+
+def resolve_range(byte_range, size):
+    """
+    Returns the `(start, stop)` offsets of `byte_range` in an object of `size`
+    bytes. `byte_range` is given as in a HTTP Range header, where a negative
+    start is a suffix length and stop is exclusive or `None`.
+    """
+    start, stop = byte_range
+    if start < 0:
+        start, stop = max(size + start, 0), size
+    elif stop is None or stop > size:
+        stop = size
+    if start >= stop:
+        raise InvalidRange(f"Range not satisfiable for {size} bytes", size)
+    return start, stop
+
+
+def file_chunks(handle, start, length):
+    """
+    Yields `length` bytes from `start` of the open file `handle` in chunks,
+    and closes it.
+    """
+    with handle:
+        handle.seek(start)
+        while length > 0:
+            chunk = handle.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
 
 class S3Handler:  # pylint: disable=too-many-instance-attributes
     """
@@ -25,6 +229,7 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
         use_ssl,
         cert,
         private_key,
+        cache=None,
     ):  # pylint: disable=too-many-arguments
         """
         Constructor for initialising a S3 client.
@@ -47,9 +252,13 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
         self.cert = cert
         assert isinstance(private_key, (Path, type(None)))
         self.private_key = private_key
+        assert isinstance(cache, (ObjectCache, type(None)))
+        self.cache = cache
 
         config_params = {
             "connect_timeout": 40,
+            "max_pool_connections": MAX_POOL_CONNECTIONS,
+            "tcp_keepalive": True,
         }
 
         if cert and private_key:
@@ -73,28 +282,135 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
         except self.s3_client.exceptions.BucketAlreadyOwnedByYou as ex:
             logging.debug("Bucket already exists: %s", str(ex))
 
+    def _get_validated(self, bucket_object_name, **params):
+        """
+        Makes a S3 GET request for a S3 object, with the extra `params`. If the
+        object is cached, the request is conditional on the cached ETag, and if
+        the cached version is current it isn't downloaded again. Returns the
+        response and `None`, or `None` and an open file with the cached bytes.
+        """
+        request = {"Bucket": self.bucket, "Key": bucket_object_name, **params}
+        etag = None if self.cache is None else self.cache.etag(bucket_object_name)
+        if etag is not None:
+            try:
+                with instrumentation.timed("s3", "get"):
+                    obj_res = self.s3_client.get_object(
+                        IfNoneMatch=f'"{etag}"', **request
+                    )
+                return obj_res, None
+            except botocore.exceptions.ClientError as ex:
+                if ex.response["Error"]["Code"] != "304":
+                    raise ex
+            handle = self.cache.open(bucket_object_name, etag)
+            if handle is not None:
+                return None, handle
+            # The cached version was removed after the request
+
+        with instrumentation.timed("s3", "get"):
+            return self.s3_client.get_object(**request), None
+
     def get_object(self, bucket_object_name):
         """
-        Returns the bytes of a S3 object.
+        Returns the bytes of a S3 object, from the cache if the cached version
+        is current.
         """
+        generation = None if self.cache is None else self.cache.generation
+        obj_res, handle = self._get_validated(bucket_object_name)
+        if handle is not None:
+            with handle:
+                return handle.read()
+        obj_data = obj_res["Body"].read()
+
+        if self.cache is not None:
+            self.cache.put(bucket_object_name, obj_res["ETag"], obj_data, generation)
+        return obj_data
+
+    def stream_object(self, bucket_object_name, byte_range=None):
+        """
+        Returns an `ObjectStream` of a S3 object, or of the part of it given by
+        `byte_range` (see `resolve_range`). Objects that are streamed whole are
+        written to the cache as they are read.
+        """
+        generation = None if self.cache is None else self.cache.generation
+        params = {}
+        if byte_range is not None:
+            start, stop = byte_range
+            if start < 0:
+                params["Range"] = f"bytes={start}"
+            else:
+                params["Range"] = f"bytes={start}-{'' if stop is None else stop - 1}"
         try:
-            obj_res = self.s3_client.get_object(
-                Bucket=self.bucket, Key=bucket_object_name
-            )
-            obj_data = obj_res["Body"].read()
-        except Exception as ex:
+            obj_res, handle = self._get_validated(bucket_object_name, **params)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "InvalidRange":
+                size = ex.response["Error"].get("ActualObjectSize", None)
+                raise InvalidRange(str(ex), size) from ex
             raise ex
 
-        return obj_data
+        if handle is not None:
+            size = os.fstat(handle.fileno()).st_size
+            start, stop = 0, size
+            if byte_range is not None:
+                try:
+                    start, stop = resolve_range(byte_range, size)
+                except InvalidRange:
+                    handle.close()
+                    raise
+            return ObjectStream(
+                file_chunks(handle, start, stop - start), size, start, stop - start
+            )
+
+        length = obj_res["ContentLength"]
+        size, start = length, 0
+        if "ContentRange" in obj_res:
+            span, size = obj_res["ContentRange"].split(" ")[-1].split("/")
+            start, size = int(span.split("-")[0]), int(size)
+
+        cached = (
+            self.cache is not None and length == size and length <= self.cache.max_size
+        )
+        chunks = self._body_chunks(
+            obj_res, bucket_object_name, generation if cached else None
+        )
+        return ObjectStream(chunks, size, start, length)
+
+    def _body_chunks(self, obj_res, bucket_object_name, generation):
+        """
+        Yields the body of the S3 response `obj_res` in chunks, writing it to
+        the cache if `generation` is given and the whole body is read.
+        """
+        body = obj_res["Body"]
+        temp_file = None if generation is None else self.cache.create_temp()
+        complete = False
+        try:
+            for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                if temp_file is not None:
+                    temp_file.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            body.close()
+            if temp_file is not None:
+                temp_file.close()
+                if complete:
+                    self.cache.commit(
+                        bucket_object_name, obj_res["ETag"], temp_file.name, generation
+                    )
+                else:
+                    os.unlink(temp_file.name)
 
     def delete_object(self, bucket_object_name):
         """
         Delete the S3 object.
         """
         try:
-            self.s3_client.delete_object(Bucket=self.bucket, Key=bucket_object_name)
+            with instrumentation.timed("s3", "delete"):
+                self.s3_client.delete_object(Bucket=self.bucket, Key=bucket_object_name)
         except Exception as ex:
             raise ex
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(bucket_object_name)
 
         return True
 
@@ -104,11 +420,15 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
         """
         copy_source = {"Bucket": self.bucket, "Key": old_object_name}
         try:
-            self.s3_client.copy_object(
-                CopySource=copy_source, Bucket=self.bucket, Key=object_name
-            )
+            with instrumentation.timed("s3", "copy"):
+                self.s3_client.copy_object(
+                    CopySource=copy_source, Bucket=self.bucket, Key=object_name
+                )
         except Exception as ex:
             raise ex
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(object_name)
 
         return True
 
@@ -119,18 +439,26 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
         if file_name is None or not isinstance(file_name, str):
             return False
         try:
-            self.s3_client.put_object(Body=file_data, Bucket=self.bucket, Key=file_name)
+            with instrumentation.timed("s3", "put"):
+                self.s3_client.put_object(
+                    Body=file_data, Bucket=self.bucket, Key=file_name
+                )
         except Exception as ex:
             raise ex
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(file_name)
 
         return True
 
     def head_object(self, object_name):
         """
-        Returns whether an object exists in a bucket or not.
+        Returns whether an object exists in a bucket or not. This always asks
+        S3, as the object may have been removed since it was cached.
         """
         try:
-            self.s3_client.head_object(Bucket=self.bucket, Key=object_name)
+            with instrumentation.timed("s3", "head"):
+                self.s3_client.head_object(Bucket=self.bucket, Key=object_name)
         except Exception as ex:
             raise ex
 
@@ -139,17 +467,35 @@ class S3Handler:  # pylint: disable=too-many-instance-attributes
 
 def get_s3_client():
     """
-    Returns a S3 client instance.
-    """
-    s3_client = S3Handler(
-        bucket=settings.s3.bucket,
-        endpoint=settings.s3.endpoint,
-        region=settings.s3.region,
-        secret_key=settings.s3.secret_key,
-        access_key=settings.s3.access_key,
-        verify=settings.s3.verify,
-        use_ssl=settings.s3.use_ssl,
-        cert=settings.s3.cert,
-        private_key=settings.s3.private_key,
-    )
-    return s3_client
+    Returns the S3 client instance of the process. The client is created, and
+    the bucket checked, on first use, and is shared between threads.
+    """
+    global S3_CLIENT  # pylint: disable=global-statement
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None:
+            cache = None
+            if settings.s3.cache_dir:
+                cache = ObjectCache(settings.s3.cache_dir, settings.s3.cache_size)
+            S3_CLIENT = S3Handler(
+                bucket=settings.s3.bucket,
+                endpoint=settings.s3.endpoint,
+                region=settings.s3.region,
+                secret_key=settings.s3.secret_key,
+                access_key=settings.s3.access_key,
+                verify=settings.s3.verify,
+                use_ssl=settings.s3.use_ssl,
+                cert=settings.s3.cert,
+                private_key=settings.s3.private_key,
+                cache=cache,
+            )
+    return S3_CLIENT
+
+
+def reset_s3_client():
+    """
+    Drops the S3 client instance, so that the next call to `get_s3_client`
+    creates a new one.
+    """
+    global S3_CLIENT  # pylint: disable=global-statement
+    with S3_CLIENT_LOCK:
+        S3_CLIENT = None
@@ -5,6 +5,8 @@ Instance specific settings for the herdbook.
 import json
 import logging
 import os
+import sys
+import tempfile
 from argparse import Namespace
 from pathlib import Path
 
@@ -20,18 +22,54 @@ service = Namespace()  # pylint: disable=C0103
 certs.private_key = Path("certs/key.pem")
 certs.ca = Path("certs/ca.pem")
 certs.template = Path("template.pdf")
+certs.preview_cache_size = int(
+    os.environ.get("HERDBOOK_PREVIEW_CACHE_SIZE", str(64 * 1024 * 1024))
+)
 
 postgres.name = os.environ.get("POSTGRES_DB", "herdbook")
 postgres.host = os.environ.get("POSTGRES_HOST", "herdbook-db")
 postgres.port = os.environ.get("POSTGRES_PORT", "5432")
 postgres.user = os.environ.get("POSTGRES_USER", "herdbook")
 postgres.password = os.environ.get("POSTGRES_PASSWORD", "insecure")
+# Setting POSTGRES_MAX_CONNECTIONS to 0 disables connection pooling
+postgres.max_connections = int(os.environ.get("POSTGRES_MAX_CONNECTIONS", "20"))
+postgres.stale_timeout = int(os.environ.get("POSTGRES_STALE_TIMEOUT", "300"))
+postgres.pool_timeout = int(os.environ.get("POSTGRES_POOL_TIMEOUT", "10"))
+# Read only data access is sent to the replica, if one is configured. Sessions
+# that have written stay on the primary for POSTGRES_REPLICA_PIN seconds.
+postgres.replica_host = os.environ.get("POSTGRES_REPLICA_HOST", None)
+postgres.replica_port = os.environ.get("POSTGRES_REPLICA_PORT", postgres.port)
+postgres.replica_pin = int(os.environ.get("POSTGRES_REPLICA_PIN", "10"))
+# Queries slower than POSTGRES_SLOW_QUERY_THRESHOLD seconds are logged, at most
+# POSTGRES_SLOW_QUERY_LOG_RATE per minute. A threshold of 0 disables the log.
+postgres.slow_query_threshold = float(
+    os.environ.get("POSTGRES_SLOW_QUERY_THRESHOLD", "0.5")
+)
+postgres.slow_query_log_rate = int(os.environ.get("POSTGRES_SLOW_QUERY_LOG_RATE", "10"))
 
 rapi.host = os.environ.get("RAPI_HOST", "r-api")
 rapi.port = os.environ.get("RAPI_PORT", "31113")
+rapi.timeout = int(os.environ.get("RAPI_TIMEOUT", "30"))
+rapi.pool_size = int(os.environ.get("RAPI_POOL_SIZE", "10"))
+# After RAPI_FAILURE_THRESHOLD consecutive failures, R-API calls fail fast for
+# RAPI_RESET_TIMEOUT seconds.
+rapi.failure_threshold = int(os.environ.get("RAPI_FAILURE_THRESHOLD", "5"))
+rapi.reset_timeout = int(os.environ.get("RAPI_RESET_TIMEOUT", "30"))
+# Genetics results of all genebanks are refreshed this often, besides when
+# the genebanks change
+rapi.refresh_interval = int(os.environ.get("RAPI_REFRESH_INTERVAL", "300"))
 
 service.host = os.environ.get("HERDBOOK_HOST", "https://127.0.0.1:8443")
 service.logfolder = os.environ.get("HERDBOOK_LOGFOLDER", "./")
+service.last_active_interval = int(
+    os.environ.get("HERDBOOK_LAST_ACTIVE_INTERVAL", "30")
+)
+service.certificate_workers = int(os.environ.get("HERDBOOK_CERTIFICATE_WORKERS", "2"))
+# Interpreter for the certificate worker processes. Under uwsgi,
+# sys.executable is the uwsgi binary, which can't run them.
+service.python = os.environ.get(
+    "HERDBOOK_PYTHON", os.path.join(sys.exec_prefix, "bin", "python3")
+)
 
 s3.bucket = os.environ.get("S3_BUCKET", "test")
 s3.endpoint = os.environ.get("S3_ENDPOINT", None)
@@ -40,5 +78,9 @@ s3.secret_key = os.environ.get("S3_SECRETKEY", "secretkeytest")
 s3.access_key = os.environ.get("S3_ACCESSKEY", "accesskeytest")
 s3.verify = json.loads(os.environ.get("S3_VERIFY", "True").lower())
 s3.use_ssl = json.loads(os.environ.get("S3_USESSL", "True").lower())
+s3.cache_dir = os.environ.get(
+    "S3_CACHE_DIR", os.path.join(tempfile.gettempdir(), "herdbook-s3-cache")
+)
+s3.cache_size = int(os.environ.get("S3_CACHE_SIZE", str(256 * 1024 * 1024)))
 s3.cert = None
 s3.private_key = None
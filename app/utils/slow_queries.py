@@ -0,0 +1,178 @@
+"""
+Logging of slow database queries.
+
+Queries taking at least `settings.postgres.slow_query_threshold` seconds are
+aggregated by their normalised SQL, and logged with their redacted
+parameters, the function that made them, and their query plan. At most
+`settings.postgres.slow_query_log_rate` queries are logged, and explained,
+per minute, so that a struggling database isn't also flooded with EXPLAINs.
+"""
+import datetime
+import logging
+import re
+import sys
+import threading
+import time
+
+import utils.settings as settings  # isort:skip
+
+logger = logging.getLogger("herdbook.slow_queries")
+
+LOG_INTERVAL = 60
+# The number of distinct statements kept, the fastest are dropped first
+MAX_STATEMENTS = 500
+# Frames in these modules are skipped when looking for the calling function
+INTERNAL_MODULES = ("peewee", "playhouse", "utils.database", "utils.slow_queries")
+
+PARAMETER_LIST = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)")
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalise(sql):
+    """
+    Returns `sql` with literals replaced by placeholders, and parameter lists
+    of any length collapsed, so that the same query made with different
+    values is aggregated together.
+    """
+    sql = STRING_LITERAL.sub("?", sql)
+    sql = NUMBER_LITERAL.sub("?", sql)
+    sql = PARAMETER_LIST.sub("(...)", sql)
+    return WHITESPACE.sub(" ", sql).strip()
+
+
+def redact(params):
+    """
+    Returns the query parameters `params` with everything but numbers,
+    booleans, dates and nulls replaced by their type and length.
+    """
+    redacted = []
+    for param in params or []:
+        if param is None or isinstance(
+            param, (bool, int, float, datetime.date, datetime.datetime)
+        ):
+            redacted.append(param)
+        elif isinstance(param, (str, bytes)):
+            redacted.append(f"<{type(param).__name__}:{len(param)}>")
+        else:
+            redacted.append(f"<{type(param).__name__}>")
+    return redacted
+
+
+def find_caller():
+    """
+    Returns the function that made the current query, as `module.function`,
+    preferring the closest `utils.data_access` function.
+    """
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    caller = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module == "utils.data_access":
+            return f"{module}.{frame.f_code.co_name}"
+        if caller is None and not module.startswith(INTERNAL_MODULES):
+            caller = f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return caller
+
+
+class SlowQueryLog:
+    """
+    Aggregated statistics of the slow queries, by normalised SQL, and the
+    rate limit of the slow query log.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.window_start = 0.0
+        self.window_count = 0
+        self.suppressed = 0
+
+    def record(self, sql, params, elapsed, explain):
+        """
+        Records the query `sql`, that took `elapsed` seconds. If the query is
+        logged, `explain` is called to get its query plan.
+        """
+        caller = find_caller()
+        normalised = normalise(sql)
+        now = time.time()
+        with self.lock:
+            entry = self.statements.get(normalised, None)
+            if entry is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    fastest = min(
+                        self.statements.values(), key=lambda e: e["total_time"]
+                    )
+                    del self.statements[fastest["sql"]]
+                entry = self.statements[normalised] = {
+                    "sql": normalised,
+                    "count": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "callers": {},
+                    "plan": None,
+                }
+            entry["count"] += 1
+            entry["total_time"] += elapsed
+            entry["max_time"] = max(entry["max_time"], elapsed)
+            entry["callers"][caller] = entry["callers"].get(caller, 0) + 1
+            entry["last_seen"] = now
+
+            suppressed = 0
+            if now - self.window_start >= LOG_INTERVAL:
+                suppressed = self.suppressed
+                self.window_start = now
+                self.window_count = 0
+                self.suppressed = 0
+            log = self.window_count < settings.postgres.slow_query_log_rate
+            if log:
+                self.window_count += 1
+            else:
+                self.suppressed += 1
+
+        if suppressed:
+            logger.warning("%s slow queries were not logged", suppressed)
+        if not log:
+            return
+
+        plan = explain()
+        with self.lock:
+            entry["plan"] = plan
+        logger.warning(
+            "Slow query, %.1f ms in %s: %s; parameters: %s; plan: %s",
+            elapsed * 1000,
+            caller,
+            sql,
+            redact(params),
+            " | ".join(plan) if plan else None,
+        )
+
+    def top(self, limit=20):
+        """
+        Returns the `limit` statements with the highest total time, slowest
+        first.
+        """
+        with self.lock:
+            entries = [
+                dict(entry, callers=dict(entry["callers"]))
+                for entry in self.statements.values()
+            ]
+        entries.sort(key=lambda e: e["total_time"], reverse=True)
+        for entry in entries:
+            entry["mean_time"] = entry["total_time"] / entry["count"]
+        return entries[:limit]
+
+    def clear(self):
+        """
+        Drops all recorded statements, and resets the rate limit.
+        """
+        with self.lock:
+            self.statements.clear()
+            self.window_start = 0.0
+            self.window_count = 0
+            self.suppressed = 0
+
+
+SLOW_QUERY_LOG = SlowQueryLog()